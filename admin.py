@@ -1,3 +1,5 @@
+from contextlib import asynccontextmanager
+
 import httpx
 import pandas as pd
 import uvicorn
@@ -15,8 +17,24 @@ from config import settings
 from database import AsyncSessionLocal, engine
 from src.models import Achievement, Task
 from src.repositories.task import TaskRepository
+from src.utils.grading import is_schema_task
+from src.utils.resource_budget import build_budget
+from src.utils.result_digest import digest_from_expected_result
+from src.utils.schema_upgrade import upgrade_schema
+from src.utils.sql_executor import SQLExecutor
+from src.utils.task_catalog import notify_catalog_changed, notify_sandbox_data_changed
+
+# Профилирование эталонных запросов для бюджетов задач
+game_executor = SQLExecutor(settings.GAME_DATABASE_URL, name="admin")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await upgrade_schema()
+    yield
+
 
-app = FastAPI(title="Admin")
+app = FastAPI(title="Admin", lifespan=lifespan)
 app.add_middleware(
     SessionMiddleware,
     secret_key=settings.SECRET_KEY,
@@ -47,6 +65,24 @@ class TaskStatsView(BaseView):
         )
 
 
+class SandboxCacheView(BaseView):
+    name = "Кэш песочницы"
+    icon = "fa-solid fa-rotate"
+
+    @expose("/sandbox-cache/", methods=["GET", "POST"])
+    async def sandbox_cache_page(self, request: Request):
+        # После перезагрузки данных game_db процессы API сбрасывают кэши
+        # результатов и оценки планов
+        invalidated = request.method == "POST"
+        if invalidated:
+            async with AsyncSessionLocal() as session:
+                await notify_sandbox_data_changed(session)
+                await session.commit()
+        return templates.TemplateResponse(
+            "sandbox_cache.html", {"request": request, "invalidated": invalidated}
+        )
+
+
 class TaskAdmin(ModelView, model=Task):
     column_list = [
         Task.task_id,
@@ -65,6 +101,8 @@ class TaskAdmin(ModelView, model=Task):
         Task.clue,
         Task.correct_query,
         Task.expected_result,
+        Task.grading_options,
+        Task.query_limits,
         Task.tags,
     ]
     column_searchable_list = [Task.task_id, Task.mission_id, Task.title]
@@ -82,15 +120,46 @@ class TaskAdmin(ModelView, model=Task):
                         json={"sql_query": data["correct_query"]},
                     )
                     response.raise_for_status()
-                    model.expected_result = {
-                        "data": response.json()["data"],
-                        "columns": response.json()["columns"],
-                        "row_count": response.json()["row_count"],
-                    }
+                    result = response.json()
                 except Exception as e:
                     model.expected_result = f"Ошибка: {str(e)}"
+                else:
+                    # /run отдает не больше SANDBOX_MAX_ROWS строк: обрезанный
+                    # эталон засчитывал бы верные решения как неверные
+                    if result.get("truncated") or result.get("cursor"):
+                        raise ValueError(
+                            "Результат эталонного запроса обрезан "
+                            f"(больше {result.get('row_count')} строк), "
+                            "сократите выборку или увеличьте SANDBOX_MAX_ROWS"
+                        )
+                    model.expected_result = {
+                        "data": result["data"],
+                        "columns": result["columns"],
+                        "row_count": result["row_count"],
+                    }
+        model.expected_digest = digest_from_expected_result(model.expected_result)
+        # Эталон мог измениться - бюджет считается здесь, а не в /run студента;
+        # None (временный сбой) API досчитает в фоне
+        correct_query = data.get("correct_query")
+        model.resource_budget = (
+            None
+            if is_schema_task(correct_query)
+            else await build_budget(game_executor, correct_query)
+        )
         return await super().on_model_change(data, model, is_created, request)
 
+    async def after_model_change(self, data, model, is_created, request):
+        await self._notify_catalog()
+
+    async def after_model_delete(self, model, request):
+        await self._notify_catalog()
+
+    async def _notify_catalog(self):
+        # Процессы API перечитают каталог задач
+        async with AsyncSessionLocal() as session:
+            await notify_catalog_changed(session)
+            await session.commit()
+
 
 class AchievementAdmin(ModelView, model=Achievement):
     column_list = [
@@ -138,6 +207,7 @@ admin = Admin(
 )
 
 admin.add_view(TaskStatsView)
+admin.add_view(SandboxCacheView)
 admin.add_view(TaskAdmin)
 admin.add_view(AchievementAdmin)
 
@@ -10,15 +10,125 @@ class Settings(BaseSettings):
     DATABASE_URL: str = os.getenv("DB_URL")
     GAME_DATABASE_URL: str = os.getenv("GAME_DATABASE_URL")
     QUEST_DATABASE_URL: str = os.getenv("QUEST_DATABASE_URL")
+    # Роль с правом записи в quest_db для сцен с откатываемыми изменениями;
+    # None - такие сцены недоступны, sql_runner в quest_db только читает
+    QUEST_DML_DATABASE_URL: str | None = os.getenv("QUEST_DML_DATABASE_URL")
     SECRET_KEY: str = os.getenv("ACCESS_TOKEN_SECRET")
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
     TASK_POINTS: list = [100, 300, 500]
+    # Каталог задач в памяти перечитывается по NOTIFY и не реже этого интервала
+    TASK_CATALOG_MAX_AGE_SECONDS: float = 300
+    # Решенные задачи и подсказки пользователей (битовые маски в памяти)
+    USER_TASK_STATE_MAX_USERS: int = 50000
+    USER_TASK_STATE_TTL_SECONDS: float = 300
     ADMIN_USERNAME: str = os.getenv("ADMIN_USERNAME")
     ADMIN_PASSWORD: str = os.getenv("ADMIN_PASSWORD")
     FRONTEND_URL: str = os.getenv("FRONTEND_URL")
     BACKEND_URL: str = os.getenv("BACKEND_URL")
 
+    # Пул соединений песочницы (GAME_DATABASE_URL / QUEST_DATABASE_URL)
+    SANDBOX_POOL_SIZE: int = 10
+    SANDBOX_MAX_OVERFLOW: int = 20
+    SANDBOX_POOL_TIMEOUT: int = 10
+    SANDBOX_POOL_RECYCLE: int = 1800
+    SANDBOX_POOL_PRE_PING: bool = False  # +1 запрос к БД на каждую выдачу соединения
+    SANDBOX_STATEMENT_TIMEOUT_MS: int = 5000
+    SANDBOX_LOCK_TIMEOUT_MS: int = 1000
+    SANDBOX_IDLE_IN_TRANSACTION_TIMEOUT_MS: int = 10000
+
+    # Дополнительные реплики песочницы с теми же данными (JSON-список DSN)
+    GAME_REPLICA_URLS: list = []
+    QUEST_REPLICA_URLS: list = []
+    SANDBOX_REPLICA_MAX_FAILURES: int = 3  # ошибок соединения подряд до исключения
+    SANDBOX_REPLICA_EJECT_SECONDS: int = 30
+    SANDBOX_REPLICA_HEALTH_INTERVAL: int = 10
+
+    # Ограничения на размер результата запроса
+    SANDBOX_STREAM_RESULTS: bool = True  # серверный курсор вместо fetchall
+    SANDBOX_FETCH_CHUNK_ROWS: int = 500
+    SANDBOX_MAX_ROWS: int = 10000
+    SANDBOX_MAX_RESULT_BYTES: int = 8 * 1024 * 1024
+    SANDBOX_EXPORT_MAX_ROWS: int = 1000000
+    SANDBOX_EXPORT_MAX_BYTES: int = 256 * 1024 * 1024
+    SANDBOX_RESPONSE_GZIP_MIN_BYTES: int = 64 * 1024  # 0 - не сжимать ответ /run
+    SANDBOX_RESPONSE_GZIP_LEVEL: int = 5
+
+    # Спул результатов /run для постраничного просмотра (?page_size=)
+    SANDBOX_PAGE_MAX_ROWS: int = 1000
+    SANDBOX_SPOOL_TTL_SECONDS: float = 600
+    SANDBOX_SPOOL_MAX_MEMORY_BYTES: int = 128 * 1024 * 1024
+    SANDBOX_SPOOL_MAX_DISK_BYTES: int = 1024 * 1024 * 1024
+    SANDBOX_SPOOL_MEMORY_ENTRY_BYTES: int = 2 * 1024 * 1024  # крупнее - во временный файл
+    SANDBOX_SPOOL_USER_ENTRIES: int = 4
+    SANDBOX_SPOOL_DIR: str | None = None  # None - системный каталог временных файлов
+    # /run с page_size читает результат до этих границ, а не до SANDBOX_MAX_ROWS
+    SANDBOX_SPOOL_MAX_ROWS: int = 200000
+    SANDBOX_SPOOL_MAX_RESULT_BYTES: int = 64 * 1024 * 1024
+    # Префикс курсора спула; None - имя хоста и pid процесса
+    SANDBOX_SPOOL_INSTANCE_ID: str | None = None
+
+    # Копии игровой БД из шаблона для задач с DDL (CREATE TABLE/ALTER)
+    SANDBOX_CLONE_ENABLED: bool = False
+    SANDBOX_CLONE_TEMPLATE_DB: str = "game_template"
+    SANDBOX_CLONE_ADMIN_URL: str | None = None  # роль с CREATEDB; None - DATABASE_URL
+    SANDBOX_CLONE_MIN_SIZE: int = 2
+    SANDBOX_CLONE_MAX_SIZE: int = 16
+    SANDBOX_CLONE_LEASE_TIMEOUT: float = 30  # ожидание свободной копии
+    SANDBOX_CLONE_SHRINK_SECONDS: float = 60  # без ожиданий - уменьшаем пул на 1
+    # Общий для перезапусков идентификатор экземпляра API; None - имя хоста
+    SANDBOX_CLONE_INSTANCE_ID: str | None = None
+
+    # Допуск запросов к песочнице
+    SANDBOX_MAX_CONCURRENCY: int = 16
+    SANDBOX_MAX_PER_USER: int = 2
+    SANDBOX_MAX_QUEUE: int = 200
+    SANDBOX_MAX_WAIT_SECONDS: float = 5.0
+    SANDBOX_RETRY_AFTER_SECONDS: int = 2
+
+    # Где выполнять запросы и проверку: "inline" - в процессе API,
+    # "process" - в пуле процессов с опросом результата по job_id
+    SANDBOX_EXECUTION_MODE: str = "inline"
+    SANDBOX_WORKER_PROCESSES: int = 4
+    SANDBOX_JOB_WAIT_SECONDS: float = 10.0  # дольше - отдаем 202 и job_id
+    SANDBOX_JOB_TTL_SECONDS: int = 300
+    SANDBOX_DISCONNECT_POLL_SECONDS: float = 0.25  # проверка отключения клиента /run
+
+    # Предварительная оценка запроса через EXPLAIN, пороги по миссиям как в TASK_POINTS
+    SANDBOX_PREFLIGHT_ENABLED: bool = True
+    SANDBOX_PREFLIGHT_MAX_COST: list = [1e6, 5e6, 2e7]
+    SANDBOX_PREFLIGHT_MAX_ROWS: list = [1e6, 5e6, 2e7]
+    SANDBOX_PREFLIGHT_CACHE_SIZE: int = 2048
+
+    # Бюджеты ресурсов задач кратно замерам эталонного запроса (Task.resource_budget)
+    SANDBOX_BUDGET_ENABLED: bool = True
+    SANDBOX_BUDGET_PROFILE_RUNS: int = 3
+    SANDBOX_BUDGET_RETRY_SECONDS: float = 60  # пауза между фоновыми расчетами бюджета
+    SANDBOX_BUDGET_TIME_MULTIPLIER: float = 20.0
+    SANDBOX_BUDGET_MEMORY_MULTIPLIER: float = 2.0
+    SANDBOX_BUDGET_MIN_TIMEOUT_MS: int = 500
+    SANDBOX_BUDGET_MAX_TIMEOUT_MS: int = 15000
+    SANDBOX_BUDGET_MIN_WORK_MEM_KB: int = 4096
+    SANDBOX_BUDGET_MAX_WORK_MEM_KB: int = 65536
+    SANDBOX_BUDGET_TEMP_FILE_LIMIT: bool = False  # temp_file_limit - только суперпользователь
+    SANDBOX_BUDGET_MIN_TEMP_FILE_KB: int = 10240
+    SANDBOX_BUDGET_MAX_TEMP_FILE_KB: int = 1048576
+
+    # Проверка ответов: "python" - сравнение с Task.expected_result,
+    # "database" - сравнение с Task.correct_query внутри игровой БД
+    GRADING_MODE: str = "python"
+    GRADING_DIFF_SAMPLE_ROWS: int = 5
+    GRADING_EXPOSE_MISSING_ROWS: bool = False  # эталон продается как подсказка
+    # Вердикт по отпечатку эталона; True - для неверного ответа еще и построчный дифф
+    GRADING_ROW_DIFF: bool = True
+
+    # Кэш результатов запросов песочницы
+    RESULT_CACHE_ENABLED: bool = True
+    RESULT_CACHE_MAX_ENTRIES: int = 512
+    RESULT_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    RESULT_CACHE_MAX_ENTRY_BYTES: int = 4 * 1024 * 1024
+    RESULT_CACHE_TTL_SECONDS: int = 60
+
     class Config:
         env_file = ".env"
         extra = "ignore"
@@ -79,6 +79,32 @@ if [ -f "/backups/game_db.sql" ]; then
     psql -U "$POSTGRES_USER" -d "game_db" -f "/backups/game_db.sql"
 fi 
 
+echo "Creating game_template for DDL tasks"
+psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" <<-EOSQL
+    CREATE DATABASE game_template TEMPLATE game_db;
+    
+    \c game_template
+    
+    -- В копиях шаблона sql_runner создает таблицы и меняет существующие
+    GRANT CREATE ON SCHEMA public TO sql_runner;
+    
+    DO \$\$
+    DECLARE
+        t record;
+    BEGIN
+        FOR t IN SELECT tablename FROM pg_tables WHERE schemaname = 'public' LOOP
+            EXECUTE format('ALTER TABLE public.%I OWNER TO sql_runner', t.tablename);
+        END LOOP;
+    END
+    \$\$;
+    
+    \c postgres
+    
+    -- Без подключений к шаблону CREATE DATABASE ... TEMPLATE не ждет
+    ALTER DATABASE game_template WITH IS_TEMPLATE true ALLOW_CONNECTIONS false;
+
+EOSQL
+
 
 echo "Creating quest_db"
 psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" <<-EOSQL
@@ -94,6 +120,26 @@ psql -v ON_ERROR_STOP=1 --username "$POSTGRES_USER" <<-EOSQL
     
     ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT SELECT ON TABLES TO sql_runner;
 
+    -- Изменения в сценах с ветвлением выполняются отдельной ролью
+    -- в транзакции с откатом (QUEST_DML_DATABASE_URL)
+    CREATE USER quest_writer WITH PASSWORD '${QUEST_WRITER_PASSWORD}';
+    
+    GRANT CONNECT ON DATABASE quest_db TO quest_writer;
+    
+    GRANT USAGE ON SCHEMA public TO quest_writer;
+    
+    GRANT SELECT, INSERT, UPDATE, DELETE ON ALL TABLES IN SCHEMA public TO quest_writer;
+    
+    ALTER DEFAULT PRIVILEGES IN SCHEMA public
+        GRANT SELECT, INSERT, UPDATE, DELETE ON TABLES TO quest_writer;
+    
+    GRANT USAGE ON ALL SEQUENCES IN SCHEMA public TO quest_writer;
+    
+    ALTER DEFAULT PRIVILEGES IN SCHEMA public GRANT USAGE ON SEQUENCES TO quest_writer;
+
+    -- Вне откатываемой транзакции (SET TRANSACTION READ WRITE) только чтение
+    ALTER ROLE quest_writer IN DATABASE quest_db SET default_transaction_read_only = on;
+
 EOSQL
 
 if [ -f "/backups/quest_db.sql" ]; then
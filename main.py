@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import asyncio
+from contextlib import asynccontextmanager
 
 # from prometheus_client import make_asgi_app, Counter, Histogram
 import time
@@ -13,11 +14,29 @@ from src.api.achievement import router as achievement_router
 from src.api.auth import router as auth_router
 from src.api.profile import router as profile_router
 from src.api.rating import router as rating_router
+from src.api.sandbox import router as sandbox_router
 from src.api.task import router as task_router
 from src.api.user_activity import router as activity_router
 from src.api.quests import router as quests_router
+from src.utils.clone_pool import game_clones
+from src.utils.sandbox_jobs import sandbox_jobs
+from src.utils.schema_upgrade import upgrade_schema
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Новые столбцы задач до первого запроса к ним
+    await upgrade_schema()
+    # Копии игровой БД для DDL-задач создаются при старте, а не на первом запросе
+    if game_clones is not None:
+        game_clones.start()
+    yield
+    sandbox_jobs.close()
+    if game_clones is not None:
+        await game_clones.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # # Добавьте Prometheus middleware
 # metrics_app = make_asgi_app()
@@ -92,6 +111,7 @@ app.include_router(task_router)
 app.include_router(rating_router)
 app.include_router(activity_router)
 app.include_router(quests_router)
+app.include_router(sandbox_router)
 
 
 async def run_server(app, port):
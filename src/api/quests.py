@@ -1,9 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.ext.asyncio import AsyncSession
 import re
+from typing import Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from config import settings
-from database import get_db
+from database import AsyncSessionLocal, get_db
 from src.models.user import User
 from src.repositories.quest import QuestRepository
 from src.schemas.quest import (
@@ -15,18 +17,74 @@ from src.schemas.quest import (
     QuestsListResponse,
 )
 from src.utils.auth import get_current_user
+from src.utils.inflight_runs import inflight_runs
+from src.utils.resource_budget import budget_profiler
+from src.utils.result_diff import ComparisonOptions
+from src.utils.result_export import export_response
+from src.utils.result_response import (
+    MSGPACK_MEDIA_TYPE,
+    response_defaults,
+    sql_response,
+    wants_columnar,
+)
+from src.utils.result_spool import result_limits, result_spool
+from src.utils.sandbox_jobs import sandbox_jobs
 from src.utils.sql_executor import SQLExecutor
 from src.utils.quest_loader import QuestLoader
 from src.utils.scoring_service import ScoringService
+from src.utils.task_catalog import task_catalog
 
 router = APIRouter(prefix="/api/quests", tags=["Квесты"])
-sql_executor = SQLExecutor(settings.QUEST_DATABASE_URL)
+sql_executor = SQLExecutor(
+    [settings.QUEST_DATABASE_URL, *settings.QUEST_REPLICA_URLS],
+    name="quest",
+    dml_url=settings.QUEST_DML_DATABASE_URL,
+)
+task_catalog.on_data_changed(sql_executor.invalidate_cache)
+# affected_rows и прочие поля квестового SQLResponse
+QUEST_RESPONSE_DEFAULTS = response_defaults(SQLResponse)
 
 
 def get_quest_repository(db: AsyncSession = Depends(get_db)) -> QuestRepository:
     return QuestRepository(db)
 
 
+async def _save_scene_budget(
+    quest_id: str, scene_id: str, reference_query: str, budget: dict
+) -> None:
+    async with AsyncSessionLocal() as session:
+        await QuestRepository(session).save_scene_budget(
+            quest_id, scene_id, reference_query, budget
+        )
+
+
+async def _scene_budget(
+    repo: QuestRepository, quest_id: str, scene_data: dict
+) -> dict | None:
+    """
+    Бюджет сцены из памяти процесса или quest_scene_budgets. Если его еще
+    нет, расчет запускается в фоне, а запрос идет без бюджета.
+    """
+    scene_id = scene_data["scene_id"]
+    reference_query = scene_data.get("correct_query")
+    if scene_data["is_branching"] or not reference_query:
+        return None
+    budget = QuestLoader.get_resource_budget(quest_id, scene_id)
+    if budget is not None:
+        return budget
+    budget = await repo.get_scene_budget(quest_id, scene_id, reference_query)
+    if budget is not None:
+        QuestLoader.set_resource_budget(quest_id, scene_id, budget)
+        return budget
+    budget_profiler.schedule(
+        ("quest", quest_id, scene_id),
+        sql_executor,
+        reference_query,
+        lambda budget: _save_scene_budget(quest_id, scene_id, reference_query, budget),
+    )
+    return None
+
+
 def _extract_update_value(sql_query: str) -> str:
     """Упрощенный парсер для извлечения значения из UPDATE запроса."""
     match = re.search(
@@ -36,6 +94,25 @@ def _extract_update_value(sql_query: str) -> str:
         return match.group(1).strip()
     return ""
 
+
+def _branch_value(outcome: dict, scene: dict, sql_query: str) -> str:
+    """
+    Ключ ветки по результату изменяющего запроса: значение branch_query
+    сцены после изменения, иначе первое значение RETURNING. Запрос, который
+    ничего не изменил, ветку не выбирает. Сцены без branch_query выбирают
+    ветку, как раньше, по значению из SET в тексте запроса.
+    """
+    if not scene.get("branch_query"):
+        return _extract_update_value(sql_query)
+    if not outcome["affected_rows"] and not outcome["data"]:
+        return ""
+    if outcome["probe_value"] is not None:
+        return str(outcome["probe_value"])
+    if outcome["data"] and outcome["data"][0]:
+        return str(outcome["data"][0][0])
+    return ""
+
+
 @router.get(
     "",
     summary="Получение списка всех квестов",
@@ -94,10 +171,13 @@ async def get_quest_progress(
     "/{quest_id}/run",
     summary="Выполнение SQL запроса в квесте",
     response_model=SQLResponse,
+    responses={200: {"content": {MSGPACK_MEDIA_TYPE: {}}}},
 )
 async def run_quest_sql(
     quest_id: str,
     request: QuestRunRequest,
+    http_request: Request,
+    page_size: int | None = Query(None, ge=1, le=settings.SANDBOX_PAGE_MAX_ROWS),
     current_user: User = Depends(get_current_user),
     repo: QuestRepository = Depends(get_quest_repository),
 ):
@@ -107,11 +187,29 @@ async def run_quest_sql(
 
     try:
         if scene_data["is_branching"]:
-            raise HTTPException(
-            status_code=403, detail=f"Пока низя"
+            # Изменения выполняются и сразу откатываются, видны RETURNING и число строк
+            work = sandbox_jobs.run_dml(
+                sql_executor, request.sql_query, user_id=current_user.user_id
             )
-        return await sql_executor.execute_sql(request.sql_query)
+        else:
+            work = sandbox_jobs.run_sql(
+                sql_executor,
+                request.sql_query,
+                user_id=current_user.user_id,
+                budget=await _scene_budget(repo, quest_id, scene_data),
+                columnar=wants_columnar(http_request, page_size),
+                **result_limits(page_size),
+            )
+        result = await inflight_runs.run(
+            ("quest", current_user.user_id, quest_id), http_request, work
+        )
+        if isinstance(result, dict):
+            result.pop("probe_value", None)
+        result = await result_spool.paginate(result, current_user.user_id, page_size)
+        return await sql_response(result, http_request, QUEST_RESPONSE_DEFAULTS)
     except HTTPException as e:
+        if e.status_code in (409, 429, 503):
+            raise
         raise HTTPException(
             status_code=400, detail=f"Ошибка выполнения: {str(e.detail)}"
         )
@@ -121,6 +219,35 @@ async def run_quest_sql(
         )
 
 
+@router.post(
+    "/{quest_id}/run/export",
+    summary="Выгрузка результата SQL запроса квеста в файл (NDJSON/CSV)",
+)
+async def export_quest_sql(
+    quest_id: str,
+    request: QuestRunRequest,
+    fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+    current_user: User = Depends(get_current_user),
+    repo: QuestRepository = Depends(get_quest_repository),
+):
+    scene_data = await repo.get_user_current_scene(current_user.user_id, quest_id)
+    if scene_data["scene_id"] != request.scene_id:
+        raise HTTPException(status_code=400, detail="Неверная сцена для выполнения")
+    if scene_data["is_branching"]:
+        raise HTTPException(
+            status_code=400, detail="Выгрузка недоступна для сцен с изменением данных"
+        )
+
+    stream = await sql_executor.open_stream(
+        request.sql_query,
+        max_rows=settings.SANDBOX_EXPORT_MAX_ROWS,
+        max_bytes=settings.SANDBOX_EXPORT_MAX_BYTES,
+        user_id=current_user.user_id,
+        budget=await _scene_budget(repo, quest_id, scene_data),
+    )
+    return export_response(stream, fmt, f"{quest_id}_{request.scene_id}")
+
+
 @router.post(
     "/{quest_id}/submit",
     summary="Отправка решения квеста на проверку",
@@ -137,17 +264,31 @@ async def submit_quest_solution(
 
     user_answer_value = ""
     is_correct = False
+    diff = None
 
     if scene["is_branching"]:
-        user_answer_value = _extract_update_value(request.sql_query)
+        outcome = await sandbox_jobs.run_dml(
+            sql_executor,
+            request.sql_query,
+            probe_query=scene.get("branch_query"),
+            user_id=current_user.user_id,
+        )
+        user_answer_value = _branch_value(outcome, scene, request.sql_query)
         is_correct = user_answer_value in scene.get("branches", {})
     else:
-        if scene.get("expected_result"):
-            user_result = await sql_executor.execute_sql(request.sql_query)
-            expected = scene["expected_result"]
-            is_correct = user_result["columns"] == expected.get(
-                "columns", []
-            ) and user_result["data"] == expected.get("data", [])
+        if scene.get("expected_result") or scene.get("correct_query"):
+            grading = await sandbox_jobs.grade(
+                sql_executor,
+                request.sql_query,
+                expected_result=scene.get("expected_result"),
+                reference_query=scene.get("correct_query"),
+                expected_digest=scene.get("expected_digest"),
+                options=ComparisonOptions.from_dict(scene.get("grading")),
+                user_id=current_user.user_id,
+                budget=await _scene_budget(repo, quest_id, scene),
+            )
+            is_correct = grading["is_correct"]
+            diff = grading["diff"]
         else:
             is_correct = True
 
@@ -176,4 +317,5 @@ async def submit_quest_solution(
         },
         "is_quest_completed": is_quest_completed,
         "awarded_achievements": [],  # TODO: integrate achievements with quest module
+        "diff": diff,
     }
@@ -0,0 +1,91 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+
+from config import settings
+from src.api.quests import sql_executor as quest_executor
+from src.api.task import sql_executor as game_executor
+from src.models.user import User
+from src.utils.auth import get_admin_user, get_current_user
+from src.utils.clone_pool import game_clones
+from src.utils.execution_scheduler import sandbox_scheduler
+from src.utils.inflight_runs import inflight_runs
+from src.utils.resource_budget import budget_profiler
+from src.utils.result_response import MSGPACK_MEDIA_TYPE, sql_response
+from src.utils.result_spool import result_spool
+from src.utils.sandbox_jobs import sandbox_jobs
+from src.utils.task_catalog import task_catalog
+from src.utils.user_task_state import user_task_state
+
+router = APIRouter(prefix="/api/sandbox", tags=["Песочница"])
+
+
+@router.get("/stats", summary="Состояние пулов соединений, кэша и очереди песочницы")
+async def get_sandbox_stats(admin_user: User = Depends(get_admin_user)):
+    return {
+        "scheduler": sandbox_scheduler.stats(),
+        "jobs": sandbox_jobs.stats(),
+        "runs": inflight_runs.stats(),
+        "spool": result_spool.stats(),
+        "clones": game_clones.stats() if game_clones is not None else None,
+        "catalog": task_catalog.stats(),
+        "budgets": budget_profiler.stats(),
+        "user_state": user_task_state.stats(),
+        "executors": {
+            executor.name: {
+                "pool": executor.pool_stats(),
+                "cache": executor.cache_stats(),
+                "plans": (
+                    executor.plan_estimates.stats()
+                    if executor.plan_estimates is not None
+                    else None
+                ),
+            }
+            for executor in (game_executor, quest_executor)
+        },
+    }
+
+
+@router.get("/jobs/{job_id}", summary="Состояние и результат задания песочницы")
+async def get_sandbox_job(job_id: str, current_user: User = Depends(get_current_user)):
+    job = sandbox_jobs.get(job_id, current_user.user_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Задание не найдено")
+    return jsonable_encoder(job.describe())
+
+
+def _check_spool_instance(cursor: str) -> None:
+    # Спул в памяти процесса: страница доступна только там, где выполнен /run
+    if not result_spool.is_local(cursor):
+        raise HTTPException(
+            status_code=421,
+            detail="Результат хранится на другом экземпляре API",
+        )
+
+
+@router.get(
+    "/results/{cursor}",
+    summary="Страница результата /run из спула без повторного выполнения",
+    responses={200: {"content": {MSGPACK_MEDIA_TYPE: {}}}},
+)
+async def get_result_page(
+    cursor: str,
+    http_request: Request,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=settings.SANDBOX_PAGE_MAX_ROWS),
+    current_user: User = Depends(get_current_user),
+):
+    _check_spool_instance(cursor)
+    page = await result_spool.get_page(cursor, current_user.user_id, offset, limit)
+    if page is None:
+        raise HTTPException(
+            status_code=404, detail="Результат устарел, выполните запрос заново"
+        )
+    return await sql_response(page, http_request)
+
+
+@router.delete("/results/{cursor}", summary="Освободить результат в спуле")
+async def release_result(cursor: str, current_user: User = Depends(get_current_user)):
+    _check_spool_instance(cursor)
+    if not result_spool.release(cursor, current_user.user_id):
+        raise HTTPException(status_code=404, detail="Результат не найден")
+    return {"released": True}
@@ -1,11 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy import select
+from typing import Literal
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from config import settings
-from database import get_db
+from database import AsyncSessionLocal, get_db
 from src.api.dependencies import get_task_repository
-from src.models.clue import PurchasedClue
 from src.models.user import User
 from src.repositories.task import TaskRepository
 from src.schemas.task import (
@@ -19,12 +19,52 @@ from src.schemas.task import (
     TaskSubmissionResult,
     TaskWithStatusResponse,
 )
-from src.utils.analytics import log_user_event
+from src.utils.analytics import log_user_event, log_user_event_background
 from src.utils.auth import get_current_user
+from src.utils.clone_pool import game_clones
+from src.utils.grading import DIFF, choose_strategy, is_schema_task, needs_row_diff
+from src.utils.inflight_runs import inflight_runs
+from src.utils.query_preflight import CostLimits
+from src.utils.resource_budget import budget_profiler
+from src.utils.result_diff import ComparisonOptions
+from src.utils.result_export import export_response
+from src.utils.result_response import (
+    MSGPACK_MEDIA_TYPE,
+    sql_response,
+    wants_columnar,
+)
+from src.utils.result_spool import result_limits, result_spool
+from src.utils.sandbox_jobs import sandbox_jobs
 from src.utils.sql_executor import SQLExecutor
+from src.utils.task_catalog import task_catalog
 
 router = APIRouter(prefix="/api/missions", tags=["Миссии и задачи"])
-sql_executor = SQLExecutor(settings.GAME_DATABASE_URL)
+sql_executor = SQLExecutor(
+    [settings.GAME_DATABASE_URL, *settings.GAME_REPLICA_URLS],
+    name="game",
+    clones=game_clones,
+)
+task_catalog.on_data_changed(sql_executor.invalidate_cache)
+
+
+async def _save_task_budget(task_global_id: int, budget: dict) -> None:
+    async with AsyncSessionLocal() as session:
+        await TaskRepository(session).save_resource_budget(task_global_id, budget)
+
+
+def _task_budget(task) -> dict | None:
+    """
+    Бюджет задачи из каталога. Обычно его считает админка при сохранении;
+    если бюджета нет, расчет запускается в фоне, а запрос идет без него.
+    """
+    if task.resource_budget is None and not is_schema_task(task.correct_query):
+        budget_profiler.schedule(
+            ("task", task.task_global_id),
+            sql_executor,
+            task.correct_query,
+            lambda budget: _save_task_budget(task.task_global_id, budget),
+        )
+    return task.resource_budget
 
 
 @router.get(
@@ -46,53 +86,37 @@ async def get_tasks_count(db: AsyncSession = Depends(get_db)):
 async def get_task_info(
     mission_id: int,
     task_id: int,
+    background_tasks: BackgroundTasks,
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
     repo = TaskRepository(db)
-    task, is_solved = await repo.get_task_info_with_status(
-        mission_id, task_id, current_user.user_id
-    )
+    task = await repo.get_task_page(mission_id, task_id, current_user.user_id)
     if not task:
         raise HTTPException(status_code=404, detail="Задача не найдена")
-    purchased_clue1 = await repo.session.execute(
-        select(PurchasedClue.clue_type).where(
-            (PurchasedClue.user_id == current_user.user_id)
-            & (PurchasedClue.task_global_id == task.task_global_id)
-            & (PurchasedClue.clue_type == 1)
-        )
-    )
-    purchased_clue2 = await repo.session.execute(
-        select(PurchasedClue.clue_type).where(
-            (PurchasedClue.user_id == current_user.user_id)
-            & (PurchasedClue.task_global_id == task.task_global_id)
-            & (PurchasedClue.clue_type == 2)
-        )
-    )
-    has_clue1 = purchased_clue1.scalar_one_or_none()
-    has_clue2 = purchased_clue2.scalar_one_or_none()
 
-    prev_mission_id, prev_task_id = await repo.find_prev_task_data(mission_id, task_id)
-    next_mission_id, next_task_id = await repo.find_next_task_data(mission_id, task_id)
-
-    await log_user_event(
-        session=db,
+    # Событие пишется после отправки ответа, в своей сессии
+    background_tasks.add_task(
+        log_user_event_background,
         user_id=current_user.user_id,
         event_type="task_started",
-        task_id=task.task_global_id,
+        task_id=task["task_global_id"],
         payload={"mission_id": mission_id, "task_id": task_id},
     )
 
     return {
-        "task_id": task.task_id,
-        "mission_id": task.mission_id,
-        "title": task.title,
-        "description": task.description,
-        "is_solved": is_solved,
-        "has_clue1": bool(has_clue1),
-        "has_clue2": bool(has_clue2),
-        "previous": {"mission_id": prev_mission_id, "task_id": prev_task_id},
-        "next": {"mission_id": next_mission_id, "task_id": next_task_id},
+        "task_id": task["task_id"],
+        "mission_id": task["mission_id"],
+        "title": task["title"],
+        "description": task["description"],
+        "is_solved": task["is_solved"],
+        "has_clue1": task["has_clue1"],
+        "has_clue2": task["has_clue2"],
+        "previous": {
+            "mission_id": task["prev_mission_id"],
+            "task_id": task["prev_task_id"],
+        },
+        "next": {"mission_id": task["next_mission_id"], "task_id": task["next_task_id"]},
     }
 
 
@@ -112,36 +136,23 @@ async def purchase_clue(
     if not task:
         raise HTTPException(status_code=404, detail="Задача на найдена")
     cost = int(settings.TASK_POINTS[mission_id] * 0.1)
-    purchased_clue1 = await repo.session.execute(
-        select(PurchasedClue.clue_type).where(
-            (PurchasedClue.user_id == current_user.user_id)
-            & (PurchasedClue.task_global_id == task.task_global_id)
-            & (PurchasedClue.clue_type == 1)
-        )
-    )
-    has_clue1 = purchased_clue1.scalar_one_or_none()
-    if has_clue1:
-        return {
-            "points_spent": 0,
-            "total_score": current_user.total_score,
-            "clue": task.clue,
-        }
-    await repo.purchase_clue(
+    points_spent, total_score = await repo.purchase_clue(
         user_id=current_user.user_id,
         task_global_id=task.task_global_id,
         clue_type=1,
         cost=cost,
     )
-    await log_user_event(
-        session=db,
-        user_id=current_user.user_id,
-        event_type="purchase_clue",
-        task_id=task.task_global_id,
-        payload={"mission_id": mission_id, "task_id": task_id, "clue_type": 1},
-    )
+    if points_spent:
+        await log_user_event(
+            session=db,
+            user_id=current_user.user_id,
+            event_type="purchase_clue",
+            task_id=task.task_global_id,
+            payload={"mission_id": mission_id, "task_id": task_id, "clue_type": 1},
+        )
     return {
-        "points_spent": cost,
-        "total_score": current_user.total_score,
+        "points_spent": points_spent,
+        "total_score": total_score,
         "clue": task.clue,
     }
 
@@ -162,37 +173,25 @@ async def purchase_expected_result(
     if not task:
         raise HTTPException(status_code=404, detail="Задача на найдена")
     cost = int(settings.TASK_POINTS[mission_id] * 0.2)
-    purchased_clue2 = await repo.session.execute(
-        select(PurchasedClue.clue_type).where(
-            (PurchasedClue.user_id == current_user.user_id)
-            & (PurchasedClue.task_global_id == task.task_global_id)
-            & (PurchasedClue.clue_type == 2)
-        )
-    )
-    has_clue2 = purchased_clue2.scalar_one_or_none()
-    if has_clue2:
-        return {
-            "points_spent": 0,
-            "total_score": current_user.total_score,
-            "expected_result": task.expected_result,
-        }
-    await repo.purchase_clue(
+    points_spent, total_score = await repo.purchase_clue(
         user_id=current_user.user_id,
         task_global_id=task.task_global_id,
         clue_type=2,
         cost=cost,
     )
-    await log_user_event(
-        session=db,
-        user_id=current_user.user_id,
-        event_type="purchase_clue",
-        task_id=task.task_global_id,
-        payload={"mission_id": mission_id, "task_id": task_id, "clue_type": 2},
-    )
+    expected_result = await repo.get_expected_result(task.task_global_id)
+    if points_spent:
+        await log_user_event(
+            session=db,
+            user_id=current_user.user_id,
+            event_type="purchase_clue",
+            task_id=task.task_global_id,
+            payload={"mission_id": mission_id, "task_id": task_id, "clue_type": 2},
+        )
     return {
-        "points_spent": cost,
-        "total_score": current_user.total_score,
-        "expected_result": task.expected_result,
+        "points_spent": points_spent,
+        "total_score": total_score,
+        "expected_result": expected_result,
     }
 
 
@@ -200,11 +199,14 @@ async def purchase_expected_result(
     "/{mission_id}/tasks/{task_id}/run",
     summary="Выполнение SQL",
     response_model=SQLResponse,
+    responses={200: {"content": {MSGPACK_MEDIA_TYPE: {}}}},
 )
 async def run_sql_query(
     mission_id: int,
     task_id: int,
     request: SQLRequest,
+    http_request: Request,
+    page_size: int | None = Query(None, ge=1, le=settings.SANDBOX_PAGE_MAX_ROWS),
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db),
 ):
@@ -213,19 +215,74 @@ async def run_sql_query(
     if not task:
         raise HTTPException(status_code=404, detail="Задача не найдена")
 
+    stats = None
     try:
+        if is_schema_task(task.correct_query):
+            # DDL выполняется в собственной копии игровой БД
+            work = sql_executor.execute_in_clone(
+                request.sql_query, user_id=current_user.user_id
+            )
+        else:
+            work = sandbox_jobs.run_sql(
+                sql_executor,
+                request.sql_query,
+                user_id=current_user.user_id,
+                limits=CostLimits.for_task(mission_id, task.query_limits),
+                budget=_task_budget(task),
+                columnar=wants_columnar(http_request, page_size),
+                **result_limits(page_size),
+            )
+        # Повторный /run по той же задаче отменяет предыдущий запрос
+        result = await inflight_runs.run(
+            ("task", current_user.user_id, mission_id, task_id), http_request, work
+        )
+        if isinstance(result, dict):
+            stats = result.get("stats")
+        result = await result_spool.paginate(result, current_user.user_id, page_size)
+        return await sql_response(result, http_request)
+    except HTTPException as e:
+        if e.status_code in (409, 429, 503):
+            raise
+        raise HTTPException(status_code=400, detail=f"Runtime error: {str(e.detail)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    finally:
+        # Событие пишется после выполнения, чтобы приложить метрики запроса
         await log_user_event(
             session=db,
             user_id=current_user.user_id,
             event_type="task_attempt",
             task_id=task.task_global_id,
-            payload={"mission_id": mission_id, "task_id": task_id},
+            payload={"mission_id": mission_id, "task_id": task_id, "stats": stats},
         )
-        return await sql_executor.execute_sql(request.sql_query)
-    except HTTPException as e:
-        raise HTTPException(status_code=400, detail=f"Runtime error: {str(e.detail)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+
+@router.post(
+    "/{mission_id}/tasks/{task_id}/run/export",
+    summary="Выгрузка результата SQL в файл (NDJSON/CSV)",
+)
+async def export_sql_query(
+    mission_id: int,
+    task_id: int,
+    request: SQLRequest,
+    fmt: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    repo = TaskRepository(db)
+    task = await repo.get_task_info(mission_id, task_id)
+    if not task:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+
+    stream = await sql_executor.open_stream(
+        request.sql_query,
+        max_rows=settings.SANDBOX_EXPORT_MAX_ROWS,
+        max_bytes=settings.SANDBOX_EXPORT_MAX_BYTES,
+        user_id=current_user.user_id,
+        limits=CostLimits.for_task(mission_id, task.query_limits),
+        budget=_task_budget(task),
+    )
+    return export_response(stream, fmt, f"task_{mission_id}_{task_id}")
 
 
 @router.post(
@@ -245,22 +302,51 @@ async def submit_sql_query(
     if not task:
         raise HTTPException(status_code=404, detail="Задача не найдена")
 
-    user_result = await sql_executor.execute_sql(request.sql_query)
-    expected_result = task.expected_result
+    options = ComparisonOptions.from_dict(task.grading_options)
+    expected_result = None
+    expected_digest = task.expected_digest
+    if choose_strategy(options, task.correct_query, expected_digest) == DIFF:
+        expected_result = await repo.get_expected_result(task.task_global_id)
+        if not expected_digest:
+            expected_digest = await repo.save_expected_digest(
+                task.task_global_id, expected_result
+            )
 
-    if not expected_result:
-        raise HTTPException(
-            status_code=404, detail="Для этой задачи еще не добавлен ответ"
+    limits = CostLimits.for_task(mission_id, task.query_limits)
+    budget = _task_budget(task)
+    grading = await sandbox_jobs.grade(
+        sql_executor,
+        request.sql_query,
+        expected_result=expected_result,
+        reference_query=task.correct_query,
+        expected_digest=expected_digest,
+        options=options,
+        user_id=current_user.user_id,
+        limits=limits,
+        budget=budget,
+    )
+    if needs_row_diff(grading):
+        # Полный эталон читается только для построчного диффа неверного ответа
+        row_diff = await sandbox_jobs.grade(
+            sql_executor,
+            request.sql_query,
+            expected_result=await repo.get_expected_result(task.task_global_id),
+            reference_query=task.correct_query,
+            options=options,
+            user_id=current_user.user_id,
+            limits=limits,
+            budget=budget,
         )
-
-    is_correct = user_result["columns"] == expected_result.get(
-        "columns", []
-    ) and user_result["data"] == expected_result.get("data", [])
+        grading = {
+            **grading,
+            "diff": row_diff["diff"],
+            "stats": {**grading["stats"], "row_diff": True},
+        }
+    is_correct = grading["is_correct"]
     try:
         result = await repo.check_and_reward_task(
             user_id=current_user.user_id,
-            mission_id=mission_id,
-            task_id=task_id,
+            task=task,
             is_correct=is_correct,
         )
         await log_user_event(
@@ -272,9 +358,10 @@ async def submit_sql_query(
                 "mission_id": mission_id,
                 "task_id": task_id,
                 "is_correct": is_correct,
+                "stats": grading["stats"],
             },
         )
-        return {**result, "is_correct": is_correct}
+        return {**result, "is_correct": is_correct, "diff": grading["diff"]}
 
     except IndexError:
         raise HTTPException(
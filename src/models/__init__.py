@@ -5,7 +5,7 @@ from src.models.achievement import (
 )
 from src.models.clue import PurchasedClue
 from src.models.progress import UserProgress
-from src.models.quest import UserQuestProgress
+from src.models.quest import QuestSceneBudget, UserQuestProgress
 from src.models.task import Task, TaskSolved
 from src.models.user_event import UserEvent
 from src.models.user import User, PasswordHash
@@ -17,6 +17,7 @@ __all__ = [
     "PurchasedClue",
     "UserProgress",
     "UserQuestProgress",
+    "QuestSceneBudget",
     "Task",
     "TaskSolved",
     "UserEvent",
@@ -66,3 +66,16 @@ class UserQuestProgress(Base):
     completed_at = Column(DateTime(timezone=True), nullable=True)
 
     user = relationship("User", back_populates="quest_progress")
+
+
+class QuestSceneBudget(Base):
+    """Бюджет ресурсов сцены квеста, посчитанный по ее эталонному запросу"""
+
+    __tablename__ = "quest_scene_budgets"
+
+    quest_id = Column(String, primary_key=True)
+    scene_id = Column(String, primary_key=True)
+    # sha1 эталонного запроса: после правки сцены бюджет считается заново
+    reference_hash = Column(String, nullable=False)
+    resource_budget = Column(JSONB, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
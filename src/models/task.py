@@ -32,6 +32,13 @@ class Task(Base):
     clue = Column(String, nullable=False)
     correct_query = Column(Text)
     expected_result = Column(JSONB)
+    expected_digest = Column(JSONB)
+    # {"mode": "ordered" | "unordered", "ignore_column_order": bool, "tolerance": float}
+    grading_options = Column(JSONB)
+    # {"max_cost": float, "max_rows": float} - пороги EXPLAIN вместо порогов миссии
+    query_limits = Column(JSONB)
+    # Замеры эталонного запроса и лимиты сессии для запросов студента
+    resource_budget = Column(JSONB)
     tags = Column(ARRAY(String))
 
     solved_by = relationship("TaskSolved", back_populates="task")
@@ -1,3 +1,4 @@
+import hashlib
 from collections import defaultdict
 from datetime import datetime
 from pathlib import Path
@@ -5,9 +6,10 @@ from typing import Dict, List, Optional, Tuple
 
 from fastapi import HTTPException
 from sqlalchemy import and_, func, select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.models.quest import UserQuestProgress
+from src.models.quest import QuestSceneBudget, UserQuestProgress
 from src.models.user import User
 from src.repositories.user import UserRepository
 from src.utils.quest_loader import QuestLoader
@@ -130,7 +132,13 @@ class QuestRepository:
             "has_clue": scene_data.get("has_clue", False),
             "is_branching": scene_data.get("is_branching", False),
             "expected_result": scene_data.get("expected_result"),
+            "correct_query": scene_data.get("correct_query"),
+            "grading": scene_data.get("grading"),
+            "expected_digest": QuestLoader.get_expected_digest(
+                quest_id, progress.current_scene_id
+            ),
             "branches": scene_data.get("branches", {}),
+            "branch_query": scene_data.get("branch_query"),
             "default_fail_scene": scene_data.get("default_fail_scene"),
             "next_scene_id": scene_data.get("next_scene_id"),
         }
@@ -178,3 +186,39 @@ class QuestRepository:
             )
         )
         return set(result.scalars().all())
+
+    async def get_scene_budget(
+        self, quest_id: str, scene_id: str, reference_query: str
+    ) -> dict | None:
+        """Бюджет сцены, если он посчитан по текущему эталонному запросу"""
+        result = await self.session.execute(
+            select(QuestSceneBudget.resource_budget).where(
+                and_(
+                    QuestSceneBudget.quest_id == quest_id,
+                    QuestSceneBudget.scene_id == scene_id,
+                    QuestSceneBudget.reference_hash == _reference_hash(reference_query),
+                )
+            )
+        )
+        return result.scalar()
+
+    async def save_scene_budget(
+        self, quest_id: str, scene_id: str, reference_query: str, budget: dict
+    ) -> None:
+        values = {
+            "reference_hash": _reference_hash(reference_query),
+            "resource_budget": budget,
+        }
+        await self.session.execute(
+            insert(QuestSceneBudget)
+            .values(quest_id=quest_id, scene_id=scene_id, **values)
+            .on_conflict_do_update(
+                index_elements=[QuestSceneBudget.quest_id, QuestSceneBudget.scene_id],
+                set_={**values, "created_at": func.now()},
+            )
+        )
+        await self.session.commit()
+
+
+def _reference_hash(reference_query: str) -> str:
+    return hashlib.sha1(reference_query.encode("utf-8")).hexdigest()
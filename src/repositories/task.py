@@ -3,7 +3,8 @@ from datetime import datetime
 from typing import Dict, List
 
 from fastapi import HTTPException
-from sqlalchemy import delete, desc, exists, func, select, update
+from sqlalchemy import delete, desc, exists, func, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from config import settings
@@ -12,8 +13,13 @@ from src.models.progress import UserProgress
 from src.models.task import Task, TaskSolved
 from src.models.user import User
 from src.repositories.achievement import AchievementRepository
-from src.repositories.user import UserRepository
-from src.utils.scoring_service import ScoringService
+from src.utils.result_digest import digest_from_expected_result
+from src.utils.task_catalog import CatalogTask, notify_catalog_changed, task_catalog
+from src.utils.user_task_state import user_task_state
+
+# Счетчики user_progress по mission_id: 0-easy, 1-medium, 2-hard
+PROGRESS_COLUMNS = ("easy_tasks_solved", "medium_tasks_solved", "hard_tasks_solved")
+
 
 class TaskRepository:
     def __init__(self, session: AsyncSession):
@@ -21,26 +27,51 @@ class TaskRepository:
 
     async def get_tasks_count(self) -> dict:
         """Возвращает количество задач по уровням сложности"""
-        result = await self.session.execute(
-            select(Task.mission_id, func.count(Task.task_id)).group_by(Task.mission_id)
-        )
-        counts = {0: 0, 1: 0, 2: 0}  # mission_id: 0-easy, 1-medium, 2-hard
-        for mission_id, count in result.all():
-            counts[mission_id] = count
+        catalog = await task_catalog.get()
+        # mission_id: 0-easy, 1-medium, 2-hard
         return {
-            "easy_tasks_total": counts[0],
-            "medium_tasks_total": counts[1],
-            "hard_tasks_total": counts[2],
+            "easy_tasks_total": catalog.count(0),
+            "medium_tasks_total": catalog.count(1),
+            "hard_tasks_total": catalog.count(2),
         }
 
-    async def get_task_info(self, mission_id: int, task_id: int) -> Task:
-        """Возвращает информацию о задаче"""
+    async def get_task_info(self, mission_id: int, task_id: int) -> CatalogTask | None:
+        """Возвращает информацию о задаче (без эталонного результата)"""
+        catalog = await task_catalog.get()
+        return catalog.get(mission_id, task_id)
+
+    async def get_expected_result(self, task_global_id: int) -> dict | None:
+        """Возвращает эталонный результат задачи"""
         result = await self.session.execute(
-            select(Task).where(
-                (Task.mission_id == mission_id) & (Task.task_id == task_id)
-            )
+            select(Task.expected_result).where(Task.task_global_id == task_global_id)
         )
-        return result.scalars().first()
+        return result.scalar()
+
+    async def save_expected_digest(
+        self, task_global_id: int, expected_result: dict
+    ) -> dict | None:
+        """Считает и сохраняет отпечаток эталона для задач, у которых его еще нет"""
+        digest = digest_from_expected_result(expected_result)
+        if digest is None:
+            return None
+        await self.session.execute(
+            update(Task)
+            .where(Task.task_global_id == task_global_id)
+            .values(expected_digest=digest)
+        )
+        await notify_catalog_changed(self.session)
+        await self.session.commit()
+        return digest
+
+    async def save_resource_budget(self, task_global_id: int, budget: dict) -> None:
+        """Сохраняет бюджет ресурсов, посчитанный по эталонному запросу"""
+        await self.session.execute(
+            update(Task)
+            .where(Task.task_global_id == task_global_id)
+            .values(resource_budget=budget)
+        )
+        await notify_catalog_changed(self.session)
+        await self.session.commit()
 
     async def add_solved_task(self, user_id: int, task_id: int) -> TaskSolved:
         """Добавляет запись о решенной задаче"""
@@ -49,6 +80,7 @@ class TaskRepository:
         )
         self.session.add(solved_task)
         await self.session.commit()
+        user_task_state.mark_solved(user_id, task_id)
         return solved_task
 
     async def get_all_tasks_grouped(self) -> Dict[int, List[dict]]:
@@ -72,35 +104,7 @@ class TaskRepository:
     async def get_all_tasks_grouped_with_status(
         self, user_id: int
     ) -> Dict[int, List[dict]]:
-        req = (
-            select(
-                Task.mission_id,
-                Task.task_id,
-                Task.task_global_id,
-                Task.title,
-                TaskSolved.task_global_id.isnot(None).label("is_solved"),
-            )
-            .select_from(Task)
-            .join(
-                TaskSolved,
-                (Task.task_global_id == TaskSolved.task_global_id)
-                & (TaskSolved.user_id == user_id),
-                isouter=True,
-            )
-            .order_by(Task.mission_id, Task.task_id)
-        )
-        result = await self.session.execute(req)
-        grouped = defaultdict(list)
-        for row in result.all():
-            grouped[row.mission_id].append(
-                {
-                    "task_id": row.task_id,
-                    "task_global_id": row.task_global_id,
-                    "title": row.title,
-                    "is_solved": bool(row.is_solved),
-                }
-            )
-        return dict(grouped)
+        return await self.get_tasks_grouped_by_mission(user_id)
 
     async def get_user_solved_tasks(self, user_id: int) -> Dict[int, List[dict]]:
         """Возвращает решенные пользователем задания, сгруппированные по mission_id"""
@@ -122,102 +126,89 @@ class TaskRepository:
         return dict(grouped)
 
     async def get_tasks_grouped_by_mission(self, user_id: int) -> Dict[int, List[dict]]:
-        stmt = (
-            select(
-                Task.mission_id,
-                Task.task_id,
-                Task.task_global_id,
-                Task.title,
-                TaskSolved.task_global_id.isnot(None).label("is_solved"),
-            )
-            .select_from(Task)
-            .join(
-                TaskSolved,
-                (Task.task_global_id == TaskSolved.task_global_id)
-                & (TaskSolved.user_id == user_id),
-                isouter=True,
-            )
-            .order_by(Task.mission_id, Task.task_id)
-        )
-        result = await self.session.execute(stmt)
+        """Задачи из каталога со статусом решения из состояния пользователя"""
+        catalog = await task_catalog.get()
+        state = await user_task_state.get(self.session, user_id)
         grouped = defaultdict(list)
-        for row in result:
-            grouped[row.mission_id].append(
+        for task in catalog.tasks:
+            grouped[task.mission_id].append(
                 {
-                    "task_id": row.task_id,
-                    "task_global_id": row.task_global_id,
-                    "title": row.title,
-                    "is_solved": bool(row.is_solved),
+                    "task_id": task.task_id,
+                    "task_global_id": task.task_global_id,
+                    "title": task.title,
+                    "is_solved": state.is_solved(task.task_global_id),
                 }
             )
         return dict(grouped)
 
-    async def get_task_info_with_status(
+    async def get_task_page(
         self, mission_id: int, task_id: int, user_id: int
-    ) -> tuple[Task, bool]:
-        """Возвращает задачу и статус решения пользователем"""
-        task_result = await self.session.execute(
-            select(Task).where(
-                (Task.mission_id == mission_id) & (Task.task_id == task_id)
-            )
-        )
-        task = task_result.scalars().first()
-        if not task:
-            return None, False
-        solved_result = await self.session.execute(
-            select(
-                exists().where(
-                    (TaskSolved.task_global_id == task.task_global_id)
-                    & (TaskSolved.user_id == user_id)
-                )
-            )
-        )
-        is_solved = solved_result.scalar()
+    ) -> dict | None:
+        """
+        Данные страницы задачи: поля и соседние задачи из каталога, статус
+        решения и купленные подсказки из состояния пользователя
+        """
+        catalog = await task_catalog.get()
+        task = catalog.get(mission_id, task_id)
+        if task is None:
+            return None
+        prev_task, next_task = catalog.neighbours(task)
 
-        return task, is_solved
+        state = await user_task_state.get(self.session, user_id)
+        return {
+            "task_global_id": task.task_global_id,
+            "task_id": task.task_id,
+            "mission_id": task.mission_id,
+            "title": task.title,
+            "description": task.description,
+            "is_solved": state.is_solved(task.task_global_id),
+            "has_clue1": state.has_clue(1, task.task_global_id),
+            "has_clue2": state.has_clue(2, task.task_global_id),
+            "prev_mission_id": prev_task.mission_id if prev_task else None,
+            "prev_task_id": prev_task.task_id if prev_task else None,
+            "next_mission_id": next_task.mission_id if next_task else None,
+            "next_task_id": next_task.task_id if next_task else None,
+        }
 
     async def check_and_reward_task(
-        self, user_id: int, mission_id: int, task_id: int, is_correct: bool
+        self, user_id: int, task: CatalogTask, is_correct: bool
     ) -> dict:
-
-        task_data = await self._get_task_data(mission_id, task_id)
-        if not task_data:
-            raise HTTPException(status_code=404, detail="Задача не найдена")
-        task_global_id, tags = task_data
-
-        already_solved = await self._check_already_solved(user_id, task_global_id)
-
+        base_points = self._get_base_points(task.mission_id)
         points_earned = 0
         points_penalty = 0
-        message = ""
+        awarded_achievements = []
 
-        scoring_service = ScoringService(self.session)
         if is_correct:
-            if not already_solved:
-                points_earned = self._get_base_points(mission_id)
-                await scoring_service.add_points(user_id, points_earned)
+            first_solve, current_points = await self._record_solve(
+                user_id, task, base_points
+            )
+            already_solved = not first_solve
+            if first_solve:
+                points_earned = base_points
                 message = f"Правильно! Заработано {points_earned} баллов"
+                if task.tags:
+                    achievement_repo = AchievementRepository(self.session)
+                    awarded_achievements = (
+                        await achievement_repo.check_and_award_achievements(
+                            user_id=user_id, task_tags=list(task.tags)
+                        )
+                    )
             else:
                 message = "Правильно! За повторное решение баллы не начисляются"
         else:
+            penalty = int(base_points * 0.1)
+            already_solved, current_points = await self._record_failed_attempt(
+                user_id, task.task_global_id, penalty
+            )
             if not already_solved:
-                points_penalty = int(self._get_base_points(mission_id) * 0.1)
-                await scoring_service.deduct_points(user_id, points_penalty)
+                points_penalty = penalty
                 message = f"Ответ неверный! Списано {points_penalty} баллов"
             else:
                 message = "Ответ неверный! За повторное решение баллы не списываются"
 
-        awarded_achievements = []
-        if is_correct and tags:
-            achievement_repo = AchievementRepository(self.session)
-            awarded_achievements = await achievement_repo.check_and_award_achievements(
-                user_id=user_id, task_tags=tags
-            )
-
         await self.session.commit()
-
-        user_repo = UserRepository(self.session)
-        user_progress = await user_repo.get_user_progress_by_id(user_id)
+        if is_correct:
+            user_task_state.mark_solved(user_id, task.task_global_id)
 
         return {
             "was_solved_before": already_solved,
@@ -225,34 +216,182 @@ class TaskRepository:
             "points_penalty": points_penalty,
             "message": message,
             "awarded_achievements": awarded_achievements,
-            "current_points": user_progress.total_score,
+            "current_points": current_points,
         }
 
+    async def _record_solve(
+        self, user_id: int, task: CatalogTask, points: int
+    ) -> tuple[bool, int]:
+        """
+        Записывает решение одним запросом: вставка в tasks_solved, начисление
+        баллов и счетчик сложности в user_progress выполняются, только если
+        строка решения вставлена. Повторная отправка ждет уникальный индекс
+        и получает DO NOTHING. Возвращает (первое решение, текущие баллы).
+        """
+        solved = (
+            insert(TaskSolved)
+            .values(
+                user_id=user_id,
+                task_global_id=task.task_global_id,
+                solved_at=func.now(),
+            )
+            .on_conflict_do_nothing()
+            .returning(TaskSolved.user_id)
+            .cte("solved")
+        )
+        is_first = exists(select(solved.c.user_id))
+        scored = (
+            update(User)
+            .where((User.user_id == user_id) & is_first)
+            .values(total_score=User.total_score + points)
+            .returning(User.total_score)
+            .cte("scored")
+        )
+        counters = {
+            column: literal(int(index == task.mission_id))
+            for index, column in enumerate(PROGRESS_COLUMNS)
+        }
+        progress = (
+            insert(UserProgress)
+            .from_select(
+                ["user_id", *counters], select(solved.c.user_id, *counters.values())
+            )
+            .on_conflict_do_update(
+                index_elements=[UserProgress.user_id],
+                set_={
+                    column: getattr(UserProgress, column)
+                    + getattr(insert(UserProgress).excluded, column)
+                    for column in counters
+                },
+            )
+            .returning(UserProgress.user_id)
+            .cte("progress")
+        )
+        result = await self.session.execute(
+            select(
+                is_first.label("first_solve"),
+                func.coalesce(
+                    select(scored.c.total_score).scalar_subquery(),
+                    select(User.total_score)
+                    .where(User.user_id == user_id)
+                    .scalar_subquery(),
+                ).label("total_score"),
+            ).add_cte(progress)
+        )
+        row = result.one()
+        return row.first_solve, row.total_score
+
+    async def _record_failed_attempt(
+        self, user_id: int, task_global_id: int, penalty: int
+    ) -> tuple[bool, int]:
+        """
+        Списывает штраф, если задача еще не решена. Возвращает
+        (задача уже решена, текущие баллы)
+        """
+        is_solved = exists().where(
+            (TaskSolved.user_id == user_id)
+            & (TaskSolved.task_global_id == task_global_id)
+        )
+        penalized = (
+            update(User)
+            .where((User.user_id == user_id) & ~is_solved)
+            .values(total_score=User.total_score - penalty)
+            .returning(User.total_score)
+            .cte("penalized")
+        )
+        result = await self.session.execute(
+            select(
+                is_solved.label("already_solved"),
+                func.coalesce(
+                    select(penalized.c.total_score).scalar_subquery(),
+                    select(User.total_score)
+                    .where(User.user_id == user_id)
+                    .scalar_subquery(),
+                ).label("total_score"),
+            )
+        )
+        row = result.one()
+        return row.already_solved, row.total_score
+
     async def purchase_clue(
         self, user_id: int, task_global_id: int, clue_type: int, cost: int
-    ) -> bool:
-        user = await self.session.get(User, user_id)
-        if user.total_score < cost:
-            raise HTTPException(
-                status_code=400, detail="Недостаточно баллов для покупки подсказки"
+    ) -> tuple[int, int]:
+        """
+        Покупка подсказки одним запросом: строка users_clues вставляется,
+        если баллов хватает, и только для вставленной строки списывается
+        cost с условием total_score >= cost. Повторная покупка (в том числе
+        параллельная) получает ON CONFLICT DO NOTHING и ничего не списывает:
+        строка users тогда не обновляется и не блокируется, баланс читается
+        отдельным запросом после отката. Возвращает (списано баллов, баланс).
+        """
+        funded = exists().where(
+            (User.user_id == user_id) & (User.total_score >= cost)
+        )
+        bought = (
+            insert(PurchasedClue)
+            .from_select(
+                ["user_id", "task_global_id", "clue_type"],
+                select(
+                    literal(user_id), literal(task_global_id), literal(clue_type)
+                ).where(funded),
             )
-        user.total_score -= cost
-
-        self.session.add(
-            PurchasedClue(
-                user_id=user_id, task_global_id=task_global_id, clue_type=clue_type
+            .on_conflict_do_nothing()
+            .returning(PurchasedClue.user_id)
+            .cte("bought")
+        )
+        is_bought = exists(select(bought.c.user_id))
+        charged = (
+            update(User)
+            .where(
+                (User.user_id == user_id) & is_bought & (User.total_score >= cost)
             )
+            .values(total_score=User.total_score - cost)
+            .returning(User.total_score)
+            .cte("charged")
+        )
+        result = await self.session.execute(
+            select(
+                is_bought.label("bought"),
+                select(charged.c.total_score).scalar_subquery().label("balance"),
+                funded.label("funded"),
+                exists()
+                .where(
+                    (PurchasedClue.user_id == user_id)
+                    & (PurchasedClue.task_global_id == task_global_id)
+                    & (PurchasedClue.clue_type == clue_type)
+                )
+                .label("owned"),
+            )
+        )
+        row = result.one()
+        if row.bought and row.balance is not None:
+            await self.session.commit()
+            user_task_state.mark_clue(user_id, task_global_id, clue_type)
+            return cost, row.balance
+        # Не вставлено при достаточном балансе - подсказка уже куплена
+        if not row.bought and (row.funded or row.owned):
+            await self.session.rollback()
+            user_task_state.mark_clue(user_id, task_global_id, clue_type)
+            balance = await self.session.scalar(
+                select(User.total_score).where(User.user_id == user_id)
+            )
+            return 0, balance
+        # Баланс потратила параллельная покупка - вставленная строка откатывается
+        await self.session.rollback()
+        raise HTTPException(
+            status_code=400, detail="Недостаточно баллов для покупки подсказки"
         )
-        await self.session.commit()
-        return True
 
     async def clear_purchased_clues(self, user_id: int, task_global_id: int):
+        """Удаляет купленные подсказки; кэш состояния меняется только после commit"""
         await self.session.execute(
             delete(PurchasedClue).where(
                 (PurchasedClue.user_id == user_id)
                 & (PurchasedClue.task_global_id == task_global_id)
             )
         )
+        await self.session.commit()
+        user_task_state.clear_clues(user_id, task_global_id)
 
     async def get_task_stats(self) -> list[dict]:
         """Возвращает статистику по решенным задачам."""
@@ -266,69 +405,21 @@ class TaskRepository:
 
     async def find_next_task_data(self, mission_id, task_id):
         """Возвращает id миссии и задачи для следующей задачи"""
-        next_probable_task_id = task_id + 1
-        next_task_exists = await self.session.execute(
-            select(Task).where(
-                (Task.mission_id == mission_id)
-                & (Task.task_id == next_probable_task_id)
-            )
-        )
-        if next_task_exists.scalars().first():
-            return (mission_id, next_probable_task_id)
-        next_probable_task_id = 1
-        next_probable_mission_id = mission_id + 1
-        next_mission_exists = await self.session.execute(
-            select(Task).where(
-                (Task.mission_id == next_probable_mission_id)
-                & (Task.task_id == next_probable_task_id)
-            )
-        )
-        if next_mission_exists.scalars().first():
-            return (next_probable_mission_id, next_probable_task_id)
-        return (None, None)
+        catalog = await task_catalog.get()
+        task = catalog.get(mission_id, task_id)
+        next_task = catalog.neighbours(task)[1] if task else None
+        if next_task is None:
+            return (None, None)
+        return (next_task.mission_id, next_task.task_id)
 
     async def find_prev_task_data(self, mission_id, task_id):
         """Возвращает id миссии и задачи для предыдущей задачи"""
-        prev_probable_task_id = task_id - 1
-        prev_task_exists = await self.session.execute(
-            select(Task).where(
-                (Task.mission_id == mission_id)
-                & (Task.task_id == prev_probable_task_id)
-            )
-        )
-        if prev_task_exists.scalars().first():
-            return (mission_id, prev_probable_task_id)
-        if mission_id == 0:
+        catalog = await task_catalog.get()
+        task = catalog.get(mission_id, task_id)
+        prev_task = catalog.neighbours(task)[0] if task else None
+        if prev_task is None:
             return (None, None)
-        prev_probable_mission_id = mission_id - 1
-        prev_mission_exists = await self.session.execute(
-            select(Task.task_id)
-            .where(Task.mission_id == prev_probable_mission_id)
-            .order_by(Task.task_id.desc())
-        )
-        prev_task_id = prev_mission_exists.scalars().first()
-        if prev_task_id:
-            return (prev_probable_mission_id, prev_task_id)
-        return (None, None)
-
-    async def _get_task_data(self, mission_id: int, task_id: int) -> tuple | None:
-        """Возвращает (task_global_id, tags) за один запрос"""
-        result = await self.session.execute(
-            select(Task.task_global_id, Task.tags).where(
-                (Task.mission_id == mission_id) & (Task.task_id == task_id)
-            )
-        )
-        row = result.first()
-        return (row.task_global_id, row.tags or []) if row else None
-
-    async def _check_already_solved(self, user_id: int, task_global_id: int) -> bool:
-        result = await self.session.execute(
-            select(exists().where(
-                (TaskSolved.user_id == user_id) & 
-                (TaskSolved.task_global_id == task_global_id)
-            ))
-        )
-        return result.scalar()
+        return (prev_task.mission_id, prev_task.task_id)
 
     def _get_base_points(self, mission_id: int) -> int:
         if 0 <= mission_id < len(settings.TASK_POINTS):
@@ -1,4 +1,4 @@
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional
 from pydantic import BaseModel
 
 
@@ -35,6 +35,7 @@ class QuestSubmitResponse(BaseModel):
     points: PointsInfo
     is_quest_completed: bool
     awarded_achievements: List[AchievementAward] = []
+    diff: Optional[Dict[str, Any]] = None
 
 
 class QuestItem(BaseModel):
@@ -52,3 +53,15 @@ class SQLResponse(BaseModel):
     columns: List[str]
     data: List[List[Any]]
     row_count: int
+    truncated: bool = False
+    total_row_count: Optional[int] = None  # None, если результат обрезан
+    total_row_count_at_least: Optional[int] = None  # нижняя граница для обрезанного
+    plan_estimate: Optional[Dict[str, float]] = None
+    resource_budget: Optional[Dict[str, int]] = None
+    stats: Optional[Dict[str, Any]] = None
+    affected_rows: Optional[int] = None  # сцены с изменением данных
+    # Постраничный просмотр: курсор на следующие строки в спуле результатов
+    cursor: Optional[str] = None
+    offset: Optional[int] = None
+    next_offset: Optional[int] = None
+    spooled_row_count: Optional[int] = None
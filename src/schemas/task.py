@@ -58,6 +58,17 @@ class SQLResponse(BaseModel):
     columns: List[str]
     data: List[List[Any]]
     row_count: int
+    truncated: bool = False
+    total_row_count: Optional[int] = None  # None, если результат обрезан
+    total_row_count_at_least: Optional[int] = None  # нижняя граница для обрезанного
+    plan_estimate: Optional[Dict[str, float]] = None
+    resource_budget: Optional[Dict[str, int]] = None
+    stats: Optional[Dict[str, Any]] = None
+    # Постраничный просмотр: курсор на следующие строки в спуле результатов
+    cursor: Optional[str] = None
+    offset: Optional[int] = None
+    next_offset: Optional[int] = None
+    spooled_row_count: Optional[int] = None
 
 
 class SQLRequest(BaseModel):
@@ -117,3 +128,4 @@ class TaskSubmissionResult(BaseModel):
     is_correct: bool
     awarded_achievements: list[AchievementAward]
     current_points: int
+    diff: Optional[Dict[str, Any]] = None
@@ -1,5 +1,6 @@
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from database import AsyncSessionLocal
 from src.models.user_event import UserEvent
 
 
@@ -18,3 +19,14 @@ async def log_user_event(
     )
     session.add(event)
     await session.commit()
+
+
+async def log_user_event_background(
+    user_id: int, event_type: str, task_id: int = None, payload: dict = None
+):
+    """
+    Запись события вне запроса (BackgroundTasks): своя сессия, ответ
+    пользователю не ждет вставки и commit
+    """
+    async with AsyncSessionLocal() as session:
+        await log_user_event(session, user_id, event_type, task_id, payload)
@@ -52,3 +52,12 @@ async def get_current_user(
     if not user:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
     return user
+
+
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    """Служебные эндпоинты - только для учетной записи ADMIN_USERNAME"""
+    if not settings.ADMIN_USERNAME or current_user.login != settings.ADMIN_USERNAME:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Недостаточно прав"
+        )
+    return current_user
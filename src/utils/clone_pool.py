@@ -0,0 +1,254 @@
+import asyncio
+import os
+import re
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import NullPool
+
+from config import settings
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ClonedDatabase:
+    def __init__(self, name: str, engine: AsyncEngine):
+        self.name = name
+        self.engine = engine
+        self.created_at = time.monotonic()
+
+
+class ClonePool:
+    """
+    Пул заранее созданных копий игровой БД (CREATE DATABASE ... TEMPLATE)
+    для запросов с DDL. Копия выдается одному запросу и после него
+    удаляется, замену создает фоновая задача. Целевой размер растет, когда
+    запрос ждал свободную копию, и уменьшается после shrink_seconds без
+    ожиданий. Все операции с базами идут по одной, через admin_url.
+    """
+
+    def __init__(
+        self,
+        admin_url: str,
+        runner_url: str,
+        template: str,
+        min_size: int,
+        max_size: int,
+        lease_timeout: float,
+        shrink_seconds: float,
+        prefix: str = "sandbox_clone",
+        instance_id: str | None = None,
+    ):
+        self.admin_engine = create_async_engine(
+            admin_url, isolation_level="AUTOCOMMIT", poolclass=NullPool
+        )
+        self.runner_url = make_url(runner_url)
+        self.template = template
+        self.min_size = min_size
+        self.max_size = max_size
+        self.lease_timeout = lease_timeout
+        self.shrink_seconds = shrink_seconds
+        # Копии называются {prefix}_{экземпляр}_{pid}_{id}: при старте удаляются
+        # копии этого экземпляра, созданные уже завершившимися процессами
+        instance = re.sub(
+            r"[^a-z0-9]", "", (instance_id or socket.gethostname()).lower()
+        )[:16]
+        self.instance_prefix = f"{prefix}_{instance}"
+        self.prefix = f"{self.instance_prefix}_{os.getpid()}"
+        self.target = min_size
+        self._ready: asyncio.Queue[ClonedDatabase] = asyncio.Queue()
+        self._retired: list[ClonedDatabase] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._leased = 0
+        self._last_miss = 0.0
+        self._last_resize = 0.0
+        self.leases = 0
+        self.misses = 0
+        self.created = 0
+        self.clone_ms: float | None = None
+        self.last_error: str | None = None
+
+    def start(self) -> None:
+        """Запускает фоновое пополнение: копии готовы до первого запроса"""
+        self._ensure_started()
+
+    @asynccontextmanager
+    async def lease(self):
+        """Соединение с собственной копией БД; после выхода копия удаляется"""
+        self._ensure_started()
+        self.leases += 1
+        if self._ready.empty():
+            self._on_miss()
+        try:
+            clone = await asyncio.wait_for(self._ready.get(), self.lease_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(
+                status_code=503,
+                detail="Нет свободной копии базы данных, попробуйте позже",
+            )
+        self._leased += 1
+        self._wakeup.set()
+        try:
+            async with clone.engine.connect() as conn:
+                yield conn
+        finally:
+            self._leased -= 1
+            self._retired.append(clone)
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "template": self.template,
+            "target": self.target,
+            "ready": self._ready.qsize(),
+            "leased": self._leased,
+            "retired": len(self._retired),
+            "leases": self.leases,
+            "misses": self.misses,
+            "created": self.created,
+            "clone_ms": self.clone_ms,
+            "last_error": self.last_error,
+        }
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        while not self._ready.empty():
+            self._retired.append(self._ready.get_nowait())
+        await self._drop_retired()
+        await self.admin_engine.dispose()
+
+    def _on_miss(self) -> None:
+        self.misses += 1
+        self._last_miss = time.monotonic()
+        if self.target < self.max_size:
+            self.target += 1
+            self._last_resize = self._last_miss
+        self._wakeup.set()
+
+    def _maybe_shrink(self) -> None:
+        now = time.monotonic()
+        if (
+            self.target > self.min_size
+            and now - self._last_miss > self.shrink_seconds
+            and now - self._last_resize > self.shrink_seconds
+        ):
+            self.target -= 1
+            self._last_resize = now
+
+    def _ensure_started(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._refill_loop())
+
+    async def _refill_loop(self) -> None:
+        cleaned = False
+        while True:
+            self._wakeup.clear()
+            self._maybe_shrink()
+            try:
+                if not cleaned:
+                    await self._drop_leftovers()
+                    cleaned = True
+                await self._drop_retired()
+                while self._ready.qsize() > self.target:
+                    self._retired.append(self._ready.get_nowait())
+                    await self._drop_retired()
+                if self._ready.qsize() < self.target:
+                    self._ready.put_nowait(await self._create())
+                    self.last_error = None
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                await asyncio.sleep(1)
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.shrink_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _create(self) -> ClonedDatabase:
+        name = f"{self.prefix}_{uuid.uuid4().hex[:12]}"
+        started = time.perf_counter()
+        async with self.admin_engine.connect() as conn:
+            await conn.execute(
+                text(f'CREATE DATABASE "{name}" TEMPLATE "{self.template}"')
+            )
+        self.clone_ms = round((time.perf_counter() - started) * 1000, 2)
+        self.created += 1
+        engine = create_async_engine(
+            self.runner_url.set(database=name),
+            isolation_level="AUTOCOMMIT",
+            poolclass=NullPool,
+            connect_args={
+                "server_settings": {
+                    "statement_timeout": str(settings.SANDBOX_STATEMENT_TIMEOUT_MS),
+                    "lock_timeout": str(settings.SANDBOX_LOCK_TIMEOUT_MS),
+                }
+            },
+        )
+        return ClonedDatabase(name, engine)
+
+    async def _drop_retired(self) -> None:
+        while self._retired:
+            clone = self._retired[-1]
+            await clone.engine.dispose()
+            await self._drop(clone.name)
+            self._retired.remove(clone)
+
+    async def _drop(self, name: str) -> None:
+        async with self.admin_engine.connect() as conn:
+            await conn.execute(text(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)'))
+
+    async def _drop_leftovers(self) -> None:
+        """
+        Копии этого экземпляра, оставшиеся от прошлых запусков и от
+        завершившихся процессов. Копии живых процессов (другие воркеры на
+        этом хосте) не трогаем.
+        """
+        async with self.admin_engine.connect() as conn:
+            names = (
+                await conn.execute(
+                    text("SELECT datname FROM pg_database WHERE datname LIKE :pattern"),
+                    {"pattern": self.instance_prefix.replace("_", "\\_") + "\\_%"},
+                )
+            ).scalars().all()
+        for name in names:
+            pid = name[len(self.instance_prefix) + 1 :].split("_", 1)[0]
+            if not pid.isdigit():
+                continue
+            if int(pid) == os.getpid() or not _process_alive(int(pid)):
+                await self._drop(name)
+
+
+game_clones = (
+    ClonePool(
+        admin_url=settings.SANDBOX_CLONE_ADMIN_URL or settings.DATABASE_URL,
+        runner_url=settings.GAME_DATABASE_URL,
+        template=settings.SANDBOX_CLONE_TEMPLATE_DB,
+        min_size=settings.SANDBOX_CLONE_MIN_SIZE,
+        max_size=settings.SANDBOX_CLONE_MAX_SIZE,
+        lease_timeout=settings.SANDBOX_CLONE_LEASE_TIMEOUT,
+        shrink_seconds=settings.SANDBOX_CLONE_SHRINK_SECONDS,
+        instance_id=settings.SANDBOX_CLONE_INSTANCE_ID,
+    )
+    if settings.SANDBOX_CLONE_ENABLED
+    else None
+)
@@ -0,0 +1,160 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Hashable
+
+from fastapi import HTTPException
+
+from config import settings
+
+
+class ExecutionScheduler:
+    """
+    Допуск запросов песочницы к БД: общий лимит одновременных запросов,
+    лимит на пользователя и очередь с обходом пользователей по кругу.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_per_user: int,
+        max_queue: int,
+        max_wait_seconds: float,
+        retry_after_seconds: int,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.retry_after_seconds = retry_after_seconds
+        self._running = 0
+        self._queued = 0
+        self._inflight: dict[Hashable, int] = {}
+        self._queues: OrderedDict[Hashable, deque] = OrderedDict()
+        self.admitted = 0
+        self.rejected_user_limit = 0
+        self.rejected_overload = 0
+        self.timed_out = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seen = 0.0
+
+    @asynccontextmanager
+    async def slot(self, user_id: Hashable = None, per_user_limit: bool = True):
+        """per_user_limit=False - служебные запросы (профилирование эталона)"""
+        wait_seconds = await self._acquire(user_id, per_user_limit)
+        try:
+            yield wait_seconds
+        finally:
+            self._release(user_id)
+
+    def stats(self) -> dict:
+        return {
+            "running": self._running,
+            "queued": self._queued,
+            "max_concurrency": self.max_concurrency,
+            "admitted": self.admitted,
+            "rejected_user_limit": self.rejected_user_limit,
+            "rejected_overload": self.rejected_overload,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": (
+                round(self.total_wait_seconds / self.admitted * 1000, 2)
+                if self.admitted
+                else 0.0
+            ),
+            "max_wait_ms": round(self.max_wait_seen * 1000, 2),
+        }
+
+    async def _acquire(self, user_id: Hashable, per_user_limit: bool = True) -> float:
+        if per_user_limit and self._inflight.get(user_id, 0) >= self.max_per_user:
+            self.rejected_user_limit += 1
+            raise self._reject(429, "Слишком много одновременных запросов")
+        if self._running < self.max_concurrency and not self._queued:
+            self._running += 1
+            self._admit(user_id, 0.0)
+            return 0.0
+        if self._queued >= self.max_queue:
+            self.rejected_overload += 1
+            raise self._reject(503, "Песочница перегружена, повторите запрос позже")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._queued += 1
+        self._inflight[user_id] = self._inflight.get(user_id, 0) + 1
+        started = time.monotonic()
+        try:
+            done, _ = await asyncio.wait({waiter}, timeout=self.max_wait_seconds)
+        except asyncio.CancelledError:
+            self._abandon(user_id, waiter)
+            raise
+        if not done:
+            self._abandon(user_id, waiter)
+            self.timed_out += 1
+            raise self._reject(503, "Превышено время ожидания в очереди песочницы")
+
+        self._inflight[user_id] -= 1
+        wait_seconds = time.monotonic() - started
+        self._admit(user_id, wait_seconds)
+        return wait_seconds
+
+    def _admit(self, user_id: Hashable, wait_seconds: float) -> None:
+        self._inflight[user_id] = self._inflight.get(user_id, 0) + 1
+        self.admitted += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seen = max(self.max_wait_seen, wait_seconds)
+
+    def _abandon(self, user_id: Hashable, waiter: asyncio.Future) -> None:
+        self._decrement(user_id)
+        if waiter.done() and not waiter.cancelled():
+            # Слот уже выдан, но ожидающий ушел - передаем слот дальше
+            self._running -= 1
+            self._dispatch()
+            return
+        waiter.cancel()
+        queue = self._queues.get(user_id)
+        if queue is not None and waiter in queue:
+            queue.remove(waiter)
+            self._queued -= 1
+            if not queue:
+                del self._queues[user_id]
+
+    def _release(self, user_id: Hashable) -> None:
+        self._decrement(user_id)
+        self._running -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._running < self.max_concurrency and self._queues:
+            # Берем первого пользователя и переставляем его в конец круга
+            user_id, queue = self._queues.popitem(last=False)
+            waiter = queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._queues[user_id] = queue
+            if waiter.done():
+                continue
+            self._running += 1
+            waiter.set_result(None)
+
+    def _decrement(self, user_id: Hashable) -> None:
+        count = self._inflight.get(user_id, 0) - 1
+        if count > 0:
+            self._inflight[user_id] = count
+        else:
+            self._inflight.pop(user_id, None)
+
+    def _reject(self, status_code: int, detail: str) -> HTTPException:
+        return HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(self.retry_after_seconds)},
+        )
+
+
+sandbox_scheduler = ExecutionScheduler(
+    max_concurrency=settings.SANDBOX_MAX_CONCURRENCY,
+    max_per_user=settings.SANDBOX_MAX_PER_USER,
+    max_queue=settings.SANDBOX_MAX_QUEUE,
+    max_wait_seconds=settings.SANDBOX_MAX_WAIT_SECONDS,
+    retry_after_seconds=settings.SANDBOX_RETRY_AFTER_SECONDS,
+)
@@ -0,0 +1,233 @@
+import time
+
+from fastapi import HTTPException
+
+from config import settings
+from src.utils.query_preflight import CostLimits
+from src.utils.result_diff import ORDERED, ComparisonOptions, ResultComparator
+from src.utils.sql_executor import SQLExecutor
+from src.utils.sql_lexer import DDL_STATEMENTS, SQLSyntaxError, sql_analysis_cache
+
+# Способы проверки ответа
+DATABASE = "database"  # EXCEPT ALL с эталонным запросом внутри игровой БД
+DIGEST = "digest"  # сверка с отпечатком эталона, без построчного диффа
+DIFF = "diff"  # построчное сравнение с Task.expected_result
+SCHEMA = "schema"  # DDL: структура таблиц после запроса в копии БД
+
+
+def is_order_sensitive(reference_query: str) -> bool:
+    """Порядок строк важен, если эталонный запрос сам его задает"""
+    try:
+        return sql_analysis_cache.analyze(reference_query).ordered
+    except SQLSyntaxError:
+        return False
+
+
+def is_schema_task(reference_query: str | None) -> bool:
+    """Задача на DDL: эталон меняет схему, проверка идет в копии БД"""
+    if not reference_query:
+        return False
+    try:
+        analysis = sql_analysis_cache.analyze(reference_query)
+    except SQLSyntaxError:
+        return False
+    return analysis.statement_type in DDL_STATEMENTS
+
+
+def is_ordered(options: ComparisonOptions, reference_query: str | None) -> bool:
+    if options.mode is not None:
+        return options.mode == ORDERED
+    return reference_query is None or is_order_sensitive(reference_query)
+
+
+def choose_strategy(
+    options: ComparisonOptions,
+    reference_query: str | None,
+    expected_digest: dict | None,
+) -> str:
+    if is_schema_task(reference_query):
+        return SCHEMA
+    if settings.GRADING_MODE == DATABASE and reference_query and options.is_exact:
+        return DATABASE
+    if expected_digest and options.is_exact:
+        return DIGEST
+    return DIFF
+
+
+def needs_row_diff(grading: dict) -> bool:
+    """
+    Вердикт получен по отпечатку, ответ неверный и нужен построчный дифф:
+    только тогда вызывающий загружает полный эталон и проверяет еще раз
+    """
+    return (
+        settings.GRADING_ROW_DIFF
+        and not grading["is_correct"]
+        and grading["stats"]["strategy"] == DIGEST
+        and not grading["stats"].get("row_diff")
+    )
+
+
+def _public_diff(comparison: dict) -> dict:
+    diff = {key: value for key, value in comparison.items() if key != "is_correct"}
+    if not settings.GRADING_EXPOSE_MISSING_ROWS:
+        diff.pop("missing_rows", None)
+        diff.pop("expected_columns", None)
+    return diff
+
+
+def _verdict(comparison: dict) -> dict:
+    return {
+        "is_correct": comparison["is_correct"],
+        "diff": None if comparison["is_correct"] else _public_diff(comparison),
+    }
+
+
+async def _diff_with_expected(
+    executor: SQLExecutor,
+    sql_query: str,
+    expected_result: dict,
+    options: ComparisonOptions,
+    ordered: bool,
+    user_id: int = None,
+    limits: CostLimits = None,
+    budget: dict = None,
+) -> dict:
+    sample_size = settings.GRADING_DIFF_SAMPLE_ROWS
+    comparator = ResultComparator(
+        expected_result.get("columns", []),
+        expected_result.get("data", []),
+        options,
+        ordered=ordered,
+        sample_size=sample_size,
+    )
+    # Лишние строки дальше выборки расхождений не читаем
+    stream = await executor.open_stream(
+        sql_query,
+        max_rows=len(comparator.expected_rows) + sample_size + 1,
+        max_bytes=settings.SANDBOX_EXPORT_MAX_BYTES,
+        user_id=user_id,
+        limits=limits,
+        budget=budget,
+    )
+    try:
+        if not comparator.check_columns(stream.columns):
+            return {
+                "is_correct": False,
+                "columns": stream.columns,
+                "expected_columns": comparator.expected_columns,
+            }
+        async for chunk in stream.chunks():
+            comparator.feed(chunk)
+    finally:
+        await stream.aclose()
+
+    comparison = comparator.finish()
+    comparison["columns"] = stream.columns
+    comparison["truncated"] = stream.truncated
+    if stream.truncated:
+        comparison["is_correct"] = False
+    return comparison
+
+
+async def _compare_schema(
+    executor: SQLExecutor, sql_query: str, reference_query: str, user_id: int = None
+) -> dict:
+    schemas = await executor.compare_schema(sql_query, reference_query, user_id)
+    comparator = ResultComparator(
+        schemas["columns"],
+        schemas["expected_data"],
+        ComparisonOptions(),
+        ordered=False,
+        sample_size=settings.GRADING_DIFF_SAMPLE_ROWS,
+    )
+    comparator.feed(schemas["data"])
+    comparison = comparator.finish()
+    comparison["columns"] = schemas["columns"]
+    return comparison
+
+
+async def grade_submission(
+    executor: SQLExecutor,
+    sql_query: str,
+    expected_result: dict | None = None,
+    reference_query: str | None = None,
+    expected_digest: dict | None = None,
+    options: ComparisonOptions = ComparisonOptions(),
+    user_id: int = None,
+    limits: CostLimits = None,
+    budget: dict = None,
+) -> dict:
+    """
+    Проверяет ответ студента; budget - лимиты сессии задачи, как на /run.
+    Возвращает {"is_correct": bool, "diff": dict | None, "stats": dict}
+    """
+    started = time.perf_counter()
+    ordered = is_ordered(options, reference_query)
+    strategy = choose_strategy(options, reference_query, expected_digest)
+    row_diff = strategy == DIFF
+
+    if strategy == SCHEMA:
+        comparison = await _compare_schema(executor, sql_query, reference_query, user_id)
+    elif strategy == DATABASE:
+        comparison = await executor.compare_with_reference(
+            sql_query,
+            reference_query,
+            ordered=ordered,
+            user_id=user_id,
+            limits=limits,
+            budget=budget,
+        )
+    elif strategy == DIGEST:
+        comparison = await executor.check_digest(
+            sql_query,
+            expected_digest,
+            ordered=ordered,
+            user_id=user_id,
+            limits=limits,
+            budget=budget,
+        )
+        row_diff = (
+            settings.GRADING_ROW_DIFF
+            and not comparison["is_correct"]
+            and isinstance(expected_result, dict)
+        )
+        if row_diff:
+            # Эталон уже в памяти (сцена квеста) - дифф для неверного ответа сразу;
+            # вердикт остается за отпечатком
+            comparison = {
+                **await _diff_with_expected(
+                    executor,
+                    sql_query,
+                    expected_result,
+                    options,
+                    ordered,
+                    user_id,
+                    limits,
+                    budget,
+                ),
+                "is_correct": False,
+            }
+    else:
+        if not isinstance(expected_result, dict):
+            raise HTTPException(
+                status_code=404, detail="Для этой задачи еще не добавлен ответ"
+            )
+        comparison = await _diff_with_expected(
+            executor,
+            sql_query,
+            expected_result,
+            options,
+            ordered,
+            user_id,
+            limits,
+            budget,
+        )
+    return {
+        **_verdict(comparison),
+        "stats": {
+            "strategy": strategy,
+            "row_diff": row_diff,
+            "grading_ms": round((time.perf_counter() - started) * 1000, 2),
+            "rows": comparison.get("row_count"),
+        },
+    }
@@ -0,0 +1,64 @@
+import asyncio
+from typing import Awaitable, Hashable
+
+from fastapi import HTTPException, Request
+
+from config import settings
+
+
+class InflightRuns:
+    """
+    Не больше одного выполняющегося /run на пользователя и задачу: новый
+    запрос отменяет предыдущий, отключение клиента отменяет его запрос.
+    Отмена asyncio-задачи прерывает запрос и на сервере БД (asyncpg
+    отправляет cancel request), соединение возвращается в пул.
+    """
+
+    def __init__(self, poll_seconds: float):
+        self.poll_seconds = poll_seconds
+        self._runs: dict[Hashable, asyncio.Task] = {}
+        self.superseded = 0
+        self.disconnected = 0
+
+    async def run(self, key: Hashable, request: Request, work: Awaitable):
+        previous = self._runs.get(key)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.superseded += 1
+        task = asyncio.ensure_future(work)
+        self._runs[key] = task
+        watcher = asyncio.create_task(self._watch_disconnect(request, task))
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            watcher.cancel()
+            if self._runs.get(key) is task:
+                del self._runs[key]
+
+        if task.cancelled():
+            raise HTTPException(
+                status_code=409,
+                detail="Запрос отменен: отправлен новый запрос или клиент отключился",
+            )
+        return task.result()
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._runs),
+            "superseded": self.superseded,
+            "disconnected": self.disconnected,
+        }
+
+    async def _watch_disconnect(self, request: Request, task: asyncio.Task) -> None:
+        while not task.done():
+            if await request.is_disconnected():
+                task.cancel()
+                self.disconnected += 1
+                return
+            await asyncio.sleep(self.poll_seconds)
+
+
+inflight_runs = InflightRuns(poll_seconds=settings.SANDBOX_DISCONNECT_POLL_SECONDS)
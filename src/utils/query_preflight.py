@@ -0,0 +1,110 @@
+import json
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import NamedTuple
+
+from config import settings
+
+
+class PlanEstimate(NamedTuple):
+    """Оценка планировщика для корневого узла плана"""
+
+    total_cost: float
+    plan_rows: float
+    planning_ms: float | None = None
+
+    def as_dict(self) -> dict:
+        return {"total_cost": self.total_cost, "plan_rows": self.plan_rows}
+
+
+def parse_explain(plan) -> PlanEstimate:
+    """Разбирает результат EXPLAIN (FORMAT JSON, SUMMARY), строкой или списком"""
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    root = plan[0]["Plan"]
+    return PlanEstimate(
+        total_cost=float(root["Total Cost"]),
+        plan_rows=float(root["Plan Rows"]),
+        planning_ms=plan[0].get("Planning Time"),
+    )
+
+
+def _mission_limit(limits: list, mission_id: int | None):
+    if not limits:
+        return None
+    if mission_id is None or not 0 <= mission_id < len(limits):
+        # Квесты и неизвестные миссии - самый мягкий лимит
+        return max(limits)
+    return limits[mission_id]
+
+
+@dataclass(frozen=True)
+class CostLimits:
+    """Пороги предварительной оценки: по миссии из настроек или из Task.query_limits"""
+
+    max_cost: float | None = None
+    max_rows: float | None = None
+
+    @classmethod
+    def for_task(
+        cls, mission_id: int | None = None, overrides: dict | None = None
+    ) -> "CostLimits":
+        overrides = overrides or {}
+        return cls(
+            max_cost=overrides.get(
+                "max_cost",
+                _mission_limit(settings.SANDBOX_PREFLIGHT_MAX_COST, mission_id),
+            ),
+            max_rows=overrides.get(
+                "max_rows",
+                _mission_limit(settings.SANDBOX_PREFLIGHT_MAX_ROWS, mission_id),
+            ),
+        )
+
+    def violation(self, estimate: PlanEstimate) -> str | None:
+        """Текст ошибки для студента, если оценка превышает пороги"""
+        problems = []
+        if self.max_cost is not None and estimate.total_cost > self.max_cost:
+            problems.append(
+                f"оценка стоимости {estimate.total_cost:.0f}"
+                f" при лимите {self.max_cost:.0f}"
+            )
+        if self.max_rows is not None and estimate.plan_rows > self.max_rows:
+            problems.append(
+                f"ожидается строк {estimate.plan_rows:.0f}"
+                f" при лимите {self.max_rows:.0f}"
+            )
+        if not problems:
+            return None
+        return "Запрос слишком тяжелый и не был выполнен: " + ", ".join(problems)
+
+
+class PlanCache:
+    """LRU-кэш оценок планов по отпечатку запроса"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, PlanEstimate] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint: str) -> PlanEstimate | None:
+        estimate = self._entries.get(fingerprint)
+        if estimate is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(fingerprint)
+        self.hits += 1
+        return estimate
+
+    def put(self, fingerprint: str, estimate: PlanEstimate) -> None:
+        self._entries[fingerprint] = estimate
+        self._entries.move_to_end(fingerprint)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -3,9 +3,13 @@ from pathlib import Path
 from typing import Dict, Any
 from fastapi import HTTPException
 
+from src.utils.result_digest import digest_from_expected_result
+
 
 class QuestLoader:
     _cache: Dict[str, dict] = {}
+    _digests: Dict[tuple, dict | None] = {}
+    _budgets: Dict[tuple, dict] = {}
     _quests_dir = Path("content/quests")
 
     @classmethod
@@ -32,6 +36,26 @@ class QuestLoader:
             raise HTTPException(status_code=404, detail="Сцена не найдена")
         return scene
     
+    @classmethod
+    def get_expected_digest(cls, quest_id: str, scene_id: str) -> dict | None:
+        """Отпечаток эталонного результата сцены, считается один раз"""
+        key = (quest_id, scene_id)
+        if key not in cls._digests:
+            scene = cls.get_scene(quest_id, scene_id)
+            cls._digests[key] = digest_from_expected_result(
+                scene.get("expected_result")
+            )
+        return cls._digests[key]
+
+    @classmethod
+    def get_resource_budget(cls, quest_id: str, scene_id: str) -> dict | None:
+        return cls._budgets.get((quest_id, scene_id))
+
+    @classmethod
+    def set_resource_budget(cls, quest_id: str, scene_id: str, budget: dict):
+        """Бюджет из quest_scene_budgets, прочитанный этим процессом"""
+        cls._budgets[(quest_id, scene_id)] = budget
+
     @classmethod
     def get_all_quests(cls) -> list[dict]:
         """Возвращает информацию о всех доступных квестах"""
@@ -0,0 +1,151 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+
+def _is_connection_failure(error: BaseException) -> bool:
+    """Отличает недоступность реплики от ошибки в самом запросе студента"""
+    if isinstance(error, (OSError, asyncio.TimeoutError)):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+class Replica:
+    def __init__(self, engine: AsyncEngine):
+        self.engine = engine
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def healthy(self) -> bool:
+        return self.ejected_until <= time.monotonic()
+
+    def stats(self) -> dict:
+        pool = self.engine.pool
+        return {
+            "url": self.engine.url.render_as_string(hide_password=True),
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+        }
+
+
+class ReplicaPool:
+    """
+    Набор одинаковых read-only реплик песочницы. Запрос уходит на реплику
+    с наименьшим числом выполняющихся запросов; после max_failures ошибок
+    соединения подряд реплика исключается на eject_seconds, фоновая проверка
+    возвращает ее раньше, если она снова отвечает. Первая БД в списке -
+    основная: изменяющие запросы идут только на нее.
+    """
+
+    def __init__(
+        self,
+        engines: list[AsyncEngine],
+        max_failures: int,
+        eject_seconds: float,
+        health_interval: float,
+    ):
+        if not engines:
+            raise ValueError("Нужна хотя бы одна БД для песочницы")
+        self.replicas = [Replica(engine) for engine in engines]
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.health_interval = health_interval
+        self._health_task: asyncio.Task | None = None
+
+    def choose(self, exclude: tuple = ()) -> Replica:
+        candidates = [replica for replica in self.replicas if replica not in exclude]
+        healthy = [replica for replica in candidates if replica.healthy]
+        if not healthy:
+            # Все реплики исключены - пробуем ту, что вернется раньше остальных
+            return min(candidates, key=lambda replica: replica.ejected_until)
+        # При равной нагрузке - та, что получила меньше запросов
+        return min(healthy, key=lambda replica: (replica.outstanding, replica.requests))
+
+    @asynccontextmanager
+    async def connect(self, primary: bool = False):
+        self._ensure_health_checks()
+        replica, conn = await self._acquire(primary)
+        try:
+            yield conn
+        except BaseException as e:
+            if _is_connection_failure(e):
+                self._record_failure(replica)
+            raise
+        else:
+            replica.consecutive_failures = 0
+        finally:
+            replica.outstanding -= 1
+            await conn.close()
+
+    async def _acquire(self, primary: bool = False) -> tuple[Replica, AsyncConnection]:
+        """Открывает соединение; если реплика недоступна, пробует следующую"""
+        tried = []
+        while True:
+            replica = self.replicas[0] if primary else self.choose(exclude=tried)
+            replica.outstanding += 1
+            replica.requests += 1
+            try:
+                return replica, await replica.engine.connect().start()
+            except BaseException as e:
+                replica.outstanding -= 1
+                if not _is_connection_failure(e):
+                    raise
+                self._record_failure(replica)
+                tried.append(replica)
+                if primary or len(tried) == len(self.replicas):
+                    raise
+
+    async def check_health(self) -> None:
+        for replica in self.replicas:
+            try:
+                async with replica.engine.connect() as conn:
+                    await conn.execute(text("SELECT 1"))
+            except Exception:
+                self._record_failure(replica)
+            else:
+                replica.consecutive_failures = 0
+                replica.ejected_until = 0.0
+
+    def stats(self) -> list[dict]:
+        return [replica.stats() for replica in self.replicas]
+
+    async def dispose(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def _record_failure(self, replica: Replica) -> None:
+        replica.failures += 1
+        replica.consecutive_failures += 1
+        if replica.consecutive_failures >= self.max_failures:
+            replica.ejected_until = time.monotonic() + self.eject_seconds
+
+    def _ensure_health_checks(self) -> None:
+        # С одной БД выбирать не из чего, проверки не нужны
+        if len(self.replicas) < 2 or self._health_task is not None:
+            return
+        self._health_task = asyncio.get_running_loop().create_task(
+            self._health_loop()
+        )
+
+    async def _health_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
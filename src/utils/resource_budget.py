@@ -0,0 +1,199 @@
+import asyncio
+import json
+import statistics
+import time
+
+from sqlalchemy.exc import DBAPIError
+
+from config import settings
+
+BUDGET_VERSION = 1
+_BLOCK_KB = 8
+# Классы SQLSTATE, которые говорят о состоянии сервера, а не об эталоне:
+# соединение, ресурсы, отмена/таймаут, конфликт транзакций
+_TRANSIENT_SQLSTATE_CLASSES = ("08", "40", "53", "57")
+_LOCK_NOT_AVAILABLE = "55P03"
+
+
+def _nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _nodes(child)
+
+
+def profile_from_explain(explain) -> dict:
+    """Замер одного прогона EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON)"""
+    if isinstance(explain, str):
+        explain = json.loads(explain)
+    root = explain[0]
+    plan = root["Plan"]
+    memory_kb = max(
+        (
+            node.get(key, 0)
+            for node in _nodes(plan)
+            for key in ("Sort Space Used", "Peak Memory Usage", "Disk Usage")
+        ),
+        default=0,
+    )
+    return {
+        "execution_ms": root.get("Execution Time", 0.0),
+        "planning_ms": root.get("Planning Time", 0.0),
+        "rows": plan.get("Actual Rows", 0),
+        "memory_kb": memory_kb,
+        # Счетчики буферов в корне плана накопительные
+        "temp_kb": plan.get("Temp Written Blocks", 0) * _BLOCK_KB,
+    }
+
+
+def summarize_profiles(profiles: list[dict]) -> dict:
+    """Базовая линия эталона: медиана времени, максимум памяти и temp"""
+    return {
+        "runs": len(profiles),
+        "execution_ms": round(
+            statistics.median(profile["execution_ms"] for profile in profiles), 3
+        ),
+        "planning_ms": round(
+            statistics.median(profile["planning_ms"] for profile in profiles), 3
+        ),
+        "rows": max(profile["rows"] for profile in profiles),
+        "memory_kb": max(profile["memory_kb"] for profile in profiles),
+        "temp_kb": max(profile["temp_kb"] for profile in profiles),
+    }
+
+
+def _clamp(value: float, low: int, high: int) -> int:
+    return int(min(max(value, low), high))
+
+
+def compute_budget(baseline: dict) -> dict:
+    """Лимиты для запросов студента кратно замерам эталонного запроса"""
+    return {
+        "version": BUDGET_VERSION,
+        "baseline": baseline,
+        "statement_timeout_ms": _clamp(
+            (baseline["execution_ms"] + baseline["planning_ms"])
+            * settings.SANDBOX_BUDGET_TIME_MULTIPLIER,
+            settings.SANDBOX_BUDGET_MIN_TIMEOUT_MS,
+            settings.SANDBOX_BUDGET_MAX_TIMEOUT_MS,
+        ),
+        "work_mem_kb": _clamp(
+            baseline["memory_kb"] * settings.SANDBOX_BUDGET_MEMORY_MULTIPLIER,
+            settings.SANDBOX_BUDGET_MIN_WORK_MEM_KB,
+            settings.SANDBOX_BUDGET_MAX_WORK_MEM_KB,
+        ),
+        "temp_file_limit_kb": _clamp(
+            baseline["temp_kb"] * settings.SANDBOX_BUDGET_MEMORY_MULTIPLIER,
+            settings.SANDBOX_BUDGET_MIN_TEMP_FILE_KB,
+            settings.SANDBOX_BUDGET_MAX_TEMP_FILE_KB,
+        ),
+    }
+
+
+def budget_settings(budget: dict | None) -> dict:
+    """Параметры сессии для set_config(..., true) внутри транзакции запроса"""
+    if not budget or "statement_timeout_ms" not in budget:
+        return {}
+    values = {
+        "statement_timeout": f"{budget['statement_timeout_ms']}ms",
+        "work_mem": f"{budget['work_mem_kb']}kB",
+    }
+    # temp_file_limit меняет только суперпользователь
+    if settings.SANDBOX_BUDGET_TEMP_FILE_LIMIT:
+        values["temp_file_limit"] = f"{budget['temp_file_limit_kb']}kB"
+    return values
+
+
+def public_budget(budget: dict | None) -> dict | None:
+    """Бюджет для ответа /run: только действующие лимиты"""
+    if not budget or "statement_timeout_ms" not in budget:
+        return None
+    public = {
+        "statement_timeout_ms": budget["statement_timeout_ms"],
+        "work_mem_kb": budget["work_mem_kb"],
+    }
+    if settings.SANDBOX_BUDGET_TEMP_FILE_LIMIT:
+        public["temp_file_limit_kb"] = budget["temp_file_limit_kb"]
+    return public
+
+
+def _is_reference_error(error: Exception) -> bool:
+    """Ошибка в самом эталонном запросе, а не временный сбой БД"""
+    if not isinstance(error, DBAPIError) or error.connection_invalidated:
+        return False
+    sqlstate = getattr(error.orig, "sqlstate", None)
+    if not sqlstate:
+        return False
+    return (
+        sqlstate[:2] not in _TRANSIENT_SQLSTATE_CLASSES
+        and sqlstate != _LOCK_NOT_AVAILABLE
+    )
+
+
+async def build_budget(executor, reference_query: str | None) -> dict | None:
+    """
+    Профилирует эталонный запрос и считает бюджет. Если эталон не выполняется,
+    бюджет хранит ошибку, чтобы не профилировать его повторно. После
+    временных сбоев (очередь, таймаут, соединение) возвращает None.
+    """
+    if not settings.SANDBOX_BUDGET_ENABLED or not reference_query:
+        return None
+    try:
+        explains = await executor.profile_query(
+            reference_query, runs=settings.SANDBOX_BUDGET_PROFILE_RUNS
+        )
+    except Exception as e:
+        if not _is_reference_error(e):
+            return None
+        return {"version": BUDGET_VERSION, "error": str(e.orig)}
+    baseline = summarize_profiles([profile_from_explain(item) for item in explains])
+    return compute_budget(baseline)
+
+
+class BudgetProfiler:
+    """
+    Расчет бюджетов в фоне для задач и сцен, которым его не посчитала
+    админка: запрос студента не ждет профилирования и выполняется без
+    бюджета. На ключ идет один расчет, после попытки (успешной или нет)
+    ключ не профилируется retry_seconds - за это время сохраненный
+    бюджет доходит до каталога задач.
+    """
+
+    def __init__(self, retry_seconds: float):
+        self.retry_seconds = retry_seconds
+        self._running: dict[tuple, asyncio.Task] = {}
+        self._retry_at: dict[tuple, float] = {}
+        self.profiled = 0
+        self.failed = 0
+
+    def schedule(self, key: tuple, executor, reference_query: str | None, save) -> None:
+        """save(budget) - корутина, сохраняющая посчитанный бюджет"""
+        if not settings.SANDBOX_BUDGET_ENABLED or not reference_query:
+            return
+        if key in self._running or self._retry_at.get(key, 0.0) > time.monotonic():
+            return
+        task = asyncio.create_task(self._profile(key, executor, reference_query, save))
+        self._running[key] = task
+        task.add_done_callback(lambda _: self._running.pop(key, None))
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._running),
+            "profiled": self.profiled,
+            "failed": self.failed,
+        }
+
+    async def _profile(self, key: tuple, executor, reference_query: str, save) -> None:
+        try:
+            budget = await build_budget(executor, reference_query)
+            if budget is None:
+                self.failed += 1
+            else:
+                await save(budget)
+                self.profiled += 1
+        except Exception:
+            self.failed += 1
+        finally:
+            self._retry_at[key] = time.monotonic() + self.retry_seconds
+
+
+budget_profiler = BudgetProfiler(retry_seconds=settings.SANDBOX_BUDGET_RETRY_SECONDS)
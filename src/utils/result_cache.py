@@ -0,0 +1,129 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
+
+def estimate_result_size(result: dict) -> int:
+    """Приблизительный размер результата в байтах (по длине JSON)"""
+    return len(json.dumps(result, default=str, ensure_ascii=False))
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class QueryResultCache:
+    """
+    LRU-кэш результатов запросов с TTL и ограничением по объему.
+    Одинаковые запросы, пришедшие во время выполнения, ждут один общий вызов.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        max_bytes: int,
+        max_entry_bytes: int,
+        ttl_seconds: float,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[Hashable, tuple[float, int, dict]] = OrderedDict()
+        self._inflight: dict[Hashable, _Flight] = {}
+        self._bytes = 0
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_execute(
+        self, key: Hashable, factory: Callable[[], Awaitable[dict]]
+    ) -> dict:
+        cached = self._get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        flight = self._inflight.get(key)
+        if flight is None:
+            self.misses += 1
+            flight = _Flight(asyncio.ensure_future(factory()))
+            self._inflight[key] = flight
+            generation = self._generation
+            flight.task.add_done_callback(
+                lambda task: self._on_done(key, flight, generation, task)
+            )
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            # Запрос отменяем, только если его больше никто не ждет
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def invalidate(self) -> None:
+        """Сбрасывает кэш (например, после перезагрузки игровой базы)"""
+        self._generation += 1
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+    def _get(self, key: Hashable) -> dict | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, size, result = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return result
+
+    def _on_done(
+        self, key: Hashable, flight: _Flight, generation: int, task: asyncio.Future
+    ) -> None:
+        if self._inflight.get(key) is flight:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        if generation != self._generation:
+            return
+        self._put(key, task.result())
+
+    def _put(self, key: Hashable, result: dict) -> None:
+        size = estimate_result_size(result)
+        if size > self.max_entry_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, size, result)
+        self._bytes += size
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
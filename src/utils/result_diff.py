@@ -0,0 +1,286 @@
+import itertools
+import json
+import math
+from collections import Counter
+from dataclasses import dataclass
+
+ORDERED = "ordered"
+UNORDERED = "unordered"
+MODES = (ORDERED, UNORDERED)
+
+
+@dataclass(frozen=True)
+class ComparisonOptions:
+    """Настройки проверки задачи (Task.grading_options / "grading" в сцене квеста)"""
+
+    mode: str | None = None  # None - порядок важен, если он задан в эталоне
+    ignore_column_order: bool = False
+    tolerance: float | None = None
+
+    @classmethod
+    def from_dict(cls, options: dict | None) -> "ComparisonOptions":
+        options = options or {}
+        mode = options.get("mode")
+        if mode not in (None, *MODES):
+            raise ValueError(f"Неизвестный режим проверки: {mode}")
+        tolerance = options.get("tolerance")
+        return cls(
+            mode=mode,
+            ignore_column_order=bool(options.get("ignore_column_order", False)),
+            tolerance=float(tolerance) if tolerance else None,
+        )
+
+    @property
+    def is_exact(self) -> bool:
+        """Проверку можно свести к точному сравнению строк"""
+        return not self.ignore_column_order and self.tolerance is None
+
+
+# Сколько числовых столбцов участвуют в ключе при сравнении с допуском:
+# соседних корзин 3 ** N, остальные числа проверяются только попарно
+TOLERANCE_KEY_COLUMNS = 3
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _normalize(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _values_equal(left, right, tolerance: float | None) -> bool:
+    if tolerance and _is_number(left) and _is_number(right):
+        return abs(left - right) <= tolerance
+    return _normalize(left) == _normalize(right)
+
+
+class ResultComparator:
+    """
+    Сравнение результата студента с эталоном за O(n): в режиме без учета
+    порядка - мультимножество строк, в упорядоченном - попарно. С допуском
+    эталонные строки раскладываются по корзинам шириной tolerance, строка
+    студента ищется в своей и соседних корзинах и сверяется попарно.
+    Строки студента подаются порциями, в памяти хранятся только счетчики
+    и первые sample_size расхождений.
+    """
+
+    def __init__(
+        self,
+        expected_columns: list,
+        expected_rows: list,
+        options: ComparisonOptions,
+        ordered: bool,
+        sample_size: int,
+    ):
+        self.expected_columns = list(expected_columns)
+        self.expected_rows = expected_rows
+        self.options = options
+        self.ordered = ordered
+        self.sample_size = sample_size
+        self.row_count = 0
+        self.missing_count = 0
+        self.extra_count = 0
+        self.missing_rows: list = []
+        self.extra_rows: list = []
+        self._permutation: list[int] | None = None
+        self._remaining: Counter | None = None
+        # С допуском: ключ корзины -> индексы еще не найденных эталонных строк
+        self._buckets: dict | None = None
+
+    def check_columns(self, columns: list) -> bool:
+        columns = list(columns)
+        if columns == self.expected_columns:
+            return True
+        if not self.options.ignore_column_order:
+            return False
+        if sorted(columns) != sorted(self.expected_columns):
+            return False
+        positions: dict[str, list[int]] = {}
+        for index, name in enumerate(columns):
+            positions.setdefault(name, []).append(index)
+        self._permutation = [positions[name].pop(0) for name in self.expected_columns]
+        return True
+
+    def feed(self, rows: list) -> None:
+        if self._permutation is not None:
+            permutation = self._permutation
+            rows = [[row[index] for index in permutation] for row in rows]
+        if self.ordered:
+            self._feed_ordered(rows)
+        else:
+            self._feed_unordered(rows)
+
+    def finish(self) -> dict:
+        if self.ordered:
+            for row in self.expected_rows[self.row_count :]:
+                self._add_missing(row)
+        elif self.options.tolerance:
+            buckets = self._expected_buckets() if self._buckets is None else self._buckets
+            for index in sorted(itertools.chain.from_iterable(buckets.values())):
+                self._add_missing(self.expected_rows[index])
+        else:
+            remaining = (
+                self._expected_counter() if self._remaining is None else self._remaining
+            )
+            for row in self.expected_rows:
+                key = self._key(row)
+                if remaining[key] > 0:
+                    remaining[key] -= 1
+                    self._add_missing(row)
+        return {
+            "is_correct": self.missing_count == 0 and self.extra_count == 0,
+            "row_count": self.row_count,
+            "expected_row_count": len(self.expected_rows),
+            "missing_count": self.missing_count,
+            "extra_count": self.extra_count,
+            "missing_rows": self.missing_rows,
+            "extra_rows": self.extra_rows,
+        }
+
+    def _feed_ordered(self, rows: list) -> None:
+        expected_rows = self.expected_rows
+        tolerance = self.options.tolerance
+        for row in rows:
+            position = self.row_count
+            self.row_count += 1
+            if position >= len(expected_rows):
+                self._add_extra(row)
+                continue
+            expected = expected_rows[position]
+            if not tolerance:
+                if list(row) != list(expected):
+                    self._add_missing(expected)
+                    self._add_extra(row)
+                continue
+            if len(row) != len(expected) or not all(
+                _values_equal(left, right, tolerance)
+                for left, right in zip(row, expected)
+            ):
+                self._add_missing(expected)
+                self._add_extra(row)
+
+    def _feed_unordered(self, rows: list) -> None:
+        if self.options.tolerance:
+            self._feed_tolerant(rows)
+            return
+        if self._remaining is None:
+            self._remaining = self._expected_counter()
+        remaining = self._remaining
+        for row in rows:
+            self.row_count += 1
+            key = self._key(row)
+            if remaining[key] > 0:
+                remaining[key] -= 1
+            else:
+                self._add_extra(row)
+
+    def _feed_tolerant(self, rows: list) -> None:
+        if self._buckets is None:
+            self._buckets = self._expected_buckets()
+        buckets = self._buckets
+        tolerance = self.options.tolerance
+        for row in rows:
+            self.row_count += 1
+            if not self._take_match(row, buckets, tolerance):
+                self._add_extra(row)
+
+    def _take_match(self, row, buckets: dict, tolerance: float) -> bool:
+        for key in self._neighbour_keys(row):
+            candidates = buckets.get(key)
+            if not candidates:
+                continue
+            for position, index in enumerate(candidates):
+                expected = self.expected_rows[index]
+                if len(expected) == len(row) and all(
+                    _values_equal(left, right, tolerance)
+                    for left, right in zip(row, expected)
+                ):
+                    candidates.pop(position)
+                    return True
+        return False
+
+    def _expected_counter(self) -> Counter:
+        return Counter(self._key(row) for row in self.expected_rows)
+
+    def _expected_buckets(self) -> dict:
+        buckets: dict = {}
+        for index, row in enumerate(self.expected_rows):
+            buckets.setdefault(self._bucket_key(row), []).append(index)
+        return buckets
+
+    def _key(self, row):
+        """
+        Ключ мультимножества - сама строка (hash(1) == hash(1.0) и 1 == 1.0),
+        для непрошедших хэширование ячеек - ее каноничный JSON
+        """
+        normalized = tuple(row)
+        try:
+            hash(normalized)
+        except TypeError:
+            # Массивы и json в ячейках
+            return json.dumps(normalized, sort_keys=True, default=str)
+        return normalized
+
+    def _bucket_key(self, row, shifts: tuple = ()):
+        """
+        Ключ корзины: первые TOLERANCE_KEY_COLUMNS чисел заменяются номером
+        корзины floor(value / tolerance) (со сдвигом shifts), остальные числа
+        в ключ не входят, прочие значения - как есть
+        """
+        tolerance = self.options.tolerance
+        key = []
+        numbers = 0
+        for value in row:
+            if not _is_number(value):
+                key.append(value)
+            elif numbers < TOLERANCE_KEY_COLUMNS:
+                shift = shifts[numbers] if shifts else 0
+                key.append(("n", math.floor(value / tolerance) + shift))
+                numbers += 1
+            else:
+                key.append(("n",))
+        return self._key(key)
+
+    def _neighbour_keys(self, row):
+        # Значения в пределах tolerance лежат в той же или соседней корзине
+        numbers = min(sum(1 for value in row if _is_number(value)), TOLERANCE_KEY_COLUMNS)
+        for shifts in itertools.product((0, -1, 1), repeat=numbers):
+            yield self._bucket_key(row, shifts)
+
+    def _add_missing(self, row) -> None:
+        self.missing_count += 1
+        if len(self.missing_rows) < self.sample_size:
+            self.missing_rows.append(list(row))
+
+    def _add_extra(self, row) -> None:
+        self.extra_count += 1
+        if len(self.extra_rows) < self.sample_size:
+            self.extra_rows.append(list(row))
+
+
+def compare_results(
+    expected: dict,
+    actual: dict,
+    options: ComparisonOptions = ComparisonOptions(),
+    ordered: bool = True,
+    sample_size: int = 5,
+) -> dict:
+    """Сравнивает два готовых результата вида {"columns": [...], "data": [...]}"""
+    comparator = ResultComparator(
+        expected.get("columns", []),
+        expected.get("data", []),
+        options,
+        ordered=ordered,
+        sample_size=sample_size,
+    )
+    if not comparator.check_columns(actual.get("columns", [])):
+        return {
+            "is_correct": False,
+            "columns": actual.get("columns", []),
+            "expected_columns": expected.get("columns", []),
+        }
+    comparator.feed(actual.get("data", []))
+    return comparator.finish()
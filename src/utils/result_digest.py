@@ -0,0 +1,73 @@
+import hashlib
+import json
+
+DIGEST_VERSION = 1
+_UNORDERED_MODULUS = 1 << 128
+
+
+def _normalize_value(value):
+    # 1 == 1.0 при прежнем сравнении списков, поэтому целые float приводим к int
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _row_hash(row) -> bytes:
+    canonical = json.dumps(
+        [_normalize_value(value) for value in row],
+        ensure_ascii=False,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).digest()
+
+
+class DigestBuilder:
+    """Потоково считает хэши результата: с учетом порядка строк и без него"""
+
+    def __init__(self):
+        self.row_count = 0
+        self._ordered = hashlib.sha256()
+        self._unordered = 0
+
+    def add(self, row) -> None:
+        row_hash = _row_hash(row)
+        self._ordered.update(row_hash)
+        # Сумма хэшей строк не зависит от порядка и учитывает дубликаты
+        self._unordered = (
+            self._unordered + int.from_bytes(row_hash, "big")
+        ) % _UNORDERED_MODULUS
+        self.row_count += 1
+
+    def add_many(self, rows) -> None:
+        for row in rows:
+            self.add(row)
+
+    @property
+    def ordered_hash(self) -> str:
+        return self._ordered.hexdigest()
+
+    @property
+    def unordered_hash(self) -> str:
+        return format(self._unordered, "032x")
+
+
+def compute_digest(columns: list, rows: list) -> dict:
+    """Отпечаток эталонного результата, хранится в Task.expected_digest"""
+    builder = DigestBuilder()
+    builder.add_many(rows)
+    return {
+        "version": DIGEST_VERSION,
+        "columns": list(columns),
+        "row_count": builder.row_count,
+        "ordered_hash": builder.ordered_hash,
+        "unordered_hash": builder.unordered_hash,
+    }
+
+
+def digest_from_expected_result(expected_result) -> dict | None:
+    if not isinstance(expected_result, dict) or "data" not in expected_result:
+        return None
+    return compute_digest(
+        expected_result.get("columns", []), expected_result.get("data", [])
+    )
@@ -0,0 +1,53 @@
+import csv
+import io
+import json
+
+from fastapi.responses import StreamingResponse
+
+from src.utils.sql_executor import ResultStream
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+
+def _json_line(value) -> str:
+    return json.dumps(value, default=str, ensure_ascii=False) + "\n"
+
+
+async def _ndjson_lines(stream: ResultStream):
+    yield _json_line({"columns": stream.columns})
+    async for chunk in stream.chunks():
+        yield "".join(_json_line(row) for row in chunk)
+    yield _json_line({"row_count": stream.row_count, "truncated": stream.truncated})
+
+
+async def _csv_lines(stream: ResultStream):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(stream.columns)
+    async for chunk in stream.chunks():
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+async def _closing(stream: ResultStream, lines):
+    try:
+        async for line in lines:
+            yield line
+    finally:
+        await stream.aclose()
+
+
+def export_response(stream: ResultStream, fmt: str, filename: str) -> StreamingResponse:
+    """Отдает результат запроса клиенту потоком в формате NDJSON или CSV"""
+    lines = _csv_lines(stream) if fmt == "csv" else _ndjson_lines(stream)
+    return StreamingResponse(
+        _closing(stream, lines),
+        media_type=EXPORT_MEDIA_TYPES[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}.{fmt}"'},
+    )
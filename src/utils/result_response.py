@@ -0,0 +1,116 @@
+import asyncio
+import gzip
+from datetime import date, time, timedelta
+from decimal import Decimal
+
+import msgpack
+import orjson
+from fastapi import Request, Response
+
+from config import settings
+from src.schemas.task import SQLResponse
+
+MSGPACK_MEDIA_TYPE = "application/vnd.msgpack"
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack", "application/msgpack")
+# Результат, в котором data - список колонок (SQLExecutor.execute_sql(columnar=True))
+COLUMNS_LAYOUT = "columns"
+
+
+def response_defaults(model) -> dict:
+    """Необязательные поля модели ответа, чтобы ключи не зависели от пути выполнения"""
+    return {
+        name: field.default
+        for name, field in model.model_fields.items()
+        if not field.is_required()
+    }
+
+
+_DEFAULTS = response_defaults(SQLResponse)
+
+
+def _default(value):
+    """Типы, которых нет в orjson; вывод совпадает с jsonable_encoder FastAPI"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    return str(value)
+
+
+def dumps_result(result: dict) -> bytes:
+    return orjson.dumps(result, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _msgpack_default(value):
+    """Значения ячеек как в JSON-ответе: даты строками ISO, Decimal числом"""
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return _default(value)
+
+
+def dumps_columnar(result: dict) -> bytes:
+    """
+    msgpack по колонкам: data - список колонок, а не строк. Имена колонок
+    не повторяются в каждой строке, однотипные значения идут подряд.
+    Колонки обычно собраны исполнителем при преобразовании строк;
+    построчный результат (страница спула, DDL в копии БД) транспонируется.
+    """
+    if result.get("layout") == COLUMNS_LAYOUT:
+        body = result
+    else:
+        data = result["data"]
+        if data:
+            columns = [list(column) for column in zip(*data)]
+        else:
+            columns = [[] for _ in result["columns"]]
+        body = {**result, "layout": COLUMNS_LAYOUT, "data": columns}
+    return msgpack.packb(body, default=_msgpack_default, datetime=False)
+
+
+def _accepts_gzip(request: Request) -> bool:
+    return "gzip" in request.headers.get("accept-encoding", "").lower()
+
+
+def _wants_msgpack(request: Request) -> bool:
+    accept = request.headers.get("accept", "").lower()
+    return any(media_type in accept for media_type in MSGPACK_MEDIA_TYPES)
+
+
+def wants_columnar(request: Request, page_size: int | None) -> bool:
+    """
+    Собирать ли результат сразу по колонкам. Постраничный результат
+    остается построчным: спул хранит и отдает строки.
+    """
+    return page_size is None and _wants_msgpack(request)
+
+
+async def sql_response(
+    result, request: Request, defaults: dict = _DEFAULTS
+) -> Response:
+    """
+    Ответ /run в обход response_model: pydantic не проверяет каждую ячейку
+    data, JSON собирается orjson. Формат тот же, что у SQLResponse; для
+    другой модели ответа (квесты) defaults строится через response_defaults.
+    С Accept: application/vnd.msgpack отдаем msgpack по колонкам.
+    Большие ответы сжимаются gzip, если клиент его принимает.
+    """
+    if isinstance(result, Response):
+        # 202 с job_id из пула процессов
+        return result
+    result = {**defaults, **result}
+    if _wants_msgpack(request):
+        body = dumps_columnar(result)
+        media_type = MSGPACK_MEDIA_TYPE
+    else:
+        body = dumps_result(result)
+        media_type = "application/json"
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    min_bytes = settings.SANDBOX_RESPONSE_GZIP_MIN_BYTES
+    if min_bytes and len(body) >= min_bytes and _accepts_gzip(request):
+        body = await asyncio.to_thread(
+            gzip.compress, body, settings.SANDBOX_RESPONSE_GZIP_LEVEL
+        )
+        headers["Content-Encoding"] = "gzip"
+    return Response(content=body, media_type=media_type, headers=headers)
@@ -0,0 +1,262 @@
+import asyncio
+import os
+import re
+import secrets
+import socket
+import tempfile
+import time
+from array import array
+from collections import OrderedDict
+
+import orjson
+
+from config import settings
+from src.utils.result_cache import estimate_result_size
+from src.utils.result_response import dumps_result
+
+# Поля результата, которые повторяются в ответе на каждую страницу
+_META_FIELDS = (
+    "truncated",
+    "total_row_count",
+    "total_row_count_at_least",
+    "plan_estimate",
+    "resource_budget",
+)
+
+
+def result_limits(page_size: int | None) -> dict:
+    """
+    Ограничения результата для /run: постраничный результат читается из
+    потока до границ спула, а не до SANDBOX_MAX_ROWS
+    """
+    if page_size is None:
+        return {}
+    return {
+        "max_rows": settings.SANDBOX_SPOOL_MAX_ROWS,
+        "max_bytes": settings.SANDBOX_SPOOL_MAX_RESULT_BYTES,
+    }
+
+
+class SpooledResult:
+    """Результат /run, из которого отдаются страницы: строки в памяти или в файле"""
+
+    def __init__(
+        self, cursor: str, user_id: int, columns: list, meta: dict, row_count: int
+    ):
+        self.cursor = cursor
+        self.user_id = user_id
+        self.columns = columns
+        self.meta = meta
+        self.row_count = row_count
+        self.size = 0
+        self.expires_at = 0.0
+        self.rows: list | None = None
+        # Временный файл: строка результата на строку файла и смещения строк
+        self.path: str | None = None
+        self.offsets: array | None = None
+
+    @property
+    def on_disk(self) -> bool:
+        return self.path is not None
+
+    def spill(self, rows: list, directory: str | None) -> None:
+        """Пишет строки в файл JSON Lines; вызывается в отдельном потоке"""
+        fd, path = tempfile.mkstemp(prefix="sql-spool-", suffix=".jsonl", dir=directory)
+        offsets = array("q", [0])
+        with os.fdopen(fd, "wb") as file:
+            for row in rows:
+                line = dumps_result(row) + b"\n"
+                file.write(line)
+                offsets.append(offsets[-1] + len(line))
+        self.path = path
+        self.offsets = offsets
+        self.size = offsets[-1]
+
+    def read(self, offset: int, limit: int) -> list:
+        end = min(offset + limit, self.row_count)
+        if offset >= end:
+            return []
+        if self.rows is not None:
+            return self.rows[offset:end]
+        with open(self.path, "rb") as file:
+            file.seek(self.offsets[offset])
+            chunk = file.read(self.offsets[end] - self.offsets[offset])
+        return [orjson.loads(line) for line in chunk.splitlines()]
+
+    def discard(self) -> None:
+        self.rows = None
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def page(self, offset: int, rows: list) -> dict:
+        next_offset = offset + len(rows)
+        return {
+            "columns": self.columns,
+            "data": rows,
+            "row_count": len(rows),
+            **self.meta,
+            "cursor": self.cursor if next_offset < self.row_count else None,
+            "offset": offset,
+            "next_offset": next_offset if next_offset < self.row_count else None,
+            "spooled_row_count": self.row_count,
+        }
+
+
+class ResultSpool:
+    """
+    Короткоживущее хранилище результатов /run для постраничного просмотра:
+    следующая страница берется из спула, а не повторным выполнением SQL.
+    Общий LRU с бюджетом байт в памяти и на диске, TTL и лимит курсоров
+    на пользователя. Крупные результаты сбрасываются во временный файл.
+
+    Спул живет в памяти процесса API. Курсор начинается с идентификатора
+    экземпляра ("{instance}.{token}"): при нескольких экземплярах балансировщик
+    направляет /api/sandbox/results/{cursor} по этому префиксу, курсор
+    другого экземпляра отклоняется с 421, а не теряется как устаревший.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float,
+        max_memory_bytes: int,
+        max_disk_bytes: int,
+        memory_entry_bytes: int,
+        max_user_entries: int,
+        directory: str | None = None,
+        instance_id: str | None = None,
+    ):
+        instance = instance_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.instance = re.sub(r"[^A-Za-z0-9_-]", "", instance)
+        self.ttl_seconds = ttl_seconds
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_entry_bytes = memory_entry_bytes
+        self.max_user_entries = max_user_entries
+        self.directory = directory
+        self._entries: OrderedDict[str, SpooledResult] = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0
+        self.pages = 0
+        self.evicted = 0
+
+    async def paginate(self, result, user_id: int, page_size: int | None):
+        """Первая страница результата и курсор на остальные"""
+        if not isinstance(result, dict) or page_size is None:
+            return result
+        data = result["data"]
+        if len(data) <= page_size:
+            return {**result, "offset": 0, "spooled_row_count": len(data)}
+
+        self._sweep()
+        entry = SpooledResult(
+            f"{self.instance}.{secrets.token_urlsafe(16)}",
+            user_id,
+            result["columns"],
+            {field: result.get(field) for field in _META_FIELDS},
+            len(data),
+        )
+        stats = result.get("stats") or {}
+        size = stats.get("estimated_bytes") or estimate_result_size(result)
+        if size > self.memory_entry_bytes:
+            await asyncio.to_thread(entry.spill, data, self.directory)
+            self._disk_bytes += entry.size
+        else:
+            entry.rows = data
+            entry.size = size
+            self._memory_bytes += entry.size
+        entry.expires_at = time.monotonic() + self.ttl_seconds
+        self._entries[entry.cursor] = entry
+        self._evict(user_id)
+
+        page = entry.page(0, data[:page_size])
+        return {**page, "stats": result.get("stats")}
+
+    def is_local(self, cursor: str) -> bool:
+        """Курсор выдан этим экземпляром API"""
+        return cursor.partition(".")[0] == self.instance
+
+    async def get_page(
+        self, cursor: str, user_id: int, offset: int, limit: int
+    ) -> dict | None:
+        self._sweep()
+        entry = self._entries.get(cursor)
+        if entry is None or entry.user_id != user_id:
+            return None
+        self._entries.move_to_end(cursor)
+        entry.expires_at = time.monotonic() + self.ttl_seconds
+        if entry.on_disk:
+            rows = await asyncio.to_thread(entry.read, offset, limit)
+        else:
+            rows = entry.read(offset, limit)
+        self.pages += 1
+        return entry.page(offset, rows)
+
+    def release(self, cursor: str, user_id: int) -> bool:
+        entry = self._entries.get(cursor)
+        if entry is None or entry.user_id != user_id:
+            return False
+        self._remove(cursor)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "on_disk": sum(1 for entry in self._entries.values() if entry.on_disk),
+            "memory_bytes": self._memory_bytes,
+            "disk_bytes": self._disk_bytes,
+            "pages": self.pages,
+            "evicted": self.evicted,
+        }
+
+    def _evict(self, user_id: int) -> None:
+        user_cursors = [
+            cursor for cursor, entry in self._entries.items() if entry.user_id == user_id
+        ]
+        excess = len(user_cursors) - self.max_user_entries
+        for cursor in user_cursors[: max(excess, 0)]:
+            self._remove(cursor)
+            self.evicted += 1
+        # Самые давние по использованию удаляются первыми
+        for cursor in list(self._entries):
+            if (
+                self._memory_bytes <= self.max_memory_bytes
+                and self._disk_bytes <= self.max_disk_bytes
+            ):
+                break
+            entry = self._entries[cursor]
+            if entry.on_disk and self._disk_bytes > self.max_disk_bytes:
+                self._remove(cursor)
+                self.evicted += 1
+            elif not entry.on_disk and self._memory_bytes > self.max_memory_bytes:
+                self._remove(cursor)
+                self.evicted += 1
+
+    def _sweep(self) -> None:
+        now = time.monotonic()
+        expired = [
+            cursor for cursor, entry in self._entries.items() if entry.expires_at < now
+        ]
+        for cursor in expired:
+            self._remove(cursor)
+
+    def _remove(self, cursor: str) -> None:
+        entry = self._entries.pop(cursor)
+        if entry.on_disk:
+            self._disk_bytes -= entry.size
+        else:
+            self._memory_bytes -= entry.size
+        entry.discard()
+
+
+result_spool = ResultSpool(
+    ttl_seconds=settings.SANDBOX_SPOOL_TTL_SECONDS,
+    max_memory_bytes=settings.SANDBOX_SPOOL_MAX_MEMORY_BYTES,
+    max_disk_bytes=settings.SANDBOX_SPOOL_MAX_DISK_BYTES,
+    memory_entry_bytes=settings.SANDBOX_SPOOL_MEMORY_ENTRY_BYTES,
+    max_user_entries=settings.SANDBOX_SPOOL_USER_ENTRIES,
+    directory=settings.SANDBOX_SPOOL_DIR,
+    instance_id=settings.SANDBOX_SPOOL_INSTANCE_ID,
+)
@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+from operator import methodcaller
+
+# OID типов PostgreSQL, см. pg_type
+DATE_OIDS = frozenset({1082, 1114, 1184})  # date, timestamp, timestamptz
+NUMERIC_OIDS = frozenset({1700})  # numeric
+# Типы, значения которых asyncpg уже отдает в пригодном для JSON виде
+PASSTHROUGH_OIDS = frozenset(
+    {
+        16,  # bool
+        18,  # char
+        19,  # name
+        20,  # int8
+        21,  # int2
+        23,  # int4
+        25,  # text
+        26,  # oid
+        114,  # json
+        700,  # float4
+        701,  # float8
+        705,  # unknown
+        1042,  # bpchar
+        1043,  # varchar
+        1083,  # time
+        1186,  # interval
+        1266,  # timetz
+        2950,  # uuid
+        3802,  # jsonb
+    }
+)
+
+_to_isoformat = methodcaller("isoformat")
+
+
+def _convert_value(value):
+    """Универсальное преобразование для типов, которых нет в плане"""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def _converter_for(oid: int):
+    if oid in PASSTHROUGH_OIDS:
+        return None
+    if oid in DATE_OIDS:
+        return _to_isoformat
+    if oid in NUMERIC_OIDS:
+        return float
+    return _convert_value
+
+
+class RowPlan:
+    """План преобразования строк результата, построенный по OID колонок"""
+
+    __slots__ = ("oids", "converters")
+
+    def __init__(self, oids: tuple):
+        self.oids = oids
+        self.converters = tuple(
+            (index, converter)
+            for index, oid in enumerate(oids)
+            if (converter := _converter_for(oid)) is not None
+        )
+
+    def convert(self, row) -> list:
+        values = list(row)
+        for index, converter in self.converters:
+            value = values[index]
+            if value is not None:
+                values[index] = converter(value)
+        return values
+
+
+class RowPlanCache:
+    """LRU-кэш планов преобразования по отпечатку запроса"""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._plans: OrderedDict[str, RowPlan] = OrderedDict()
+
+    def get_plan(self, fingerprint: str | None, description) -> RowPlan:
+        oids = tuple(column[1] for column in description or ())
+        if fingerprint is None:
+            return RowPlan(oids)
+        plan = self._plans.get(fingerprint)
+        if plan is not None and plan.oids == oids:
+            self._plans.move_to_end(fingerprint)
+            return plan
+        plan = RowPlan(oids)
+        self._plans[fingerprint] = plan
+        if len(self._plans) > self.max_entries:
+            self._plans.popitem(last=False)
+        return plan
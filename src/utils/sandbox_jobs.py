@@ -0,0 +1,393 @@
+import asyncio
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+import uuid
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from config import settings
+from src.utils.execution_scheduler import ExecutionScheduler, sandbox_scheduler
+from src.utils.grading import grade_submission, is_schema_task
+from src.utils.sql_executor import SQLExecutor
+from src.utils.task_catalog import task_catalog
+
+INLINE = "inline"  # запросы выполняются в event loop процесса API
+PROCESS = "process"  # запросы и проверка уходят в пул процессов
+
+# Состояния задания
+QUEUED = "queued"
+DONE = "done"
+FAILED = "failed"
+
+# Сообщения процессу-исполнителю
+JOB = "job"
+CANCEL = "cancel"
+INVALIDATE = "invalidate"
+STOP = "stop"
+WORKER_DIED = "Исполнитель запросов завершился с ошибкой"
+
+# SQLExecutor процесса-исполнителя, по одному на БД
+_worker_executors: dict[str, SQLExecutor] = {}
+
+
+def _worker_executor(name: str) -> SQLExecutor:
+    executor = _worker_executors.get(name)
+    if executor is None:
+        urls = {
+            "game": [settings.GAME_DATABASE_URL, *settings.GAME_REPLICA_URLS],
+            "quest": [settings.QUEST_DATABASE_URL, *settings.QUEST_REPLICA_URLS],
+        }
+        # Копии БД для DDL выдает только процесс API: проверка DDL идет там
+        executor = SQLExecutor(
+            urls[name],
+            name=name,
+            dml_url=settings.QUEST_DML_DATABASE_URL if name == "quest" else None,
+        )
+        _worker_executors[name] = executor
+    return executor
+
+
+async def _dispatch(kind: str, executor_name: str, kwargs: dict) -> dict:
+    executor = _worker_executor(executor_name)
+    if kind == "run":
+        return await executor.execute_sql(**kwargs)
+    if kind == "dml":
+        return await executor.execute_dml(**kwargs)
+    return await grade_submission(executor, **kwargs)
+
+
+def _invalidate_caches() -> None:
+    for executor in _worker_executors.values():
+        executor.invalidate_cache()
+
+
+async def _run_job(kind: str, executor_name: str, kwargs: dict) -> bytes:
+    """Результат задания в pickle: HTTPException не переживает pickle"""
+    try:
+        outcome = DONE, await _dispatch(kind, executor_name, kwargs)
+    except HTTPException as e:
+        outcome = FAILED, (e.status_code, e.detail, e.headers)
+    except Exception as e:
+        outcome = FAILED, (500, f"Internal server error: {str(e)}", None)
+    try:
+        return pickle.dumps(outcome)
+    except Exception as e:
+        return pickle.dumps((FAILED, (500, f"Internal server error: {str(e)}", None)))
+
+
+def _worker_main(jobs: multiprocessing.Queue, results: multiprocessing.Queue) -> None:
+    """Точка входа процесса-исполнителя"""
+    asyncio.run(_serve(jobs, results))
+
+
+async def _serve(jobs: multiprocessing.Queue, results: multiprocessing.Queue) -> None:
+    """
+    Event loop исполнителя: задания из очереди выполняются параллельно,
+    каждое в своей asyncio-задаче, число одновременных запросов к БД
+    ограничивает планировщик процесса API. Очередь читает отдельный поток.
+    """
+    loop = asyncio.get_running_loop()
+    running: dict[str, asyncio.Task] = {}
+    stopped = loop.create_future()
+
+    def finish(job_id: str, task: asyncio.Task) -> None:
+        running.pop(job_id, None)
+        if not task.cancelled():
+            results.put((job_id, task.result()))
+
+    def start(job_id: str, kind: str, executor_name: str, kwargs: dict) -> None:
+        task = loop.create_task(_run_job(kind, executor_name, kwargs))
+        running[job_id] = task
+        task.add_done_callback(lambda done: finish(job_id, done))
+
+    def cancel(job_id: str) -> None:
+        # asyncpg при отмене ожидания шлет серверу запрос отмены запроса
+        task = running.get(job_id)
+        if task is not None:
+            task.cancel()
+
+    def receive() -> None:
+        while True:
+            message = jobs.get()
+            if message[0] == STOP:
+                loop.call_soon_threadsafe(stopped.set_result, None)
+                return
+            if message[0] == CANCEL:
+                loop.call_soon_threadsafe(cancel, message[1])
+            elif message[0] == INVALIDATE:
+                loop.call_soon_threadsafe(_invalidate_caches)
+            else:
+                loop.call_soon_threadsafe(start, *message[1:])
+
+    threading.Thread(target=receive, daemon=True).start()
+    await stopped
+
+
+class Worker:
+    """Процесс-исполнитель в процессе API: своя очередь заданий"""
+
+    def __init__(self, context, results: multiprocessing.Queue):
+        self.jobs = context.Queue()
+        self.outstanding: set[str] = set()
+        # spawn: дочерний процесс не наследует соединения пулов API
+        self.process = context.Process(
+            target=_worker_main, args=(self.jobs, results), daemon=True
+        )
+        self.process.start()
+
+
+class Job:
+    def __init__(self, job_id: str, user_id: int, kind: str, task: asyncio.Task):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.kind = kind
+        self.task = task
+        self.created_at = time.monotonic()
+        self.finished_at: float | None = None
+
+    @property
+    def status(self) -> str:
+        if not self.task.done():
+            return QUEUED
+        if self.task.cancelled():
+            return FAILED
+        return self.task.result()[0]
+
+    def describe(self) -> dict:
+        description = {"job_id": self.job_id, "status": self.status}
+        if self.status == DONE:
+            description["result"] = self.task.result()[1]
+        elif self.status == FAILED:
+            status_code, detail, _ = self._error()
+            description["error"] = {"status_code": status_code, "detail": detail}
+        return description
+
+    def outcome(self) -> dict:
+        """Результат выполненного задания или HTTPException из исполнителя"""
+        if self.status == DONE:
+            return self.task.result()[1]
+        status_code, detail, headers = self._error()
+        raise HTTPException(status_code=status_code, detail=detail, headers=headers)
+
+    def _error(self) -> tuple:
+        if self.task.cancelled():
+            return 500, "Задание отменено", None
+        return self.task.result()[1]
+
+
+class SandboxJobs:
+    """
+    Выполнение запросов песочницы и проверки ответов. В режиме "process"
+    работа уходит в процессы-исполнители (задание - тому, у кого меньше
+    выполняющихся), у каждого задания есть id: ответ ждем wait_seconds,
+    дальше клиент опрашивает GET /api/sandbox/jobs/{job_id}. Допуск
+    по-прежнему через планировщик. Результаты из общей очереди читает
+    отдельный поток и передает в event loop API.
+    """
+
+    def __init__(
+        self,
+        mode: str,
+        processes: int,
+        wait_seconds: float,
+        ttl_seconds: float,
+        scheduler: ExecutionScheduler = sandbox_scheduler,
+    ):
+        if mode not in (INLINE, PROCESS):
+            raise ValueError(f"Неизвестный режим выполнения: {mode}")
+        self.mode = mode
+        self.processes = processes
+        self.wait_seconds = wait_seconds
+        self.ttl_seconds = ttl_seconds
+        self.scheduler = scheduler
+        self._context = multiprocessing.get_context("spawn")
+        self._workers: list[Worker] | None = None
+        self._results: multiprocessing.Queue | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        # job_id -> (future результата, исполнитель)
+        self._pending: dict[str, tuple[asyncio.Future, Worker]] = {}
+        self._jobs: dict[str, Job] = {}
+
+    async def run_sql(
+        self, executor: SQLExecutor, sql_query: str, user_id: int = None, **kwargs
+    ):
+        """Результат запроса либо 202 с job_id, если он не уложился в wait_seconds"""
+        if self.mode == INLINE:
+            return await executor.execute_sql(sql_query, user_id=user_id, **kwargs)
+        job = self.submit("run", executor, user_id, {"sql_query": sql_query, **kwargs})
+        if not await self._wait(job, timeout=self.wait_seconds):
+            return JSONResponse(status_code=202, content=jsonable_encoder(job.describe()))
+        return job.outcome()
+
+    async def grade(
+        self, executor: SQLExecutor, sql_query: str, user_id: int = None, **kwargs
+    ) -> dict:
+        """Проверка ответа; начисление баллов остается в API, поэтому ждем всегда"""
+        # DDL проверяется в копии БД из пула процесса API
+        inline = self.mode == INLINE or is_schema_task(kwargs.get("reference_query"))
+        if inline:
+            return await grade_submission(executor, sql_query, user_id=user_id, **kwargs)
+        job = self.submit("grade", executor, user_id, {"sql_query": sql_query, **kwargs})
+        await self._wait(job)
+        return job.outcome()
+
+    async def run_dml(
+        self, executor: SQLExecutor, sql_query: str, user_id: int = None, **kwargs
+    ) -> dict:
+        """Изменяющий запрос с откатом; по результату выбирается ветка, ждем всегда"""
+        if self.mode == INLINE:
+            return await executor.execute_dml(sql_query, user_id=user_id, **kwargs)
+        job = self.submit("dml", executor, user_id, {"sql_query": sql_query, **kwargs})
+        await self._wait(job)
+        return job.outcome()
+
+    def submit(
+        self, kind: str, executor: SQLExecutor, user_id: int, kwargs: dict
+    ) -> Job:
+        self._sweep()
+        kwargs = {**kwargs, "user_id": user_id}
+        job_id = uuid.uuid4().hex
+        task = asyncio.create_task(
+            self._execute(job_id, kind, executor.name, user_id, kwargs)
+        )
+        job = Job(job_id, user_id, kind, task)
+        task.add_done_callback(lambda _: setattr(job, "finished_at", time.monotonic()))
+        self._jobs[job.job_id] = job
+        return job
+
+    async def _wait(self, job: Job, timeout: float | None = None) -> bool:
+        """
+        Ждет задание. Если ждущего отменили (новый запуск, отключение
+        клиента), отменяется и задание: исполнитель прерывает запрос в БД,
+        слот планировщика освобождается.
+        """
+        try:
+            done, _ = await asyncio.wait({job.task}, timeout=timeout)
+        except asyncio.CancelledError:
+            job.task.cancel()
+            raise
+        return bool(done)
+
+    def get(self, job_id: str, user_id: int) -> Job | None:
+        job = self._jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "processes": self.processes if self.mode == PROCESS else 0,
+            "worker_jobs": [len(worker.outstanding) for worker in self._workers or ()],
+            "jobs": len(self._jobs),
+            "pending": sum(1 for job in self._jobs.values() if not job.task.done()),
+        }
+
+    async def _execute(
+        self, job_id: str, kind: str, executor_name: str, user_id: int, kwargs: dict
+    ) -> tuple:
+        try:
+            async with self.scheduler.slot(user_id):
+                return await self._send(job_id, kind, executor_name, kwargs)
+        except HTTPException as e:
+            return FAILED, (e.status_code, e.detail, e.headers)
+        except Exception as e:
+            return FAILED, (500, f"Internal server error: {str(e)}", None)
+
+    async def _send(
+        self, job_id: str, kind: str, executor_name: str, kwargs: dict
+    ) -> tuple:
+        workers = self._get_workers()
+        worker = min(workers, key=lambda candidate: len(candidate.outstanding))
+        future = self._loop.create_future()
+        self._pending[job_id] = (future, worker)
+        worker.outstanding.add(job_id)
+        worker.jobs.put((JOB, job_id, kind, executor_name, kwargs))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if self._pending.pop(job_id, None) is not None:
+                worker.outstanding.discard(job_id)
+                worker.jobs.put((CANCEL, job_id))
+            raise
+
+    def invalidate_caches(self) -> None:
+        """Кэши результатов живут в исполнителях: сбрасываем их сообщением"""
+        for worker in self._workers or ():
+            worker.jobs.put((INVALIDATE,))
+
+    def close(self) -> None:
+        """Останавливает исполнители при остановке API"""
+        for worker in self._workers or ():
+            worker.jobs.put((STOP,))
+        for worker in self._workers or ():
+            worker.process.join(timeout=5)
+        self._workers = None
+
+    def _get_workers(self) -> list[Worker]:
+        if self._workers is None:
+            self._loop = asyncio.get_running_loop()
+            self._results = self._context.Queue()
+            self._workers = [
+                Worker(self._context, self._results) for _ in range(self.processes)
+            ]
+            threading.Thread(target=self._read_results, daemon=True).start()
+        return self._workers
+
+    def _read_results(self) -> None:
+        """Поток чтения результатов; раз в секунду - проверка исполнителей"""
+        checked_at = time.monotonic()
+        while True:
+            try:
+                job_id, outcome = self._results.get(timeout=1.0)
+                self._loop.call_soon_threadsafe(self._deliver, job_id, outcome)
+            except queue.Empty:
+                pass
+            if time.monotonic() - checked_at >= 1.0:
+                checked_at = time.monotonic()
+                self._loop.call_soon_threadsafe(self._check_workers)
+
+    def _deliver(self, job_id: str, outcome: bytes) -> None:
+        pending = self._pending.pop(job_id, None)
+        if pending is None:
+            return
+        future, worker = pending
+        worker.outstanding.discard(job_id)
+        if not future.done():
+            future.set_result(pickle.loads(outcome))
+
+    def _check_workers(self) -> None:
+        """Задания упавшего исполнителя завершаются ошибкой, процесс перезапускается"""
+        for index, worker in enumerate(self._workers or ()):
+            if worker.process.is_alive():
+                continue
+            for job_id in worker.outstanding:
+                future, _ = self._pending.pop(job_id)
+                if not future.done():
+                    future.set_result((FAILED, (500, WORKER_DIED, None)))
+            self._workers[index] = Worker(self._context, self._results)
+
+    def _sweep(self) -> None:
+        """Забываем выполненные задания старше ttl_seconds"""
+        deadline = time.monotonic() - self.ttl_seconds
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished_at is not None and job.finished_at < deadline
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+sandbox_jobs = SandboxJobs(
+    mode=settings.SANDBOX_EXECUTION_MODE,
+    processes=settings.SANDBOX_WORKER_PROCESSES,
+    wait_seconds=settings.SANDBOX_JOB_WAIT_SECONDS,
+    ttl_seconds=settings.SANDBOX_JOB_TTL_SECONDS,
+)
+task_catalog.on_data_changed(sandbox_jobs.invalidate_caches)
@@ -0,0 +1,64 @@
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from database import Base, engine
+from src.models.quest import QuestSceneBudget
+
+# Таблицы users_db приходят из резервной копии, новые таблицы и столбцы
+# добавляются здесь: при старте API и админки или командой make migrate.
+# Создается только отсутствующее, поэтому повторный запуск ничего не блокирует.
+TABLES = (QuestSceneBudget.__table__,)
+COLUMNS = (
+    ("tasks", "expected_digest", "JSONB"),
+    ("tasks", "grading_options", "JSONB"),
+    ("tasks", "query_limits", "JSONB"),
+    ("tasks", "resource_budget", "JSONB"),
+)
+
+# Несколько процессов стартуют одновременно - обновление выполняет один
+_UPGRADE_LOCK_KEY = 0x5344_4B01
+
+
+async def upgrade_schema(bind: AsyncEngine = engine) -> list[str]:
+    """Добавляет недостающие таблицы и столбцы, возвращает список добавленных"""
+    tables = sorted(
+        {table for table, _, _ in COLUMNS} | {table.name for table in TABLES}
+    )
+    added = []
+    async with bind.begin() as conn:
+        await conn.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": _UPGRADE_LOCK_KEY}
+        )
+        result = await conn.execute(
+            text(
+                "SELECT table_name, column_name FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = ANY(:tables)"
+            ),
+            {"tables": tables},
+        )
+        existing = {(row.table_name, row.column_name) for row in result}
+        existing_tables = {table for table, _ in existing}
+        missing_tables = [
+            table for table in TABLES if table.name not in existing_tables
+        ]
+        if missing_tables:
+            await conn.run_sync(Base.metadata.create_all, tables=missing_tables)
+            added.extend(table.name for table in missing_tables)
+        for table, column, column_type in COLUMNS:
+            if (table, column) in existing:
+                continue
+            await conn.execute(
+                text(
+                    f"ALTER TABLE {table} "
+                    f"ADD COLUMN IF NOT EXISTS {column} {column_type}"
+                )
+            )
+            added.append(f"{table}.{column}")
+    return added
+
+
+if __name__ == "__main__":
+    added = asyncio.run(upgrade_schema())
+    print("Добавлено: " + ", ".join(added) if added else "Схема актуальна")
@@ -1,70 +1,908 @@
-from datetime import date, datetime
-from decimal import Decimal
+import json
+import time
+from contextlib import AsyncExitStack, contextmanager
 
-from asyncpg.exceptions import QueryCanceledError
+from asyncpg.exceptions import PostgresError, QueryCanceledError
 from fastapi import HTTPException
-from sqlalchemy import text
+from sqlalchemy import event, text
 from sqlalchemy.exc import StatementError
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 
 from config import settings
+from src.utils.clone_pool import ClonePool
+from src.utils.execution_scheduler import ExecutionScheduler, sandbox_scheduler
+from src.utils.query_preflight import CostLimits, PlanCache, PlanEstimate, parse_explain
+from src.utils.replica_pool import ReplicaPool
+from src.utils.resource_budget import budget_settings, public_budget
+from src.utils.result_cache import QueryResultCache
+from src.utils.result_digest import DigestBuilder
+from src.utils.result_response import COLUMNS_LAYOUT
+from src.utils.row_converter import RowPlan, RowPlanCache
+from src.utils.sql_lexer import (
+    DDL_STATEMENTS,
+    DML_STATEMENTS,
+    READ_STATEMENTS,
+    SQLSyntaxError,
+    check_policy,
+    sql_analysis_cache,
+)
+
+
+@contextmanager
+def _translate_errors():
+    """Преобразует ошибки выполнения запроса в ответ 400"""
+    try:
+        yield
+    except QueryCanceledError:
+        raise HTTPException(
+            status_code=400, detail="Время выполнения запроса превышено"
+        )
+    except StatementError as e:
+        raise HTTPException(
+            status_code=400, detail=f"Ошибка выполнения: {str(e.orig)}"
+        )
+    except PostgresError as e:
+        # Ошибку открытия серверного курсора (stream) SQLAlchemy не оборачивает
+        raise HTTPException(status_code=400, detail=f"Ошибка выполнения: {e}")
+
+
+# Сравнение результата студента с эталоном внутри БД: наружу уходят
+# только счетчики и небольшая выборка расхождений
+_COMPARE_SQL = """
+WITH _student AS MATERIALIZED (SELECT {rn}_s.* FROM ({student}) AS _s),
+     _reference AS MATERIALIZED (SELECT {rn}_r.* FROM ({reference}) AS _r),
+     _missing AS (SELECT * FROM _reference EXCEPT ALL SELECT * FROM _student),
+     _extra AS (SELECT * FROM _student EXCEPT ALL SELECT * FROM _reference)
+SELECT
+    (SELECT count(*) FROM _student) AS row_count,
+    (SELECT count(*) FROM _reference) AS expected_row_count,
+    (SELECT count(*) FROM _missing) AS missing_count,
+    (SELECT count(*) FROM _extra) AS extra_count,
+    (SELECT json_agg(m)::text FROM (SELECT * FROM _missing {order} LIMIT {limit}) AS m)
+        AS missing_rows,
+    (SELECT json_agg(e)::text FROM (SELECT * FROM _extra {order} LIMIT {limit}) AS e)
+        AS extra_rows
+"""
+
+
+# Ошибки EXCEPT ALL из-за разных типов или числа колонок: 42804 - несовместимые
+# типы, 42601 - разное число колонок, 42883 - нет оператора сравнения для типа
+_COMPARE_MISMATCH_SQLSTATES = frozenset({"42804", "42601", "42883"})
+
+
+def _sqlstate(error: BaseException) -> str | None:
+    orig = getattr(error, "orig", None)
+    return getattr(orig, "sqlstate", None)
+
+
+# Структура таблиц после DDL: колонки и ключи (имена ограничений не сравниваем,
+# они генерируются). NOT NULL виден в колонке, CHECK-ограничения пропускаем.
+SCHEMA_COLUMNS = ["table_name", "kind", "name", "definition"]
+_SCHEMA_SQL = """
+SELECT table_name::text, 'column' AS kind, column_name::text AS name,
+       data_type || CASE WHEN is_nullable = 'NO' THEN ' not null' ELSE '' END
+           AS definition
+FROM information_schema.columns
+WHERE table_schema = 'public' AND table_name = ANY(:tables)
+UNION ALL
+SELECT tc.table_name::text, 'constraint', tc.constraint_type::text,
+       string_agg(kcu.column_name::text, ', ' ORDER BY kcu.ordinal_position)
+FROM information_schema.table_constraints AS tc
+LEFT JOIN information_schema.key_column_usage AS kcu
+    USING (constraint_schema, constraint_name, table_name)
+WHERE tc.table_schema = 'public' AND tc.table_name = ANY(:tables)
+    AND tc.constraint_type <> 'CHECK'
+GROUP BY tc.table_name, tc.constraint_type, tc.constraint_name
+ORDER BY 1, 2, 3, 4
+"""
+
+
+def _json_rows(value: str | None, ordered: bool) -> list:
+    """Разбирает json_agg в список строк, сохраняя порядок и дубли колонок"""
+    if not value:
+        return []
+    rows = json.loads(value, object_pairs_hook=lambda pairs: [v for _, v in pairs])
+    # Служебный номер строки в упорядоченном режиме не показываем
+    return [row[1:] for row in rows] if ordered else rows
+
+
+def _sandbox_server_settings() -> dict:
+    """Параметры сессии, которые применяются один раз при открытии соединения"""
+    return {
+        # Запись разрешается только внутри откатываемой транзакции execute_dml
+        "default_transaction_read_only": "on",
+        "statement_timeout": str(settings.SANDBOX_STATEMENT_TIMEOUT_MS),
+        "lock_timeout": str(settings.SANDBOX_LOCK_TIMEOUT_MS),
+        "idle_in_transaction_session_timeout": str(
+            settings.SANDBOX_IDLE_IN_TRANSACTION_TIMEOUT_MS
+        ),
+    }
+
+
+def _create_sandbox_engine(url: str) -> AsyncEngine:
+    engine = create_async_engine(
+        url,
+        isolation_level="AUTOCOMMIT",
+        pool_size=settings.SANDBOX_POOL_SIZE,
+        max_overflow=settings.SANDBOX_MAX_OVERFLOW,
+        pool_timeout=settings.SANDBOX_POOL_TIMEOUT,
+        pool_recycle=settings.SANDBOX_POOL_RECYCLE,
+        pool_pre_ping=settings.SANDBOX_POOL_PRE_PING,
+        connect_args={"server_settings": _sandbox_server_settings()},
+    )
+    event.listen(engine.sync_engine, "after_cursor_execute", _remember_description)
+    return engine
+
+
+_DESCRIPTION_KEY = "sandbox_cursor_description"
+
+
+def _remember_description(conn, cursor, statement, parameters, context, executemany):
+    conn.info[_DESCRIPTION_KEY] = cursor.description
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 2)
+
+
+async def _apply_session_settings(conn, values: dict | None) -> None:
+    """
+    Параметры только для текущей транзакции, соединение пула не меняется.
+    Сессию запрос студента изменить не может (SET и set_config запрещены
+    check_policy), поэтому при возврате в пул соединение не сбрасывается.
+    """
+    if not values:
+        return
+    calls = ", ".join(
+        f"set_config(:name_{index}, :value_{index}, true)" for index in range(len(values))
+    )
+    params = {}
+    for index, (name, value) in enumerate(values.items()):
+        params[f"name_{index}"] = name
+        params[f"value_{index}"] = value
+    await conn.execute(text(f"SELECT {calls}"), params)
 
 
 class SQLExecutor:
-    def __init__(self, db_url: str = settings.GAME_DATABASE_URL):
-        self.engine = create_async_engine(db_url, isolation_level="AUTOCOMMIT")
+    def __init__(
+        self,
+        db_url: str | list[str] = settings.GAME_DATABASE_URL,
+        name: str = "game",
+        scheduler: ExecutionScheduler = sandbox_scheduler,
+        clones: ClonePool | None = None,
+        dml_url: str | None = None,
+    ):
+        self.name = name
+        self.scheduler = scheduler
+        # Копии БД для DDL; без них задачи на изменение схемы недоступны
+        self.clones = clones
+        # Несколько адресов - одинаковые реплики, запросы распределяются между ними
+        db_urls = [db_url] if isinstance(db_url, str) else list(db_url)
+        self.replicas = ReplicaPool(
+            [_create_sandbox_engine(url) for url in db_urls],
+            max_failures=settings.SANDBOX_REPLICA_MAX_FAILURES,
+            eject_seconds=settings.SANDBOX_REPLICA_EJECT_SECONDS,
+            health_interval=settings.SANDBOX_REPLICA_HEALTH_INTERVAL,
+        )
+        # Отдельная роль с правом записи для execute_dml: роль песочницы
+        # только читает, даже если сессия сняла default_transaction_read_only
+        self.dml_engine = _create_sandbox_engine(dml_url) if dml_url else None
+        self.result_cache = (
+            QueryResultCache(
+                max_entries=settings.RESULT_CACHE_MAX_ENTRIES,
+                max_bytes=settings.RESULT_CACHE_MAX_BYTES,
+                max_entry_bytes=settings.RESULT_CACHE_MAX_ENTRY_BYTES,
+                ttl_seconds=settings.RESULT_CACHE_TTL_SECONDS,
+            )
+            if settings.RESULT_CACHE_ENABLED
+            else None
+        )
+        self.row_plans = RowPlanCache()
+        self.plan_estimates = (
+            PlanCache(settings.SANDBOX_PREFLIGHT_CACHE_SIZE)
+            if settings.SANDBOX_PREFLIGHT_ENABLED
+            else None
+        )
+        self._reference_columns: dict[str, list] = {}
+
+    def pool_stats(self) -> dict:
+        """Текущее состояние пулов соединений песочницы по репликам"""
+        return {
+            "max_overflow": settings.SANDBOX_MAX_OVERFLOW,
+            "replicas": self.replicas.stats(),
+        }
+
+    def invalidate_cache(self) -> None:
+        """Сбрасывает кэш результатов; вызывается по NOTIFY sandbox_data"""
+        if self.result_cache is not None:
+            self.result_cache.invalidate()
+        if self.plan_estimates is not None:
+            # После перезагрузки данных меняется статистика и оценки планов
+            self.plan_estimates.clear()
+
+    def cache_stats(self) -> dict | None:
+        return self.result_cache.stats() if self.result_cache is not None else None
+
+    async def execute_sql(
+        self,
+        sql_query: str,
+        use_cache: bool = True,
+        user_id: int = None,
+        limits: CostLimits = None,
+        budget: dict = None,
+        columnar: bool = False,
+        max_rows: int = None,
+        max_bytes: int = None,
+    ) -> dict:
+        """
+        columnar: data - список колонок (layout "columns"), колонки собираются
+        при преобразовании строк, для msgpack по колонкам без транспонирования.
+        max_rows/max_bytes: ограничения результата вместо SANDBOX_MAX_ROWS и
+        SANDBOX_MAX_RESULT_BYTES (результат для спула страниц).
+        """
+        started = time.perf_counter()
+        sql_query, fingerprint = self._validate_sql(sql_query)
+        estimate = await self.preflight(sql_query, fingerprint, limits, user_id)
+        session_settings = budget_settings(budget)
+        max_rows = max_rows or settings.SANDBOX_MAX_ROWS
+        max_bytes = max_bytes or settings.SANDBOX_MAX_RESULT_BYTES
+        executed = False
+
+        async def execute() -> dict:
+            nonlocal executed
+            executed = True
+            return await self._execute(
+                sql_query,
+                fingerprint,
+                user_id,
+                session_settings,
+                columnar,
+                max_rows,
+                max_bytes,
+            )
+
+        if self.result_cache is None or not use_cache:
+            result = await execute()
+        else:
+            # Бюджет меняет лимиты выполнения: результат под другим бюджетом
+            # (или ошибка по таймауту) другому бюджету не подходит
+            settings_key = tuple(sorted((session_settings or {}).items()))
+            key = (self.name, fingerprint, settings_key, columnar, max_rows, max_bytes)
+            result = await self.result_cache.get_or_execute(key, execute)
+        # Результат может лежать в кэше, поэтому не изменяем его на месте.
+        # При попадании в кэш время выполнения и ожидания - от исходного запуска.
+        stats = {
+            **result.get("stats", {}),
+            "planning_ms": estimate.planning_ms if estimate is not None else None,
+            "cache_hit": not executed,
+            "total_ms": _elapsed_ms(started),
+        }
+        return {
+            **result,
+            "plan_estimate": estimate.as_dict() if estimate is not None else None,
+            "resource_budget": public_budget(budget),
+            "stats": stats,
+        }
+
+    async def execute_dml(
+        self,
+        sql_query: str,
+        probe_query: str = None,
+        user_id: int = None,
+        budget: dict = None,
+    ) -> dict:
+        """
+        Выполняет INSERT/UPDATE/DELETE/MERGE в транзакции, которая всегда
+        откатывается. Возвращает строки RETURNING, число измененных строк и
+        значение probe_query, прочитанное в той же транзакции до отката.
+        Строки RETURNING читаются порциями с теми же ограничениями, что и
+        результат SELECT. Соединение берется из пула отдельной роли с правом
+        записи, у которой по умолчанию действует default_transaction_read_only: запись
+        разрешается только в этой транзакции, данные и блокировки снимает откат.
+        """
+        started = time.perf_counter()
+        sql_query, fingerprint = self._validate_sql(
+            sql_query, READ_STATEMENTS | DML_STATEMENTS
+        )
+        analysis = sql_analysis_cache.analyze(sql_query)
+        # У курсора нет rowcount: запрос без RETURNING выполняется обычным execute
+        returns_rows = (
+            analysis.statement_type in READ_STATEMENTS or "returning" in analysis.words
+        )
+        session_settings = budget_settings(budget)
+        columns, data, truncated, fetched_rows = [], [], False, 0
+        with _translate_errors():
+            async with (
+                self.scheduler.slot(user_id) as wait_seconds,
+                self._dml_connect() as conn,
+            ):
+                await conn.execution_options(isolation_level="READ COMMITTED")
+                transaction = await conn.begin()
+                try:
+                    await conn.execute(text("SET TRANSACTION READ WRITE"))
+                    await _apply_session_settings(conn, session_settings)
+                    if returns_rows:
+                        result = await conn.stream(text(sql_query))
+                        description = conn.info.pop(_DESCRIPTION_KEY, None)
+                        # Без строк (RETURNING только в CTE) число изменений неизвестно
+                        affected_rows = None
+                        if description is not None:
+                            columns = list(result.keys())
+                            # Соединение и транзакцию закрывает этот метод
+                            stream = ResultStream(
+                                columns,
+                                result,
+                                self.row_plans.get_plan(fingerprint, description),
+                                AsyncExitStack(),
+                                max_rows=settings.SANDBOX_MAX_ROWS,
+                                max_bytes=settings.SANDBOX_MAX_RESULT_BYTES,
+                            )
+                            async for chunk in stream.chunks():
+                                data.extend(chunk)
+                            truncated = stream.truncated
+                            fetched_rows = stream.fetched_rows
+                            if not truncated:
+                                affected_rows = len(data)
+                    else:
+                        result = await conn.execute(text(sql_query))
+                        affected_rows = result.rowcount
+                    probe_value = None
+                    if probe_query:
+                        probe_value = (await conn.execute(text(probe_query))).scalar()
+                finally:
+                    await transaction.rollback()
+        return {
+            "columns": columns,
+            "data": data,
+            "row_count": len(data),
+            "truncated": truncated,
+            "total_row_count": affected_rows,
+            "total_row_count_at_least": fetched_rows if truncated else None,
+            "affected_rows": affected_rows,
+            "probe_value": probe_value,
+            "resource_budget": public_budget(budget),
+            "stats": {
+                "execution_ms": _elapsed_ms(started),
+                "queue_wait_ms": round(wait_seconds * 1000, 2),
+                "rows": len(data),
+            },
+        }
+
+    async def execute_in_clone(self, sql_query: str, user_id: int = None) -> dict:
+        """
+        Выполняет запрос с DDL в отдельной копии игровой БД. Если запрос
+        не возвращает строк, в ответе структура упомянутых в нем таблиц
+        после изменения. Запрос идет в транзакции с откатом, поэтому команды
+        вне транзакций (CREATE DATABASE, ALTER SYSTEM, ...) не выполняются.
+        """
+        started = time.perf_counter()
+        sql_query, fingerprint, tables = self._validate_schema_sql(sql_query)
+        async with (
+            self.scheduler.slot(user_id) as wait_seconds,
+            self._lease_clone() as conn,
+        ):
+            await conn.execution_options(isolation_level="READ COMMITTED")
+            transaction = await conn.begin()
+            try:
+                with _translate_errors():
+                    result = await conn.execute(text(sql_query))
+                if result.returns_rows:
+                    columns = list(result.keys())
+                    plan = self.row_plans.get_plan(
+                        fingerprint, result.cursor.description
+                    )
+                    data = [
+                        plan.convert(row)
+                        for row in result.fetchmany(settings.SANDBOX_MAX_ROWS)
+                    ]
+                else:
+                    columns = SCHEMA_COLUMNS
+                    data = await self._schema_snapshot(conn, tables)
+            finally:
+                await transaction.rollback()
+        return {
+            "columns": columns,
+            "data": data,
+            "row_count": len(data),
+            "stats": {
+                "execution_ms": _elapsed_ms(started),
+                "queue_wait_ms": round(wait_seconds * 1000, 2),
+                "rows": len(data),
+            },
+        }
 
-    async def execute_sql(self, sql_query: str) -> dict:
+    async def compare_schema(
+        self, sql_query: str, reference_query: str, user_id: int = None
+    ) -> dict:
+        """
+        Структура таблиц после запроса студента и после эталона. Оба
+        выполняются в одной копии БД, каждый в своей транзакции с откатом
+        (DDL в PostgreSQL транзакционный).
+        """
+        sql_query, _, tables = self._validate_schema_sql(sql_query)
+        reference_query = reference_query.rstrip(";").strip()
+        tables |= sql_analysis_cache.analyze(reference_query).identifiers
+        async with self.scheduler.slot(user_id), self._lease_clone() as conn:
+            with _translate_errors():
+                student_rows = await self._schema_after(conn, sql_query, tables)
+            reference_rows = await self._schema_after(conn, reference_query, tables)
+        return {
+            "columns": SCHEMA_COLUMNS,
+            "data": student_rows,
+            "expected_data": reference_rows,
+        }
+
+    async def preflight(
+        self,
+        sql_query: str,
+        fingerprint: str,
+        limits: CostLimits = None,
+        user_id: int = None,
+    ) -> PlanEstimate | None:
+        """
+        Оценивает запрос через EXPLAIN до выполнения и отклоняет слишком
+        тяжелые. Оценки кэшируются по отпечатку, повторный запрос в БД не идет.
+        """
+        if self.plan_estimates is None:
+            return None
+        estimate = self.plan_estimates.get(fingerprint)
+        if estimate is None:
+            with _translate_errors():
+                async with self.scheduler.slot(user_id), self.replicas.connect() as conn:
+                    plan = (
+                        await conn.execute(
+                            text(f"EXPLAIN (FORMAT JSON, SUMMARY) {sql_query}")
+                        )
+                    ).scalar_one()
+            estimate = parse_explain(plan)
+            self.plan_estimates.put(fingerprint, estimate)
+        violation = (limits or CostLimits.for_task()).violation(estimate)
+        if violation is not None:
+            raise HTTPException(status_code=400, detail=violation)
+        return estimate
+
+    async def compare_with_reference(
+        self,
+        sql_query: str,
+        reference_query: str,
+        ordered: bool = False,
+        sample_size: int = settings.GRADING_DIFF_SAMPLE_ROWS,
+        user_id: int = None,
+        limits: CostLimits = None,
+        budget: dict = None,
+    ) -> dict:
+        """
+        Сравнивает результат запроса студента с эталонным запросом в БД
+        (EXCEPT ALL в обе стороны), не выгружая результаты целиком
+        """
+        sql_query, fingerprint = self._validate_sql(sql_query)
+        await self.preflight(sql_query, fingerprint, limits, user_id)
+        reference_query = reference_query.rstrip(";").strip()
+        session_settings = budget_settings(budget)
+
+        async with self.scheduler.slot(user_id), self.replicas.connect() as conn:
+            if session_settings:
+                await conn.execution_options(isolation_level="READ COMMITTED")
+                await conn.begin()
+                await _apply_session_settings(conn, session_settings)
+            with _translate_errors():
+                student_columns = await self._columns_of(conn, sql_query)
+            reference_columns = self._reference_columns.get(reference_query)
+            if reference_columns is None:
+                reference_columns = await self._columns_of(conn, reference_query)
+                self._reference_columns[reference_query] = reference_columns
+            if student_columns != reference_columns:
+                return {
+                    "is_correct": False,
+                    "columns": student_columns,
+                    "expected_columns": reference_columns,
+                }
+            compare_sql = _COMPARE_SQL.format(
+                student=sql_query,
+                reference=reference_query,
+                rn="row_number() OVER () AS _rn, " if ordered else "",
+                order="ORDER BY 1" if ordered else "",
+                limit=int(sample_size),
+            )
+            try:
+                row = (await conn.execute(text(compare_sql))).one()
+            except StatementError as e:
+                if _sqlstate(e) not in _COMPARE_MISMATCH_SQLSTATES:
+                    # Таймаут, отмена, обрыв соединения - не ответ студента
+                    with _translate_errors():
+                        raise
+                # Несовместимые типы колонок: запрос студента корректен, ответ нет
+                return {
+                    "is_correct": False,
+                    "columns": student_columns,
+                    "expected_columns": reference_columns,
+                }
+
+        return {
+            "is_correct": row.missing_count == 0 and row.extra_count == 0,
+            "columns": student_columns,
+            "expected_columns": reference_columns,
+            "row_count": row.row_count,
+            "expected_row_count": row.expected_row_count,
+            "missing_count": row.missing_count,
+            "extra_count": row.extra_count,
+            "missing_rows": _json_rows(row.missing_rows, ordered),
+            "extra_rows": _json_rows(row.extra_rows, ordered),
+        }
+
+    async def check_digest(
+        self,
+        sql_query: str,
+        digest: dict,
+        ordered: bool = True,
+        user_id: int = None,
+        limits: CostLimits = None,
+        budget: dict = None,
+    ) -> dict:
+        """
+        Сверяет результат запроса с отпечатком эталона, читая строки потоком
+        и останавливаясь на первом расхождении колонок или числа строк
+        """
+        expected_row_count = digest["row_count"]
+        stream = await self.open_stream(
+            sql_query,
+            max_rows=expected_row_count + 1,
+            max_bytes=settings.SANDBOX_EXPORT_MAX_BYTES,
+            user_id=user_id,
+            limits=limits,
+            budget=budget,
+        )
+        builder = DigestBuilder()
+        try:
+            if stream.columns != digest["columns"]:
+                return {
+                    "is_correct": False,
+                    "columns": stream.columns,
+                    "expected_columns": digest["columns"],
+                }
+            async for chunk in stream.chunks():
+                builder.add_many(chunk)
+        finally:
+            await stream.aclose()
+
+        hash_key = "ordered_hash" if ordered else "unordered_hash"
+        is_correct = (
+            not stream.truncated
+            and builder.row_count == expected_row_count
+            and getattr(builder, hash_key) == digest[hash_key]
+        )
+        return {
+            "is_correct": is_correct,
+            "columns": stream.columns,
+            "expected_columns": digest["columns"],
+            "row_count": builder.row_count,
+            "expected_row_count": expected_row_count,
+            "truncated": stream.truncated,
+        }
+
+    async def _columns_of(self, conn, sql_query: str) -> list:
+        result = await conn.execute(
+            text(f"SELECT * FROM ({sql_query}) AS _q LIMIT 0")
+        )
+        return list(result.keys())
+
+    async def open_stream(
+        self,
+        sql_query: str,
+        max_rows: int = None,
+        max_bytes: int = None,
+        user_id: int = None,
+        limits: CostLimits = None,
+        budget: dict = None,
+    ) -> "ResultStream":
+        """Выполняет запрос через серверный курсор без кэша, строки читаются порциями"""
+        sql_query, fingerprint = self._validate_sql(sql_query)
+        await self.preflight(sql_query, fingerprint, limits, user_id)
+        return await self._open_stream(
+            sql_query,
+            fingerprint,
+            max_rows,
+            max_bytes,
+            user_id,
+            budget_settings(budget),
+        )
+
+    async def profile_query(self, sql_query: str, runs: int) -> list:
+        """
+        Прогоняет эталонный запрос через EXPLAIN ANALYZE для расчета бюджета
+        задачи. Только для запросов из админки, запрос студента сюда не попадает.
+        """
         sql_query = sql_query.rstrip(";").strip()
-        self._validate_sql(sql_query)
+        explains = []
+        # Ошибки не переводятся в 400: build_budget отличает ошибку эталона от сбоя
+        async with (
+            self.scheduler.slot("profiler", per_user_limit=False),
+            self.replicas.connect() as conn,
+        ):
+            await conn.execution_options(
+                isolation_level="READ COMMITTED", postgresql_readonly=True
+            )
+            async with conn.begin():
+                await _apply_session_settings(
+                    conn,
+                    {"statement_timeout": f"{settings.SANDBOX_BUDGET_MAX_TIMEOUT_MS}ms"},
+                )
+                for _ in range(runs):
+                    result = await conn.execute(
+                        text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql_query}")
+                    )
+                    explains.append(result.scalar_one())
+        return explains
+
+    async def _open_stream(
+        self,
+        sql_query: str,
+        fingerprint: str,
+        max_rows: int = None,
+        max_bytes: int = None,
+        user_id: int = None,
+        session_settings: dict = None,
+    ) -> "ResultStream":
+        exit_stack = AsyncExitStack()
+        try:
+            # Слот планировщика занят, пока поток не закрыт
+            wait_seconds = await exit_stack.enter_async_context(
+                self.scheduler.slot(user_id)
+            )
+            with _translate_errors():
+                conn = await exit_stack.enter_async_context(self.replicas.connect())
+                # Серверный курсор asyncpg работает только внутри транзакции
+                await conn.execution_options(
+                    isolation_level="READ COMMITTED", postgresql_readonly=True
+                )
+                await exit_stack.enter_async_context(conn.begin())
+                await _apply_session_settings(conn, session_settings)
+                result = await conn.stream(text(sql_query))
+                columns = list(result.keys())
+                # OID колонок есть только в description курсора DBAPI,
+                # у AsyncResult потока его нет - берем из события execute
+                plan = self.row_plans.get_plan(
+                    fingerprint, conn.info.pop(_DESCRIPTION_KEY)
+                )
+        except BaseException:
+            await exit_stack.aclose()
+            raise
+        return ResultStream(
+            columns,
+            result,
+            plan,
+            exit_stack,
+            max_rows=max_rows or settings.SANDBOX_MAX_ROWS,
+            max_bytes=max_bytes or settings.SANDBOX_MAX_RESULT_BYTES,
+            queue_wait_seconds=wait_seconds,
+        )
+
+    async def _execute(
+        self,
+        sql_query: str,
+        fingerprint: str,
+        user_id: int = None,
+        session_settings: dict = None,
+        columnar: bool = False,
+        max_rows: int = None,
+        max_bytes: int = None,
+    ) -> dict:
+        if not settings.SANDBOX_STREAM_RESULTS:
+            return await self._execute_buffered(
+                sql_query,
+                fingerprint,
+                user_id,
+                session_settings,
+                columnar,
+                max_rows,
+                max_bytes,
+            )
+        started = time.perf_counter()
+        stream = await self._open_stream(
+            sql_query,
+            fingerprint,
+            max_rows,
+            max_bytes,
+            user_id=user_id,
+            session_settings=session_settings,
+        )
         try:
-            async with self.engine.connect() as conn:
-                await conn.execute(text("SET statement_timeout TO 5000"))
+            if columnar:
+                data = [[] for _ in stream.columns]
+                async for chunk in stream.chunks(columnar=True):
+                    for column, values in zip(data, chunk):
+                        column.extend(values)
+            else:
+                data = []
+                async for chunk in stream.chunks():
+                    data.extend(chunk)
+        finally:
+            await stream.aclose()
+        queue_wait_ms = round(stream.queue_wait_seconds * 1000, 2)
+        return {
+            **({"layout": COLUMNS_LAYOUT} if columnar else {}),
+            "columns": stream.columns,
+            "data": data,
+            "row_count": stream.row_count,
+            "truncated": stream.truncated,
+            # Обрезанный результат не дочитывается: известна только нижняя
+            # граница, оценку дает plan_estimate
+            "total_row_count": None if stream.truncated else stream.row_count,
+            "total_row_count_at_least": (
+                stream.fetched_rows if stream.truncated else None
+            ),
+            "stats": {
+                "execution_ms": round(_elapsed_ms(started) - queue_wait_ms, 2),
+                "queue_wait_ms": queue_wait_ms,
+                "rows": stream.row_count,
+                "estimated_bytes": stream.byte_count,  # по repr строк, не размер ответа
+            },
+        }
+
+    async def _execute_buffered(
+        self,
+        sql_query: str,
+        fingerprint: str,
+        user_id: int = None,
+        session_settings: dict = None,
+        columnar: bool = False,
+        max_rows: int = None,
+        max_bytes: int = None,
+    ) -> dict:
+        max_rows = max_rows or settings.SANDBOX_MAX_ROWS
+        max_bytes = max_bytes or settings.SANDBOX_MAX_RESULT_BYTES
+        with _translate_errors():
+            async with (
+                self.scheduler.slot(user_id) as wait_seconds,
+                self.replicas.connect() as conn,
+            ):
+                started = time.perf_counter()
+                if session_settings:
+                    # set_config(..., true) действует только внутри транзакции
+                    await conn.execution_options(isolation_level="READ COMMITTED")
+                    await conn.begin()
+                    await _apply_session_settings(conn, session_settings)
                 result = await conn.execute(text(sql_query))
-                if result.returns_rows:
-                    columns = list(result.keys())
-                    data = []
-                    for row in result.fetchall():
-                        processed_row = []
-                        for value in row:
-                            if isinstance(value, (date, datetime)):
-                                processed_row.append(value.isoformat())
-                            elif isinstance(value, Decimal):
-                                processed_row.append(float(value))
-                            else:
-                                processed_row.append(value)
-                        data.append(processed_row)
-                    return {"columns": columns, "data": data, "row_count": len(data)}
-                return {"columns": [], "data": [], "row_count": result.rowcount}
-        except QueryCanceledError:
+                if not result.returns_rows:
+                    return {"columns": [], "data": [], "row_count": result.rowcount}
+                columns = list(result.keys())
+                plan = self.row_plans.get_plan(fingerprint, result.cursor.description)
+                rows = result.fetchall()
+        data = [[] for _ in columns] if columnar else []
+        row_count = 0
+        size = 0
+        for row in rows[:max_rows]:
+            processed_row = plan.convert(row)
+            size += len(repr(processed_row))
+            if size > max_bytes:
+                break
+            if columnar:
+                for column, value in zip(data, processed_row):
+                    column.append(value)
+            else:
+                data.append(processed_row)
+            row_count += 1
+        return {
+            **({"layout": COLUMNS_LAYOUT} if columnar else {}),
+            "columns": columns,
+            "data": data,
+            "row_count": row_count,
+            "truncated": row_count < len(rows),
+            "total_row_count": len(rows),
+            "stats": {
+                "execution_ms": _elapsed_ms(started),
+                "queue_wait_ms": round(wait_seconds * 1000, 2),
+                "rows": row_count,
+                "estimated_bytes": size,
+            },
+        }
+
+    def _dml_connect(self):
+        if self.dml_engine is None:
             raise HTTPException(
-                status_code=400, detail="Время выполнения запроса превышено"
+                status_code=503, detail="Сцены с изменением данных сейчас недоступны"
             )
-        except StatementError as e:
+        return self.dml_engine.connect()
+
+    def _lease_clone(self):
+        if self.clones is None:
             raise HTTPException(
-                status_code=400, detail=f"Ошибка выполнения: {str(e.orig)}"
+                status_code=503, detail="Задачи на изменение схемы сейчас недоступны"
             )
+        return self.clones.lease()
 
-    def _validate_sql(self, sql_query: str):
-        """Базовая проверка SQL-запроса на безопасность"""
-        sql_lower = sql_query.lower()
-        forbidden_keywords = [
-            "insert",
-            "delete",
-            "update",
-            "grant",
-            "revoke",
-            "create",
-            "alter",
-            "drop",
-            "truncate",
-            "/*",
-            "*/",
-            "pg_",
-            "user",
-        ]
-        for keyword in forbidden_keywords:
-            if keyword in sql_lower:
-                raise HTTPException(
-                    status_code=400, detail="Запрещенная операция в SQL-запросе"
-                )
+    async def _schema_snapshot(self, conn, tables: frozenset) -> list:
+        result = await conn.execute(text(_SCHEMA_SQL), {"tables": sorted(tables)})
+        return [list(row) for row in result]
+
+    async def _schema_after(self, conn, sql_query: str, tables: frozenset) -> list:
+        await conn.execution_options(isolation_level="READ COMMITTED")
+        transaction = await conn.begin()
+        try:
+            await conn.execute(text(sql_query))
+            return await self._schema_snapshot(conn, tables)
+        finally:
+            await transaction.rollback()
+
+    def _validate_schema_sql(self, sql_query: str) -> tuple[str, str, frozenset]:
+        """Проверка запроса для копии БД: разрешены еще DML и DDL"""
+        sql_query, fingerprint = self._validate_sql(
+            sql_query, READ_STATEMENTS | DML_STATEMENTS | DDL_STATEMENTS
+        )
+        tables = sql_analysis_cache.analyze(sql_query).identifiers
+        return sql_query, fingerprint, tables
+
+    def _validate_sql(
+        self, sql_query: str, allowed_statements: frozenset = READ_STATEMENTS
+    ) -> tuple[str, str]:
+        """
+        Проверяет запрос по токенам: один оператор чтения, без запрещенных
+        слов вне строк и комментариев. Возвращает текст запроса без ";"
+        и комментариев в конце и его отпечаток.
+        """
+        try:
+            analysis = sql_analysis_cache.analyze(sql_query)
+        except SQLSyntaxError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        error = check_policy(analysis, allowed_statements)
+        if error is not None:
+            raise HTTPException(status_code=400, detail=error)
+        return sql_query[: analysis.statement_end], analysis.fingerprint
+
+
+class ResultStream:
+    """Результат запроса, читаемый порциями с ограничением по строкам и байтам"""
+
+    def __init__(
+        self,
+        columns: list,
+        result,
+        plan: RowPlan,
+        exit_stack: AsyncExitStack,
+        max_rows: int,
+        max_bytes: int,
+        queue_wait_seconds: float = 0.0,
+    ):
+        self.columns = columns
+        self.queue_wait_seconds = queue_wait_seconds
+        self.row_count = 0
+        self.byte_count = 0
+        self.truncated = False
+        self.fetched_rows = 0  # строк получено с сервера, включая отброшенные
+        self._result = result
+        self._plan = plan
+        self._exit_stack = exit_stack
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+
+    async def chunks(self, columnar: bool = False):
+        """Порции строк; columnar - порция как список колонок"""
+        with _translate_errors():
+            async for partition in self._result.partitions(
+                settings.SANDBOX_FETCH_CHUNK_ROWS
+            ):
+                self.fetched_rows += len(partition)
+                chunk = [[] for _ in self.columns] if columnar else []
+                rows_before = self.row_count
+                for row in partition:
+                    if self.row_count >= self._max_rows:
+                        self.truncated = True
+                        break
+                    processed_row = self._plan.convert(row)
+                    self.byte_count += len(repr(processed_row))
+                    if self.byte_count > self._max_bytes:
+                        self.truncated = True
+                        break
+                    if columnar:
+                        for column, value in zip(chunk, processed_row):
+                            column.append(value)
+                    else:
+                        chunk.append(processed_row)
+                    self.row_count += 1
+                if self.row_count > rows_before:
+                    yield chunk
+                if self.truncated:
+                    return
+
+    async def aclose(self) -> None:
+        await self._exit_stack.aclose()
@@ -0,0 +1,360 @@
+import hashlib
+import re
+from collections import OrderedDict
+from typing import NamedTuple
+
+# Виды токенов
+WORD = "word"  # ключевое слово или идентификатор без кавычек
+QUOTED = "quoted"  # "идентификатор"
+STRING = "string"  # 'строка', E'...', $$...$$
+NUMBER = "number"
+PARAM = "param"  # $1
+OPERATOR = "operator"
+PUNCT = "punct"  # ( ) , ; [ ] . :
+
+_WORD_RE = re.compile(r"[A-Za-z_\u0080-\uffff][A-Za-z0-9_$\u0080-\uffff]*")
+_NUMBER_RE = re.compile(r"(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?")
+_PARAM_RE = re.compile(r"\$\d+")
+_DOLLAR_TAG_RE = re.compile(r"\$(?:[A-Za-z_\u0080-\uffff][A-Za-z0-9_\u0080-\uffff]*)?\$")
+_OPERATOR_RE = re.compile(r"[+\-*/<>=~!@#%^&|`?]+")
+# С этими символами многосимвольный оператор может кончаться на + или -
+_OPERATOR_SPECIAL = frozenset("~!@#%^&|`?")
+_PUNCT = "(),;[].:"
+# Префиксы строковых констант: E'..', B'..', X'..', N'..', U&'..'
+_STRING_PREFIXES = ("u&", "e", "b", "x", "n")
+
+# Операторы, с которых может начинаться запрос, и их класс
+READ_STATEMENTS = frozenset({"select", "values", "table"})
+DML_STATEMENTS = frozenset({"insert", "update", "delete", "merge"})
+DDL_STATEMENTS = frozenset({"create", "alter", "drop", "truncate"})
+_STATEMENT_WORDS = READ_STATEMENTS | DML_STATEMENTS | DDL_STATEMENTS
+
+# Слова, запрещенные в запросах песочницы в любом месте. Прочие служебные
+# операторы (SET, COPY, GRANT, ...) отсекаются проверкой вида запроса.
+FORBIDDEN_WORDS = frozenset(
+    {
+        "into",  # SELECT ... INTO создает таблицу
+        # Функции, меняющие состояние сессии или выходящие за пределы БД
+        "set_config",
+        "dblink",
+        "dblink_exec",
+        "lo_import",
+        "lo_export",
+        "query_to_xml",
+        "query_to_xmlschema",
+        "query_to_xml_and_xmlschema",
+        "cursor_to_xml",
+    }
+)
+# В INSERT ... INTO это слово - часть самого оператора
+_DML_CLAUSE_WORDS = frozenset({"into"})
+
+
+class SQLSyntaxError(ValueError):
+    pass
+
+
+class Token(NamedTuple):
+    kind: str
+    text: str
+    end: int  # позиция в исходном тексте сразу после токена
+
+
+class SQLAnalysis(NamedTuple):
+    fingerprint: str
+    statement_count: int
+    statement_type: str | None  # select / update / create / ...
+    words: frozenset  # слова без кавычек в нижнем регистре
+    identifiers: frozenset  # все идентификаторы, включая "в кавычках"
+    statement_end: int  # конец первого оператора без ";" и комментариев после него
+    balanced: bool  # скобки парные и не закрываются раньше открытия
+    ordered: bool  # ORDER BY самого внешнего запроса первого оператора
+
+
+def tokenize(sql: str) -> list[Token]:
+    """Однопроходный лексер SQL: строки, идентификаторы в кавычках и комментарии"""
+    tokens = []
+    pos = 0
+    length = len(sql)
+    while pos < length:
+        char = sql[pos]
+        if char.isspace():
+            pos += 1
+            continue
+        if sql.startswith("--", pos):
+            end = sql.find("\n", pos)
+            pos = length if end == -1 else end + 1
+            continue
+        if sql.startswith("/*", pos):
+            pos = _skip_block_comment(sql, pos)
+            continue
+
+        lowered = sql[pos : pos + 3].lower()
+        prefix = next(
+            (
+                p
+                for p in _STRING_PREFIXES
+                if lowered.startswith(p) and sql.startswith("'", pos + len(p))
+            ),
+            None,
+        )
+        if prefix is not None:
+            end = _scan_quoted(sql, pos + len(prefix), "'", backslash=prefix == "e")
+            tokens.append(Token(STRING, sql[pos:end], end))
+            pos = end
+            continue
+        if lowered.startswith("u&") and sql.startswith('"', pos + 2):
+            end = _scan_quoted(sql, pos + 2, '"')
+            tokens.append(Token(QUOTED, sql[pos:end], end))
+            pos = end
+            continue
+        if char == "'":
+            end = _scan_quoted(sql, pos, "'")
+            tokens.append(Token(STRING, sql[pos:end], end))
+            pos = end
+            continue
+        if char == '"':
+            end = _scan_quoted(sql, pos, '"')
+            tokens.append(Token(QUOTED, sql[pos:end], end))
+            pos = end
+            continue
+        if char == "$":
+            match = _PARAM_RE.match(sql, pos)
+            if match:
+                tokens.append(Token(PARAM, match.group(), match.end()))
+                pos = match.end()
+                continue
+            match = _DOLLAR_TAG_RE.match(sql, pos)
+            if match:
+                tag = match.group()
+                end = sql.find(tag, match.end())
+                if end == -1:
+                    raise SQLSyntaxError("Незакрытая строка в SQL-запросе")
+                end += len(tag)
+                tokens.append(Token(STRING, sql[pos:end], end))
+                pos = end
+                continue
+
+        match = _WORD_RE.match(sql, pos)
+        if match:
+            tokens.append(Token(WORD, match.group().lower(), match.end()))
+            pos = match.end()
+            continue
+        match = _NUMBER_RE.match(sql, pos)
+        if match:
+            tokens.append(Token(NUMBER, match.group(), match.end()))
+            pos = match.end()
+            continue
+        if sql.startswith("::", pos):
+            tokens.append(Token(PUNCT, "::", pos + 2))
+            pos += 2
+            continue
+        if char in _PUNCT:
+            tokens.append(Token(PUNCT, char, pos + 1))
+            pos += 1
+            continue
+        match = _OPERATOR_RE.match(sql, pos)
+        if match:
+            end = _operator_end(match.group(), pos)
+            tokens.append(Token(OPERATOR, sql[pos:end], end))
+            pos = end
+            continue
+        raise SQLSyntaxError(f"Неожиданный символ в SQL-запросе: {char!r}")
+    return tokens
+
+
+def _skip_block_comment(sql: str, pos: int) -> int:
+    """Пропускает /* ... */ с учетом вложенности, как в PostgreSQL"""
+    depth = 0
+    length = len(sql)
+    while pos < length:
+        if sql.startswith("/*", pos):
+            depth += 1
+            pos += 2
+        elif sql.startswith("*/", pos):
+            depth -= 1
+            pos += 2
+            if depth == 0:
+                return pos
+        else:
+            pos += 1
+    raise SQLSyntaxError("Незакрытый комментарий в SQL-запросе")
+
+
+def _operator_end(text: str, pos: int) -> int:
+    """
+    Конец оператора по правилам сканера PostgreSQL: -- и /* внутри
+    начинают комментарий, а + и - в конце отбрасываются, если в операторе
+    нет символов из _OPERATOR_SPECIAL ("1 *-1" - это "*" и "-")
+    """
+    for comment in ("--", "/*"):
+        index = text.find(comment, 1)
+        if index != -1:
+            text = text[:index]
+    if len(text) > 1 and not _OPERATOR_SPECIAL.intersection(text):
+        text = text.rstrip("+-") or text[0]
+    return pos + len(text)
+
+
+def _scan_quoted(sql: str, pos: int, quote: str, backslash: bool = False) -> int:
+    """Возвращает позицию после закрывающей кавычки; удвоенная кавычка - экранирование"""
+    pos += 1
+    length = len(sql)
+    while pos < length:
+        char = sql[pos]
+        if backslash and char == "\\":
+            pos += 2
+            continue
+        if char == quote:
+            if sql.startswith(quote, pos + 1):
+                pos += 2
+                continue
+            return pos + 1
+        pos += 1
+    raise SQLSyntaxError("Незакрытая строка или идентификатор в SQL-запросе")
+
+
+def _split_statements(tokens: list[Token]) -> list[list[Token]]:
+    statements = [[]]
+    for token in tokens:
+        if token.kind == PUNCT and token.text == ";":
+            statements.append([])
+        else:
+            statements[-1].append(token)
+    return [statement for statement in statements if statement]
+
+
+def _statement_type(tokens: list[Token]) -> str | None:
+    """Вид оператора по первому слову; для WITH - первое слово после CTE"""
+    words = (token for token in tokens if token.kind != PUNCT or token.text != "(")
+    first = next(words, None)
+    if first is None or first.kind != WORD:
+        return None
+    if first.text != "with":
+        return first.text
+    depth = 0
+    for token in tokens:
+        if token.kind == PUNCT and token.text == "(":
+            depth += 1
+        elif token.kind == PUNCT and token.text == ")":
+            depth -= 1
+        elif depth == 0 and token.kind == WORD and token.text in _STATEMENT_WORDS:
+            return token.text
+    return None
+
+
+def _top_level_order_by(tokens: list[Token]) -> bool:
+    """
+    ORDER BY вне скобок: оконные функции, агрегаты (string_agg(... ORDER BY))
+    и подзапросы порядок результата не задают
+    """
+    depth = 0
+    previous = None
+    for token in tokens:
+        if token.kind == PUNCT and token.text == "(":
+            depth += 1
+        elif token.kind == PUNCT and token.text == ")":
+            depth -= 1
+        elif depth == 0 and token.kind == WORD and token.text == "by":
+            if previous is not None and previous.text == "order":
+                return True
+        previous = token
+    return False
+
+
+def _identifier(token: Token) -> str:
+    if token.kind == QUOTED:
+        start = token.text.index('"')
+        return token.text[start + 1 : -1].replace('""', '"').lower()
+    return token.text
+
+
+def _parentheses_balanced(tokens: list[Token]) -> bool:
+    depth = 0
+    for token in tokens:
+        if token.kind == PUNCT and token.text == "(":
+            depth += 1
+        elif token.kind == PUNCT and token.text == ")":
+            depth -= 1
+            if depth < 0:
+                return False
+    return depth == 0
+
+
+def fingerprint_tokens(tokens: list[Token]) -> str:
+    """
+    Отпечаток запроса: без комментариев и лишних пробелов, слова без кавычек
+    в нижнем регистре (PostgreSQL их так и понимает), литералы как есть
+    """
+    normalized = " ".join(token.text for token in tokens)
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def analyze_sql(sql: str) -> SQLAnalysis:
+    tokens = tokenize(sql)
+    statements = _split_statements(tokens)
+    return SQLAnalysis(
+        fingerprint=fingerprint_tokens(tokens),
+        statement_count=len(statements),
+        statement_type=_statement_type(statements[0]) if statements else None,
+        words=frozenset(token.text for token in tokens if token.kind == WORD),
+        identifiers=frozenset(
+            _identifier(token) for token in tokens if token.kind in (WORD, QUOTED)
+        ),
+        statement_end=statements[0][-1].end if statements else 0,
+        balanced=_parentheses_balanced(tokens),
+        ordered=_top_level_order_by(statements[0]) if statements else False,
+    )
+
+
+class SQLAnalysisCache:
+    """LRU-кэш разбора запросов: повторный запрос с тем же текстом не лексится"""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, SQLAnalysis | SQLSyntaxError] = OrderedDict()
+
+    def analyze(self, sql: str) -> SQLAnalysis:
+        entry = self._entries.get(sql)
+        if entry is None:
+            try:
+                entry = analyze_sql(sql)
+            except SQLSyntaxError as e:
+                entry = e
+            self._entries[sql] = entry
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(sql)
+        if isinstance(entry, SQLSyntaxError):
+            raise entry
+        return entry
+
+
+sql_analysis_cache = SQLAnalysisCache()
+
+
+def check_policy(
+    analysis: SQLAnalysis, allowed_statements: frozenset = READ_STATEMENTS
+) -> str | None:
+    """Возвращает текст ошибки, если запрос не подходит под политику песочницы"""
+    if analysis.statement_count == 0:
+        return "Пустой SQL-запрос"
+    if analysis.statement_count > 1:
+        return "Допускается только один SQL-запрос"
+    if analysis.statement_type not in allowed_statements:
+        return "Запрещенная операция в SQL-запросе"
+    if not analysis.balanced:
+        # Запрос подставляется в обертки (сравнение, список столбцов) в скобках
+        return "Непарные скобки в SQL-запросе"
+    forbidden = FORBIDDEN_WORDS
+    if analysis.statement_type in DML_STATEMENTS:
+        forbidden = forbidden - _DML_CLAUSE_WORDS
+    # Имена в кавычках ("set_config") вызывают те же функции
+    if analysis.identifiers & forbidden:
+        return "Запрещенная операция в SQL-запросе"
+    if analysis.words & (_STATEMENT_WORDS - allowed_statements):
+        return "Запрещенная операция в SQL-запросе"
+    if any(identifier.startswith("pg_") for identifier in analysis.identifiers):
+        return "Запрещенная операция в SQL-запросе"
+    return None
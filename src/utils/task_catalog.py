@@ -0,0 +1,225 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+import asyncpg
+from sqlalchemy import select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import defer
+
+from config import settings
+from database import AsyncSessionLocal
+from src.models.task import Task
+
+CHANNEL = "task_catalog"
+# Данные игровой БД перезагружены: кэши результатов песочницы устарели
+DATA_CHANNEL = "sandbox_data"
+# Пауза между попытками открыть LISTEN-соединение
+LISTEN_RETRY_SECONDS = 30
+
+
+@dataclass(frozen=True)
+class CatalogTask:
+    """Задача без эталонного результата; атрибуты как у модели Task"""
+
+    task_global_id: int
+    mission_id: int
+    task_id: int
+    title: str
+    description: str
+    clue: str
+    correct_query: str | None
+    expected_digest: dict | None
+    grading_options: dict | None
+    query_limits: dict | None
+    resource_budget: dict | None
+    tags: tuple
+
+
+class TaskCatalog:
+    """
+    Неизменяемый снимок таблицы tasks: индексы по (mission_id, task_id)
+    и task_global_id, число задач по миссиям, соседние задачи в порядке
+    прохождения. При изменении строится и подменяется целиком.
+    """
+
+    def __init__(self, tasks: list[CatalogTask]):
+        self.tasks = tuple(
+            sorted(tasks, key=lambda task: (task.mission_id, task.task_id))
+        )
+        self.loaded_at = time.monotonic()
+        self._by_key = {(task.mission_id, task.task_id): task for task in self.tasks}
+        self._by_id = {task.task_global_id: task for task in self.tasks}
+        self._counts: dict[int, int] = {}
+        for task in self.tasks:
+            self._counts[task.mission_id] = self._counts.get(task.mission_id, 0) + 1
+        self._neighbours: dict[int, tuple] = {}
+        for index, task in enumerate(self.tasks):
+            prev_task = self.tasks[index - 1] if index > 0 else None
+            next_task = self.tasks[index + 1] if index + 1 < len(self.tasks) else None
+            self._neighbours[task.task_global_id] = (prev_task, next_task)
+
+    def get(self, mission_id: int, task_id: int) -> CatalogTask | None:
+        return self._by_key.get((mission_id, task_id))
+
+    def by_id(self, task_global_id: int) -> CatalogTask | None:
+        return self._by_id.get(task_global_id)
+
+    def count(self, mission_id: int) -> int:
+        return self._counts.get(mission_id, 0)
+
+    def neighbours(self, task: CatalogTask) -> tuple:
+        """(предыдущая, следующая) задача или None"""
+        return self._neighbours[task.task_global_id]
+
+
+def _catalog_task(task: Task) -> CatalogTask:
+    return CatalogTask(
+        task_global_id=task.task_global_id,
+        mission_id=task.mission_id,
+        task_id=task.task_id,
+        title=task.title,
+        description=task.description,
+        clue=task.clue,
+        correct_query=task.correct_query,
+        expected_digest=task.expected_digest,
+        grading_options=task.grading_options,
+        query_limits=task.query_limits,
+        resource_budget=task.resource_budget,
+        tags=tuple(task.tags or ()),
+    )
+
+
+async def notify_catalog_changed(session) -> None:
+    """Сообщает всем процессам API, что tasks изменилась (доставка после commit)"""
+    await session.execute(text("SELECT pg_notify(:channel, '')"), {"channel": CHANNEL})
+
+
+async def notify_sandbox_data_changed(session) -> None:
+    """Сообщает процессам API, что данные game_db изменились (после commit)"""
+    await session.execute(
+        text("SELECT pg_notify(:channel, '')"), {"channel": DATA_CHANNEL}
+    )
+
+
+class TaskCatalogHolder:
+    """
+    Текущий каталог процесса. Перезагружается по NOTIFY task_catalog
+    (админка, сохранение отпечатка или бюджета) и не реже max_age_seconds.
+    То же соединение слушает sandbox_data и вызывает on_data_changed.
+    Без LISTEN-соединения (например, за пулером в режиме транзакций)
+    остается только перезагрузка по возрасту, соединение переоткрывается
+    не чаще LISTEN_RETRY_SECONDS.
+    """
+
+    def __init__(self, database_url: str, max_age_seconds: float):
+        # asyncpg напрямую: LISTEN держит отдельное соединение вне пула
+        self.dsn = make_url(database_url).set(drivername="postgresql").render_as_string(
+            hide_password=False
+        )
+        self.max_age_seconds = max_age_seconds
+        self._catalog: TaskCatalog | None = None
+        self._stale = True
+        self._loading: asyncio.Task | None = None
+        self._listener: asyncpg.Connection | None = None
+        self._next_listen_attempt = 0.0
+        self._data_callbacks: list[Callable[[], None]] = []
+        self.reloads = 0
+
+    async def get(self) -> TaskCatalog:
+        catalog = self._catalog
+        if catalog is not None and not self._is_stale(catalog):
+            return catalog
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._reload())
+            self._loading.add_done_callback(self._on_loaded)
+        # Общая загрузка для всех, кто пришел во время нее
+        return await asyncio.shield(self._loading)
+
+    def invalidate(self) -> None:
+        self._stale = True
+
+    def on_data_changed(self, callback: Callable[[], None]) -> None:
+        """Регистрирует сброс кэша по NOTIFY sandbox_data"""
+        self._data_callbacks.append(callback)
+
+    def stats(self) -> dict:
+        return {
+            "tasks": len(self._catalog.tasks) if self._catalog is not None else None,
+            "reloads": self.reloads,
+            "listening": self._listener is not None and not self._listener.is_closed(),
+        }
+
+    def _is_stale(self, catalog: TaskCatalog) -> bool:
+        return (
+            self._stale or time.monotonic() - catalog.loaded_at > self.max_age_seconds
+        )
+
+    def _on_loaded(self, task: asyncio.Task) -> None:
+        self._loading = None
+
+    async def _reload(self) -> TaskCatalog:
+        await self._ensure_listener()
+        # Флаг снимаем до чтения: NOTIFY во время загрузки вызовет еще одну
+        self._stale = False
+        try:
+            async with AsyncSessionLocal() as session:
+                result = await session.execute(
+                    select(Task).options(defer(Task.expected_result))
+                )
+                catalog = TaskCatalog([_catalog_task(task) for task in result.scalars()])
+        except BaseException:
+            self._stale = True
+            raise
+        self._catalog = catalog
+        self.reloads += 1
+        return catalog
+
+    async def _ensure_listener(self) -> None:
+        if self._listener is not None and not self._listener.is_closed():
+            return
+        now = time.monotonic()
+        if now < self._next_listen_attempt:
+            return
+        self._next_listen_attempt = now + LISTEN_RETRY_SECONDS
+        listener = None
+        try:
+            listener = await asyncpg.connect(self.dsn)
+            await listener.add_listener(CHANNEL, self._on_notify)
+            await listener.add_listener(DATA_CHANNEL, self._on_data_notify)
+            listener.add_termination_listener(self._on_listener_closed)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError):
+            # Без LISTEN каталог перечитывается по max_age_seconds
+            if listener is not None:
+                listener.terminate()
+            self._listener = None
+            return
+        self._listener = listener
+
+    def _on_notify(self, connection, pid, channel, payload) -> None:
+        self._stale = True
+
+    def _on_data_notify(self, connection, pid, channel, payload) -> None:
+        for callback in self._data_callbacks:
+            callback()
+
+    def _on_listener_closed(self, connection) -> None:
+        self._listener = None
+        self._stale = True
+
+
+task_catalog = TaskCatalogHolder(
+    settings.DATABASE_URL, max_age_seconds=settings.TASK_CATALOG_MAX_AGE_SECONDS
+)
+
+
+if __name__ == "__main__":
+    # make invalidate-cache: после перезагрузки данных game_db
+
+    async def _notify_data_changed() -> None:
+        async with AsyncSessionLocal() as session:
+            await notify_sandbox_data_changed(session)
+            await session.commit()
+
+    asyncio.run(_notify_data_changed())
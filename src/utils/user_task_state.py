@@ -0,0 +1,145 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from sqlalchemy import literal, select, union_all
+
+from config import settings
+from src.models.clue import PurchasedClue
+from src.models.task import TaskSolved
+
+SOLVED = 0  # clue_type 1 и 2 - купленные подсказки
+
+
+class UserTaskState:
+    """
+    Решенные задачи и купленные подсказки пользователя: битовые маски по
+    task_global_id (бит N - задача N) для решений и подсказок каждого типа
+    """
+
+    __slots__ = ("bits", "loaded_at")
+
+    def __init__(self, bits: dict[int, int]):
+        self.bits = bits
+        self.loaded_at = time.monotonic()
+
+    def has(self, kind: int, task_global_id: int) -> bool:
+        return bool(self.bits.get(kind, 0) >> task_global_id & 1)
+
+    def is_solved(self, task_global_id: int) -> bool:
+        return self.has(SOLVED, task_global_id)
+
+    def has_clue(self, clue_type: int, task_global_id: int) -> bool:
+        return self.has(clue_type, task_global_id)
+
+    def set(self, kind: int, task_global_id: int) -> None:
+        self.bits[kind] = self.bits.get(kind, 0) | 1 << task_global_id
+
+    def clear(self, kind: int, task_global_id: int) -> None:
+        self.bits[kind] = self.bits.get(kind, 0) & ~(1 << task_global_id)
+
+
+class UserTaskStateCache:
+    """
+    LRU состояний пользователей. Состояние читается из tasks_solved и
+    users_clues одним запросом при первом обращении, дальше обновляется
+    сквозной записью из путей решения и покупки подсказок. ttl_seconds
+    ограничивает расхождение с записями других процессов API.
+    """
+
+    def __init__(self, max_users: int, ttl_seconds: float):
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self._states: OrderedDict[int, UserTaskState] = OrderedDict()
+        self._loading: dict[int, asyncio.Future] = {}
+        # Пользователи, для которых была запись во время загрузки состояния
+        self._written: set[int] = set()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, session, user_id: int) -> UserTaskState:
+        state = self._states.get(user_id)
+        if state is not None and time.monotonic() - state.loaded_at <= self.ttl_seconds:
+            self._states.move_to_end(user_id)
+            self.hits += 1
+            return state
+        self.misses += 1
+        loading = self._loading.get(user_id)
+        if loading is not None:
+            return await asyncio.shield(loading)
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[user_id] = loading
+        try:
+            # Запись во время чтения могла не попасть в результат - читаем снова
+            while True:
+                self._written.discard(user_id)
+                state = await self._load(session, user_id)
+                if user_id not in self._written:
+                    break
+            self._store(user_id, state)
+            loading.set_result(state)
+            return state
+        except BaseException as e:
+            loading.set_exception(e)
+            # Ошибку увидят ожидающие; если их нет, future не должен ругаться
+            loading.exception()
+            raise
+        finally:
+            del self._loading[user_id]
+            self._written.discard(user_id)
+
+    def mark_solved(self, user_id: int, task_global_id: int) -> None:
+        self._write(user_id, SOLVED, task_global_id, True)
+
+    def mark_clue(self, user_id: int, task_global_id: int, clue_type: int) -> None:
+        self._write(user_id, clue_type, task_global_id, True)
+
+    def clear_clues(self, user_id: int, task_global_id: int) -> None:
+        for clue_type in (1, 2):
+            self._write(user_id, clue_type, task_global_id, False)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._states),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _write(self, user_id: int, kind: int, task_global_id: int, value: bool) -> None:
+        if user_id in self._loading:
+            self._written.add(user_id)
+        state = self._states.get(user_id)
+        if state is None:
+            return
+        if value:
+            state.set(kind, task_global_id)
+        else:
+            state.clear(kind, task_global_id)
+
+    def _store(self, user_id: int, state: UserTaskState) -> None:
+        self._states[user_id] = state
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_users:
+            self._states.popitem(last=False)
+
+    async def _load(self, session, user_id: int) -> UserTaskState:
+        result = await session.execute(
+            union_all(
+                select(literal(SOLVED), TaskSolved.task_global_id).where(
+                    TaskSolved.user_id == user_id
+                ),
+                select(PurchasedClue.clue_type, PurchasedClue.task_global_id).where(
+                    PurchasedClue.user_id == user_id
+                ),
+            )
+        )
+        state = UserTaskState({})
+        for kind, task_global_id in result.all():
+            state.set(kind, task_global_id)
+        return state
+
+
+user_task_state = UserTaskStateCache(
+    max_users=settings.USER_TASK_STATE_MAX_USERS,
+    ttl_seconds=settings.USER_TASK_STATE_TTL_SECONDS,
+)
@@ -0,0 +1,103 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from src.utils.execution_scheduler import ExecutionScheduler
+
+
+def scheduler(**overrides) -> ExecutionScheduler:
+    options = {
+        "max_concurrency": 1,
+        "max_per_user": 2,
+        "max_queue": 10,
+        "max_wait_seconds": 1.0,
+        "retry_after_seconds": 3,
+    }
+    return ExecutionScheduler(**{**options, **overrides})
+
+
+def test_per_user_limit_rejects_with_retry_after():
+    async def scenario():
+        limited = scheduler(max_concurrency=5, max_per_user=1)
+        async with limited.slot("u"):
+            with pytest.raises(HTTPException) as error:
+                async with limited.slot("u"):
+                    pass
+            # Служебные запросы лимит пользователя не проверяют
+            async with limited.slot("u", per_user_limit=False):
+                pass
+        return error.value, limited.stats()
+
+    error, stats = asyncio.run(scenario())
+    assert error.status_code == 429
+    assert error.headers == {"Retry-After": "3"}
+    assert stats["running"] == 0
+    assert stats["rejected_user_limit"] == 1
+
+
+def test_queue_serves_users_round_robin():
+    async def scenario():
+        fair = scheduler(max_per_user=3)
+        order = []
+        release = asyncio.Event()
+
+        async def run(user_id, tag):
+            async with fair.slot(user_id):
+                order.append(tag)
+                await release.wait()
+
+        holder = asyncio.create_task(run("a", "a0"))
+        await asyncio.sleep(0)
+        waiters = [
+            asyncio.create_task(run(user_id, tag))
+            for user_id, tag in (("a", "a1"), ("a", "a2"), ("b", "b1"))
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(holder, *waiters)
+        return order
+
+    # Пользователь a занял очередь первым, но b обслуживается раньше его второго
+    assert asyncio.run(scenario()) == ["a0", "a1", "b1", "a2"]
+
+
+def test_full_queue_and_wait_timeout_return_503():
+    async def scenario():
+        busy = scheduler(max_queue=1, max_wait_seconds=0.05)
+        async with busy.slot("a"):
+            waiter = asyncio.create_task(busy.slot("b").__aenter__())
+            await asyncio.sleep(0)
+            with pytest.raises(HTTPException) as overload:
+                async with busy.slot("c"):
+                    pass
+            with pytest.raises(HTTPException) as timeout:
+                await waiter
+        return overload.value, timeout.value, busy.stats()
+
+    overload, timeout, stats = asyncio.run(scenario())
+    assert overload.status_code == 503
+    assert timeout.status_code == 503
+    assert stats["rejected_overload"] == 1
+    assert stats["timed_out"] == 1
+    assert stats["running"] == 0
+    assert stats["queued"] == 0
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        busy = scheduler()
+        async with busy.slot("a"):
+            waiter = asyncio.create_task(busy.slot("b").__aenter__())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiter
+            queued = busy.stats()["queued"]
+        async with busy.slot("b"):
+            pass
+        return queued, busy.stats()
+
+    queued, stats = asyncio.run(scenario())
+    assert queued == 0
+    assert stats["running"] == 0
@@ -0,0 +1,49 @@
+import json
+
+from config import settings
+from src.utils.query_preflight import CostLimits, PlanCache, PlanEstimate, parse_explain
+
+EXPLAIN = [
+    {
+        "Plan": {"Node Type": "Seq Scan", "Total Cost": 35.5, "Plan Rows": 2550},
+        "Planning Time": 0.12,
+    }
+]
+
+
+def test_parse_explain_from_list_and_string():
+    expected = PlanEstimate(total_cost=35.5, plan_rows=2550.0, planning_ms=0.12)
+    assert parse_explain(EXPLAIN) == expected
+    assert parse_explain(json.dumps(EXPLAIN)) == expected
+
+
+def test_parse_explain_without_summary():
+    plan = [{"Plan": {"Total Cost": 1, "Plan Rows": 1}}]
+    assert parse_explain(plan).planning_ms is None
+
+
+def test_violation_lists_every_exceeded_limit():
+    limits = CostLimits(max_cost=10, max_rows=100)
+    assert limits.violation(PlanEstimate(5, 50)) is None
+    message = limits.violation(PlanEstimate(20, 500))
+    assert "оценка стоимости 20 при лимите 10" in message
+    assert "ожидается строк 500 при лимите 100" in message
+
+
+def test_for_task_uses_mission_limits_and_overrides():
+    limits = CostLimits.for_task(0)
+    assert limits.max_cost == settings.SANDBOX_PREFLIGHT_MAX_COST[0]
+    # Квесты и неизвестные миссии - самый мягкий лимит
+    loosest_cost = max(settings.SANDBOX_PREFLIGHT_MAX_COST)
+    assert CostLimits.for_task(None).max_cost == loosest_cost
+    assert CostLimits.for_task(99).max_rows == max(settings.SANDBOX_PREFLIGHT_MAX_ROWS)
+    assert CostLimits.for_task(0, {"max_cost": 1.5}).max_cost == 1.5
+
+
+def test_plan_cache_lru():
+    cache = PlanCache(max_entries=1)
+    cache.put("a", PlanEstimate(1, 1))
+    assert cache.get("a") == PlanEstimate(1, 1)
+    cache.put("b", PlanEstimate(2, 2))
+    assert cache.get("a") is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 1}
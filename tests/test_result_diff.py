@@ -0,0 +1,97 @@
+import pytest
+
+from src.utils.result_diff import ComparisonOptions, compare_results
+
+EXPECTED = {"columns": ["id", "name"], "data": [[1, "a"], [2, "b"], [2, "b"]]}
+
+
+def result(data, columns=("id", "name")):
+    return {"columns": list(columns), "data": data}
+
+
+def test_ordered_match_and_mismatch():
+    assert compare_results(EXPECTED, result([[1, "a"], [2, "b"], [2, "b"]]))[
+        "is_correct"
+    ]
+    diff = compare_results(EXPECTED, result([[2, "b"], [1, "a"], [2, "b"]]))
+    assert not diff["is_correct"]
+    assert diff["missing_rows"] == [[1, "a"], [2, "b"]]
+    assert diff["extra_rows"] == [[2, "b"], [1, "a"]]
+
+
+def test_unordered_respects_duplicates():
+    actual = result([[2, "b"], [1, "a"], [2, "b"]])
+    assert compare_results(EXPECTED, actual, ordered=False)["is_correct"]
+
+    diff = compare_results(EXPECTED, result([[2, "b"], [1, "a"]]), ordered=False)
+    assert diff["missing_count"] == 1
+    assert diff["missing_rows"] == [[2, "b"]]
+    assert diff["extra_count"] == 0
+
+
+def test_integer_float_equal():
+    assert compare_results(
+        {"columns": ["x"], "data": [[1], [2.5]]},
+        {"columns": ["x"], "data": [[2.5], [1.0]]},
+        ordered=False,
+    )["is_correct"]
+
+
+def test_unhashable_cells():
+    expected = {"columns": ["tags"], "data": [[["a", "b"]], [{"k": 1}]]}
+    actual = {"columns": ["tags"], "data": [[{"k": 1}], [["a", "b"]]]}
+    assert compare_results(expected, actual, ordered=False)["is_correct"]
+
+
+def test_column_mismatch_reported():
+    diff = compare_results(EXPECTED, result([[1, "a"]], columns=("name", "id")))
+    assert diff == {
+        "is_correct": False,
+        "columns": ["name", "id"],
+        "expected_columns": ["id", "name"],
+    }
+
+
+def test_ignore_column_order():
+    options = ComparisonOptions(ignore_column_order=True)
+    actual = result([["a", 1], ["b", 2], ["b", 2]], columns=("name", "id"))
+    assert compare_results(EXPECTED, actual, options)["is_correct"]
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_tolerance(ordered):
+    options = ComparisonOptions(tolerance=0.01)
+    expected = {"columns": ["x", "y"], "data": [[1.0, 0.333], [2.0, 0.5]]}
+    close = {"columns": ["x", "y"], "data": [[1.0, 0.3333], [2.0, 0.505]]}
+    far = {"columns": ["x", "y"], "data": [[1.0, 0.3333], [2.0, 0.52]]}
+    assert compare_results(expected, close, options, ordered=ordered)["is_correct"]
+    diff = compare_results(expected, far, options, ordered=ordered)
+    assert diff["missing_rows"] == [[2.0, 0.5]]
+    assert diff["extra_rows"] == [[2.0, 0.52]]
+
+
+def test_tolerance_across_bucket_boundary():
+    # 0.0999 и 0.1001 попадают в соседние корзины шириной 0.01
+    options = ComparisonOptions(tolerance=0.01)
+    expected = {"columns": ["x"], "data": [[0.0999]]}
+    actual = {"columns": ["x"], "data": [[0.1001]]}
+    assert compare_results(expected, actual, options, ordered=False)["is_correct"]
+
+
+def test_sample_size_limits_rows_not_counts():
+    expected = {"columns": ["x"], "data": [[i] for i in range(10)]}
+    diff = compare_results(
+        expected, {"columns": ["x"], "data": []}, ordered=False, sample_size=3
+    )
+    assert diff["missing_count"] == 10
+    assert len(diff["missing_rows"]) == 3
+
+
+def test_options_from_dict():
+    assert ComparisonOptions.from_dict(None) == ComparisonOptions()
+    options = ComparisonOptions.from_dict({"mode": "unordered", "tolerance": "0.5"})
+    assert options.mode == "unordered"
+    assert options.tolerance == 0.5
+    assert not options.is_exact
+    with pytest.raises(ValueError):
+        ComparisonOptions.from_dict({"mode": "sorted"})
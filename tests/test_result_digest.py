@@ -0,0 +1,33 @@
+from src.utils.result_digest import (
+    DIGEST_VERSION,
+    compute_digest,
+    digest_from_expected_result,
+)
+
+
+def test_ordered_hash_depends_on_order_unordered_does_not():
+    first = compute_digest(["x"], [[1], [2], [3]])
+    shuffled = compute_digest(["x"], [[3], [1], [2]])
+    assert first["ordered_hash"] != shuffled["ordered_hash"]
+    assert first["unordered_hash"] == shuffled["unordered_hash"]
+    assert first["row_count"] == 3
+    assert first["version"] == DIGEST_VERSION
+
+
+def test_unordered_hash_counts_duplicates():
+    assert (
+        compute_digest(["x"], [[1], [1], [2]])["unordered_hash"]
+        != compute_digest(["x"], [[1], [2], [2]])["unordered_hash"]
+    )
+
+
+def test_integer_floats_hash_like_ints():
+    assert compute_digest(["x"], [[1.0]]) == compute_digest(["x"], [[1]])
+    assert compute_digest(["x"], [[1.5]]) != compute_digest(["x"], [[1]])
+
+
+def test_digest_from_expected_result():
+    expected = {"columns": ["x"], "data": [[1]], "row_count": 1}
+    assert digest_from_expected_result(expected) == compute_digest(["x"], [[1]])
+    assert digest_from_expected_result("Ошибка: timeout") is None
+    assert digest_from_expected_result(None) is None
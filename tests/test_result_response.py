@@ -0,0 +1,35 @@
+from datetime import date
+from decimal import Decimal
+
+import msgpack
+
+from src.utils.result_response import COLUMNS_LAYOUT, dumps_columnar
+
+
+def unpack(body: bytes) -> dict:
+    return msgpack.unpackb(body)
+
+
+def test_row_result_is_transposed():
+    body = unpack(
+        dumps_columnar(
+            {"columns": ["id", "d"], "data": [[1, date(2024, 1, 2)], [2, None]]}
+        )
+    )
+    assert body["layout"] == COLUMNS_LAYOUT
+    assert body["data"] == [[1, 2], ["2024-01-02", None]]
+
+
+def test_columnar_result_packed_as_is():
+    result = {
+        "layout": COLUMNS_LAYOUT,
+        "columns": ["n"],
+        "data": [[Decimal("1.5"), 2]],
+        "row_count": 2,
+    }
+    assert unpack(dumps_columnar(result))["data"] == [[1.5, 2]]
+
+
+def test_empty_result_keeps_one_list_per_column():
+    body = unpack(dumps_columnar({"columns": ["a", "b"], "data": []}))
+    assert body["data"] == [[], []]
@@ -0,0 +1,52 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+from src.utils.row_converter import RowPlan, RowPlanCache
+
+INT4, TEXT, NUMERIC, DATE, TIMESTAMP, UNKNOWN_OID = 23, 25, 1700, 1082, 1114, 99999
+
+
+def description(*oids):
+    return [(f"c{index}", oid) for index, oid in enumerate(oids)]
+
+
+def test_converts_only_planned_columns():
+    plan = RowPlan((INT4, TEXT, NUMERIC, DATE, TIMESTAMP))
+    row = (1, "a", Decimal("2.5"), date(2024, 1, 2), datetime(2024, 1, 2, 3, 4))
+    assert plan.convert(row) == [1, "a", 2.5, "2024-01-02", "2024-01-02T03:04:00"]
+    assert [index for index, _ in plan.converters] == [2, 3, 4]
+
+
+def test_null_values_pass_through():
+    assert RowPlan((NUMERIC, DATE)).convert((None, None)) == [None, None]
+
+
+def test_unknown_type_uses_generic_conversion():
+    plan = RowPlan((UNKNOWN_OID,))
+    assert plan.convert((Decimal("1.5"),)) == [1.5]
+    assert plan.convert((date(2024, 1, 2),)) == ["2024-01-02"]
+    assert plan.convert(("x",)) == ["x"]
+
+
+def test_plan_cached_per_fingerprint_and_rebuilt_on_type_change():
+    cache = RowPlanCache(max_entries=2)
+    plan = cache.get_plan("q1", description(INT4))
+    assert cache.get_plan("q1", description(INT4)) is plan
+    assert cache.get_plan("q1", description(NUMERIC)) is not plan
+
+
+def test_cache_evicts_least_recent():
+    cache = RowPlanCache(max_entries=2)
+    first = cache.get_plan("q1", description(INT4))
+    cache.get_plan("q2", description(INT4))
+    cache.get_plan("q1", description(INT4))
+    cache.get_plan("q3", description(INT4))
+    assert cache.get_plan("q1", description(INT4)) is first
+    assert "q2" not in cache._plans
+
+
+def test_no_fingerprint_is_not_cached():
+    cache = RowPlanCache()
+    assert cache.get_plan(None, description(INT4)) is not cache.get_plan(
+        None, description(INT4)
+    )
@@ -0,0 +1,141 @@
+import pytest
+
+from src.utils.sql_lexer import (
+    DML_STATEMENTS,
+    OPERATOR,
+    READ_STATEMENTS,
+    STRING,
+    SQLSyntaxError,
+    analyze_sql,
+    check_policy,
+    tokenize,
+)
+
+
+# Как в SQLExecutor.execute_dml: чтение плюс изменение данных
+READ_AND_DML = READ_STATEMENTS | DML_STATEMENTS
+
+
+def operators(sql: str) -> list[str]:
+    return [token.text for token in tokenize(sql) if token.kind == OPERATOR]
+
+
+def policy(sql: str, allowed=READ_STATEMENTS) -> str | None:
+    return check_policy(analyze_sql(sql), allowed)
+
+
+@pytest.mark.parametrize(
+    "sql, expected",
+    [
+        ("select 1 +/* x */ 2", ["+"]),
+        ("select 1 -/* x */ 2", ["-"]),
+        ("select 1 */* x */ 2", ["*"]),
+        ("select 1 <-- x\n, 2", ["<"]),
+        ("select 1 +-- x\n, 2", ["+"]),
+        ("select 1 *-1", ["*", "-"]),
+        ("select a @- b", ["@-"]),
+        ("select 1 <> 2", ["<>"]),
+    ],
+)
+def test_operator_stops_at_comment_start(sql, expected):
+    assert operators(sql) == expected
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT 1 +/* ' */ length(pg_terminate_backend(123)::text) -- '",
+        "SELECT 1 -/* ' */ length(set_config('a', 'b', false)) -- '",
+        "SELECT 1 +-- '\n, set_config('a', 'b', false)",
+    ],
+)
+def test_comment_glued_to_operator_does_not_hide_calls(sql):
+    assert policy(sql) == "Запрещенная операция в SQL-запросе"
+
+
+def test_dollar_quotes_are_single_string():
+    tokens = tokenize("select $tag$ it's -- not /* a comment $tag$, $$x$$")
+    strings = [token.text for token in tokens if token.kind == STRING]
+    assert strings == ["$tag$ it's -- not /* a comment $tag$", "$$x$$"]
+
+
+def test_forbidden_word_inside_dollar_quote_is_allowed():
+    assert policy("select $$set_config pg_sleep$$") is None
+
+
+def test_unclosed_dollar_quote():
+    with pytest.raises(SQLSyntaxError):
+        tokenize("select $a$ text $b$")
+
+
+def test_positional_parameter_is_not_dollar_quote():
+    assert [token.kind for token in tokenize("select $1")] == ["word", "param"]
+
+
+def test_nested_block_comments():
+    tokens = tokenize("select /* a /* b */ set_config */ 1")
+    assert [token.text for token in tokens] == ["select", "1"]
+
+
+def test_unclosed_nested_block_comment():
+    with pytest.raises(SQLSyntaxError):
+        tokenize("select /* a /* b */ 1")
+
+
+def test_quoted_identifiers_are_checked():
+    assert policy('select "set_config"(\'a\', \'b\', false)') is not None
+    assert policy('select * from "PG_class"') is not None
+
+
+def test_escape_string_backslash_quote():
+    tokens = tokenize(r"select E'a\'b', 'c''d'")
+    assert [token.text for token in tokens if token.kind == STRING] == [
+        r"E'a\'b'",
+        "'c''d'",
+    ]
+
+
+def test_statement_type_after_cte():
+    analysis = analyze_sql("with x as (select 1) delete from t")
+    assert analysis.statement_type == "delete"
+    assert policy("with x as (select 1) delete from t") is not None
+    assert policy("with x as (select 1) delete from t", READ_AND_DML) is None
+
+
+def test_into_allowed_only_in_dml():
+    assert policy("select 1 into t") is not None
+    assert policy("insert into t values (1)", READ_AND_DML) is None
+
+
+def test_multiple_statements_rejected():
+    assert policy("select 1; select 2") == "Допускается только один SQL-запрос"
+    assert policy("select 1;") is None
+
+
+def test_unbalanced_parentheses_rejected():
+    assert policy("select 1) union (select 2") == "Непарные скобки в SQL-запросе"
+
+
+def test_fingerprint_ignores_comments_and_case():
+    assert (
+        analyze_sql("SELECT  1 -- c\n").fingerprint
+        == analyze_sql("select /* x */ 1").fingerprint
+    )
+
+
+@pytest.mark.parametrize(
+    "sql, expected",
+    [
+        ("select a from t order by a", True),
+        ("select 1 union select 2 ORDER\nBY 1", True),
+        ("with c as (select a from t order by a) select a from c", False),
+        ("select row_number() over (order by a) from t", False),
+        ("select string_agg(a, ',' order by a) from t", False),
+        ("select * from (select a from t order by a) s", False),
+        ("select \"order\" by_ from t", False),
+        ("select 'order by' from t", False),
+        ("select 1; select 2 order by 1", False),
+    ],
+)
+def test_ordered_only_for_top_level_order_by(sql, expected):
+    assert analyze_sql(sql).ordered is expected